@@ -0,0 +1,214 @@
+"""
+Offline benchmarks of the operations that normally need AWS and live hosts -- baking an
+AMI, launching N instances, reconciling M security groups and deploying code to K hosts --
+run against the simulated backends in fakes.py.  For each, reports the wall time, the EC2
+API calls made and the SSH round-trips, connections and bytes.  The numbers only mean
+something relative to each other (e.g., before and after a change), at the same knobs.
+
+Run from the repository root, e.g.:
+    python benchmarks/backend_bench.py
+    python benchmarks/backend_bench.py launch deploy --instances 50 --hosts 40 --rtt 0.05
+    python benchmarks/backend_bench.py reconcile --groups 50 --max-request-rate 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['DEVOPS_SETTINGS_MODULE'] = 'bench_settings'
+
+BENCHMARKS = ['bake', 'rebake', 'launch', 'reconcile', 'reconcile-noop', 'deploy']
+
+
+class Measurement(object):
+    def __init__(self, name, wall_time, ec2_calls, ssh_counts, connects, gateway_stats, error=None):
+        super(Measurement, self).__init__()
+        self.name = name
+        self.wall_time = wall_time
+        self.ec2_calls = ec2_calls
+        self.gateway_stats = gateway_stats
+        self.ssh_counts = ssh_counts
+        self.connects = connects
+        self.error = error
+
+    def row(self):
+        return '%-28s %8.2fs %10d %15d %9d %12d%s' % (
+            self.name, self.wall_time, sum(self.ec2_calls.values()), self.ssh_counts['round_trips'],
+            self.connects, self.ssh_counts['bytes_sent'], '  FAILED: %s' % self.error if self.error else '')
+
+    def ec2_breakdown(self):
+        return ', '.join('%s=%d' % item for item in sorted(self.ec2_calls.items()))
+
+    def gateway_summary(self):
+        return ', '.join('%s=%s' % (k, self.gateway_stats[k])
+                         for k in ('calls', 'requests', 'coalesced', 'throttled', 'retried', 'rate_limited', 'rate'))
+
+
+def measure(name, fn, quiet):
+    from devops import settings
+    from devops.gateway import ec2_gateway
+    ec2_gateway.reset_counts()
+    settings.ec2_conn.reset_counts()
+    settings.fab_api.reset_counts()
+    connects_before = settings.connection_cache.connects
+    stdout = sys.stdout
+    error = None
+    start = time.time()
+    try:
+        if quiet:
+            sys.stdout = open(os.devnull, 'w')
+        fn()
+    except Exception, e:
+        error = '%s: %s' % (type(e).__name__, e)
+    finally:
+        sys.stdout = stdout
+    return Measurement(name, time.time() - start, dict(settings.ec2_conn.call_counts),
+                       settings.fab_api.counts(), settings.connection_cache.connects - connects_before,
+                       ec2_gateway.stats(), error)
+
+
+def bake_benchmark(n_units):
+    from devops import settings
+    from devops.base import AMI, ExternalAMI, SecurityGroup, SecurityGroupRule
+    from devops.instance_config import CommandStrs
+    units = [CommandStrs('Bench step %d' % i, ['echo step %d' % i]) for i in range(n_units)]
+    sg = SecurityGroup('bench-ami', 'Bench AMI creation', [SecurityGroupRule('tcp', 22, 22, cidr_ip='0.0.0.0/0')])
+    ami = AMI('Bench', '1', settings.DEVOPS_ENV, ExternalAMI('ami-base'), units)
+    return lambda: ami.create(settings.ec2_conn, sg, use_layer_cache=True)
+
+
+def launch_benchmark(n_instances):
+    from devops import settings
+    from devops.base import Instance, launch_instances
+
+    def run():
+        instances = [Instance('bench', 'bench-%d' % i, '1', 'r1', 'bench', settings.DEVOPS_ENV, 'ami-base',
+                              'm1.small', settings.ALL_AVAILABILITY_ZONES[i % 2], ['default'], [])
+                     for i in range(n_instances)]
+        failed = [r for r in launch_instances(settings.ec2_conn, instances) if not r.succeeded]
+        if failed:
+            raise Exception('%d instances failed: %s' % (len(failed), failed[0]))
+    return run
+
+
+def reconcile_benchmark(n_groups):
+    from devops import settings
+    from devops.base import SecurityGroup, SecurityGroupRule, reconcile_security_groups
+    groups = []
+    for i in range(n_groups):
+        rules = [SecurityGroupRule('tcp', 22, 22, cidr_ip='0.0.0.0/0'),
+                 SecurityGroupRule('tcp', 8000 + i, 8000 + i, cidr_ip='10.0.0.0/8')]
+        if i > 0:
+            rules.append(SecurityGroupRule('tcp', 5432, 5432, src_group_name='bench-sg-%d' % (i - 1)))
+        groups.append(SecurityGroup('bench-sg-%d' % i, 'Bench group %d' % i, rules))
+    return lambda: reconcile_security_groups(settings.ec2_conn, groups)
+
+
+def deploy_benchmark(n_hosts, pool_size):
+    from devops.deployment import CodeDeployment, SvnCodeRepository
+    from devops.fleet import FleetExecutor
+    from devops.instance_config import SshKey, SshKeyPlacement
+    key_dir = tempfile.mkdtemp(prefix='devops-bench-')
+    with open(os.path.join(key_dir, 'bench_key'), 'w') as f:
+        f.write('not a real key\n')
+    key_placement = SshKeyPlacement('Bench key', SshKey('bench_key', key_dir), '/home/ubuntu/.ssh')
+    repo = SvnCodeRepository('svn+ssh://svn.bench.invalid/repo', key_placement)
+    deployment = CodeDeployment('Bench code', repo, 'app', 'trunk', '/deploy', activate_immediately=True)
+    hosts = ['ubuntu@bench-host-%d.invalid' % i for i in range(n_hosts)]
+
+    def run():
+        FleetExecutor([key_placement, deployment], pool_size=pool_size).run(hosts).raise_for_failures()
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks against simulated EC2 and SSH')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='any of: %s (default: all).  rebake and reconcile-noop measure repeating '
+                             'bake and reconcile, so run them after those' % ', '.join(BENCHMARKS))
+    parser.add_argument('--units', type=int, default=5, help='config units in the baked AMI')
+    parser.add_argument('--instances', type=int, default=20, help='instances to launch')
+    parser.add_argument('--groups', type=int, default=20, help='security groups to reconcile')
+    parser.add_argument('--hosts', type=int, default=20, help='hosts to deploy to')
+    parser.add_argument('--pool-size', type=int, default=10, help='hosts deployed to at once')
+    parser.add_argument('--call-latency', type=float, default=0.05, help='seconds per EC2 API call')
+    parser.add_argument('--visibility-delay', type=float, default=1.0,
+                        help='seconds before a new EC2 resource is visible to the API')
+    parser.add_argument('--boot-time', type=float, default=2.0, help='seconds from pending to running')
+    parser.add_argument('--ssh-delay', type=float, default=1.0, help='seconds from running to sshd being up')
+    parser.add_argument('--image-time', type=float, default=3.0, help='seconds for an image to become available')
+    parser.add_argument('--max-request-rate', type=int, help='EC2 API calls per second beyond which EC2 throttles '
+                                                             '(default: no throttling)')
+    parser.add_argument('--rate-limit', type=float, help="the EC2 gateway's rate limit, in requests per second "
+                                                         '(default: EC2_RATE_LIMIT)')
+    parser.add_argument('--rtt', type=float, default=0.02, help='seconds per SSH round-trip')
+    parser.add_argument('--bandwidth', type=float, default=10 * 1024 * 1024, help='SSH bytes per second')
+    parser.add_argument('--handshake', type=float, default=0.1, help='seconds per SSH connection')
+    parser.add_argument('--verbose', action='store_true', help="show devops' own output")
+    parser.add_argument('--trace', metavar='PATH', help='write a Chrome trace of the run to PATH, and print '
+                                                         'the per-config-unit latency table')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+    selected = args.benchmarks or BENCHMARKS
+
+    from devops import settings
+    import fakes
+    ec2_conn = settings.ec2_conn
+    ec2_conn.call_latency = args.call_latency
+    ec2_conn.visibility_delay = args.visibility_delay
+    ec2_conn.boot_time = args.boot_time
+    ec2_conn.ssh_delay = args.ssh_delay
+    ec2_conn.image_time = args.image_time
+    ec2_conn.max_request_rate = args.max_request_rate
+    if args.rate_limit:
+        from devops.gateway import ec2_gateway
+        ec2_gateway.max_rate = ec2_gateway.bucket.rate = args.rate_limit
+    settings.fab_api.rtt = args.rtt
+    settings.fab_api.bandwidth = args.bandwidth
+    settings.connection_cache.handshake_time = args.handshake
+    fakes.install(ec2_conn, settings.connection_cache)
+    if args.trace:
+        from devops import tracing
+        tracing.enable()
+
+    benchmarks = {
+        'bake': ('bake (%d units)' % args.units, lambda: bake_benchmark(args.units)),
+        'rebake': ('rebake (%d units, cached)' % args.units, lambda: bake_benchmark(args.units)),
+        'launch': ('launch %d instances' % args.instances, lambda: launch_benchmark(args.instances)),
+        'reconcile': ('reconcile %d groups' % args.groups, lambda: reconcile_benchmark(args.groups)),
+        'reconcile-noop': ('reconcile %d groups (no-op)' % args.groups, lambda: reconcile_benchmark(args.groups)),
+        'deploy': ('deploy to %d hosts' % args.hosts, lambda: deploy_benchmark(args.hosts, args.pool_size)),
+    }
+    measurements = []
+    for key in BENCHMARKS:
+        if key in selected:
+            name, setup = benchmarks[key]
+            measurements.append(measure(name, setup(), not args.verbose))
+
+    print '%-28s %9s %10s %15s %9s %12s' % ('benchmark', 'wall', 'ec2 calls', 'ssh round-trips', 'connects',
+                                            'bytes sent')
+    for m in measurements:
+        print m.row()
+    print
+    for m in measurements:
+        print '%s: %s' % (m.name, m.ec2_breakdown() or 'no EC2 calls')
+    print
+    print 'EC2 gateway:'
+    for m in measurements:
+        print '%s: %s' % (m.name, m.gateway_summary())
+    if args.trace:
+        tracing.export_chrome_trace(args.trace)
+        print
+        print 'Config unit latency:'
+        print tracing.unit_latency_table()
+        print 'Wrote %s' % args.trace
+    if any(m.error for m in measurements):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""
+Settings for the offline benchmarks (see backend_bench.py): EC2 and SSH are simulated by the
+fakes in fakes.py, whose knobs backend_bench.py sets from its command line.
+"""
+import fakes
+
+KEYPAIR_NAME = 'bench'
+ALL_AVAILABILITY_ZONES = ['us-east-1a', 'us-east-1b']
+USERNAME = 'ubuntu'
+INSTANCE_TYPE_FOR_AMI_CREATION = 't1.micro'
+AWS_OWNER_ID = '000000000000'
+DEVOPS_ENV = 'bench'
+
+# Nothing should outlive a benchmark run
+OPS_REGISTRY_SNAPSHOT_PATH = None
+
+fab_api = fakes.FakeFabApi()
+ec2_conn = fakes.FakeEC2Connection(AWS_OWNER_ID)
+connection_cache = fakes.FakeConnectionCache()
@@ -0,0 +1,488 @@
+"""
+Simulated EC2 and SSH backends, for measuring devops without an AWS account or any hosts.
+
+FakeEC2Connection stands in for boto's EC2Connection (the calls devops makes, with boto's
+shapes): every call costs call_latency seconds, instances take boot_time to go from pending
+to running (and sshd is up ssh_delay after that), images take image_time to become
+available, and a new resource is invisible to describe/tag calls for visibility_delay
+seconds -- EC2's eventual consistency.  With max_request_rate, calls beyond that many in
+any one second fail with RequestLimitExceeded, as EC2's throttling does.
+
+FakeFabApi stands in for fabric.api: every run/sudo costs one rtt, a put costs one rtt plus
+size / bandwidth, and commands "succeed" with canned output (see responses).
+FakeConnectionCache stands in for Fabric's connection cache (a miss costs handshake_time).
+The SSH counters live in shared memory, so the work done in FleetExecutor's worker
+processes is counted too.
+
+See install() for plugging them in, and backend_bench.py for their use.
+"""
+import collections
+from contextlib import contextmanager
+import copy
+import itertools
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+import boto.exception
+
+
+def _throttled():
+    return boto.exception.EC2ResponseError(503, 'Service Unavailable',
+                                           '<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                                           '<Message>Request limit exceeded.</Message></Error></Errors></Response>')
+
+
+def _not_found(code, resource_id):
+    return boto.exception.EC2ResponseError(400, 'Bad Request',
+                                           '<Response><Errors><Error><Code>%s</Code><Message>%s does not exist'
+                                           '</Message></Error></Errors></Response>' % (code, resource_id))
+
+
+class _Grant(object):
+    def __init__(self, cidr_ip=None, group_id=None, groupName=None, owner_id=None):
+        self.cidr_ip = cidr_ip
+        self.group_id = group_id
+        self.groupName = groupName
+        self.owner_id = owner_id
+
+
+class _IPPermissions(object):
+    def __init__(self, ip_protocol, from_port, to_port):
+        self.ip_protocol = ip_protocol
+        # boto hands back ports as strings
+        self.from_port = str(from_port) if from_port is not None else None
+        self.to_port = str(to_port) if to_port is not None else None
+        self.grants = []
+
+
+class FakeSecurityGroup(object):
+    def __init__(self, group_id, name, description, owner_id):
+        self.id = group_id
+        self.name = name
+        self.description = description
+        self.owner_id = owner_id
+        self.rules = []
+
+
+class _TaggedObject(object):
+    def add_tag(self, key, value=''):
+        self.connection.create_tags([self.id], {key: value})
+        self.tags[key] = value
+
+
+class FakeInstance(_TaggedObject):
+    def __init__(self, conn, record):
+        self.connection = conn
+        self._update_from(record)
+
+    def _update_from(self, record):
+        self.__dict__.update(copy.deepcopy(record))
+
+    def update(self):
+        self._update_from(self.connection._describe_instance(self.id))
+        return self.state
+
+    def terminate(self):
+        self.connection.terminate_instances([self.id])
+
+
+class FakeImage(_TaggedObject):
+    def __init__(self, conn, record):
+        self.connection = conn
+        self.__dict__.update(copy.deepcopy(record))
+
+
+class FakeReservation(object):
+    def __init__(self, reservation_id, instances):
+        self.id = reservation_id
+        self.instances = instances
+
+
+class FakeEC2Connection(object):
+    """A simulated EC2 (see the module docstring).  Counts calls by method in call_counts."""
+    def __init__(self, owner_id='000000000000', call_latency=0.05, visibility_delay=1.0, boot_time=2.0,
+                 ssh_delay=1.0, image_time=3.0, max_request_rate=None):
+        super(FakeEC2Connection, self).__init__()
+        self.owner_id = owner_id
+        self.call_latency = call_latency
+        self.visibility_delay = visibility_delay
+        self.boot_time = boot_time
+        self.ssh_delay = ssh_delay
+        self.image_time = image_time
+        self.max_request_rate = max_request_rate
+        self.call_counts = {}
+        self.throttled_counts = {}
+        self._recent_calls = collections.deque()  # Times of the calls in the last second
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._instances = {}  # ID -> record (a dict of attributes)
+        self._images = {}
+        self._groups = {}  # Name -> FakeSecurityGroup
+        self._created_at = {}  # Resource ID -> time
+
+    # -- bookkeeping
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        # Every call comes through here, as with boto (so that, e.g., tracing can wrap it)
+        with self._lock:
+            self.call_counts[action] = self.call_counts.get(action, 0) + 1
+            if self.max_request_rate:
+                now = time.time()
+                while self._recent_calls and self._recent_calls[0] <= now - 1:
+                    self._recent_calls.popleft()
+                self._recent_calls.append(now)
+                throttled = len(self._recent_calls) > self.max_request_rate
+                if throttled:
+                    self.throttled_counts[action] = self.throttled_counts.get(action, 0) + 1
+        time.sleep(self.call_latency)
+        if self.max_request_rate and throttled:
+            raise _throttled()
+
+    def _call(self, method):
+        self.make_request(method)
+
+    def reset_counts(self):
+        with self._lock:
+            self.call_counts = {}
+            self.throttled_counts = {}
+
+    def _new_id(self, prefix):
+        return '%s-%08x' % (prefix, next(self._ids))
+
+    def _visible(self, resource_id):
+        return time.time() - self._created_at[resource_id] >= self.visibility_delay
+
+    def _require_visible(self, resource_ids, code):
+        for resource_id in resource_ids:
+            if resource_id not in self._created_at or not self._visible(resource_id):
+                raise _not_found(code, resource_id)
+
+    def _instance_record(self, instance_id):
+        record = self._instances[instance_id]
+        if record['state'] == 'pending' and time.time() - self._created_at[instance_id] >= self.boot_time:
+            record['state'] = 'running'
+        return record
+
+    def _image_record(self, image_id):
+        record = self._images[image_id]
+        if record['state'] == 'pending' and time.time() - self._created_at[image_id] >= self.image_time:
+            record['state'] = 'available'
+        return record
+
+    @staticmethod
+    def _matches(record, filters):
+        for key, wanted in (filters or {}).items():
+            values = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+            if key.startswith('tag:'):
+                actual = record['tags'].get(key[4:])
+            elif key == 'instance-id':
+                actual = record['id']
+            else:
+                actual = record.get(key.replace('-', '_'))
+            if actual not in values:
+                return False
+        return True
+
+    def ssh_port_is_open(self, host, port=22, timeout=3.0):
+        """Whether sshd on the (fake) host is up: a stand-in for devops.readiness.ssh_port_is_open"""
+        with self._lock:
+            for instance_id, record in self._instances.items():
+                if host in (record['public_dns_name'], record['ip_address']):
+                    up_at = self._created_at[instance_id] + self.boot_time + self.ssh_delay
+                    return record['state'] != 'terminated' and time.time() >= up_at
+        return False
+
+    # -- instances
+
+    def run_instances(self, image_id, min_count=1, max_count=1, key_name=None, security_groups=None,
+                      user_data=None, instance_type='m1.small', placement=None, ebs_optimized=False, **kwargs):
+        self._call('run_instances')
+        with self._lock:
+            if image_id not in self._images and not image_id.startswith('ami-base'):
+                raise _not_found('InvalidAMIID.NotFound', image_id)
+            instances = []
+            for launch_index in range(max_count):
+                instance_id = self._new_id('i')
+                n = int(instance_id.split('-')[1], 16)
+                ip = '10.%d.%d.%d' % ((n >> 16) & 255, (n >> 8) & 255, n & 255)
+                record = {'id': instance_id, 'state': 'pending', 'image_id': image_id,
+                          'instance_type': instance_type, 'placement': placement,
+                          'ami_launch_index': str(launch_index), 'key_name': key_name,
+                          'groups': list(security_groups or []), 'tags': {},
+                          'public_dns_name': 'ec2-%s.compute-1.fake' % ip.replace('.', '-'),
+                          'private_dns_name': 'ip-%s.ec2.internal' % ip.replace('.', '-'),
+                          'ip_address': ip, 'private_ip_address': ip}
+                self._instances[instance_id] = record
+                self._created_at[instance_id] = time.time()
+                instances.append(FakeInstance(self, record))
+        return FakeReservation(self._new_id('r'), instances)
+
+    def _describe_instance(self, instance_id):
+        self._call('describe_instances')
+        with self._lock:
+            self._require_visible([instance_id], 'InvalidInstanceID.NotFound')
+            return self._instance_record(instance_id)
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        self._call('describe_instances')
+        with self._lock:
+            if instance_ids:
+                self._require_visible(instance_ids, 'InvalidInstanceID.NotFound')
+                ids = instance_ids
+            else:
+                ids = [i for i in sorted(self._instances) if self._visible(i)]
+            records = [self._instance_record(i) for i in ids]
+            instances = [FakeInstance(self, r) for r in records if self._matches(r, filters)]
+        return [FakeReservation(self._new_id('r'), [i]) for i in instances]
+
+    def terminate_instances(self, instance_ids):
+        self._call('terminate_instances')
+        with self._lock:
+            for instance_id in instance_ids:
+                self._instances[instance_id]['state'] = 'terminated'
+
+    # -- images
+
+    def create_image(self, instance_id, name, description=None, no_reboot=False):
+        self._call('create_image')
+        with self._lock:
+            image_id = self._new_id('ami')
+            self._images[image_id] = {'id': image_id, 'name': name, 'description': description,
+                                      'state': 'pending', 'tags': {}, 'owner_id': self.owner_id,
+                                      'creationDate': time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())}
+            self._created_at[image_id] = time.time()
+        return image_id
+
+    def get_image(self, image_id):
+        self._call('describe_images')
+        with self._lock:
+            self._require_visible([image_id], 'InvalidAMIID.NotFound')
+            return FakeImage(self, self._image_record(image_id))
+
+    def get_all_images(self, image_ids=None, owners=None, filters=None):
+        self._call('describe_images')
+        with self._lock:
+            ids = image_ids or [i for i in sorted(self._images) if self._visible(i)]
+            records = [self._image_record(i) for i in ids if i in self._images]
+            return [FakeImage(self, r) for r in records if self._matches(r, filters)]
+
+    def deregister_image(self, image_id, delete_snapshot=False):
+        self._call('deregister_image')
+        with self._lock:
+            self._images.pop(image_id, None)
+        return True
+
+    # -- tags
+
+    def create_tags(self, resource_ids, tags):
+        self._call('create_tags')
+        with self._lock:
+            for resource_id in resource_ids:
+                # As EC2 does, named after the kind of resource that isn't found
+                self._require_visible([resource_id], 'InvalidAMIID.NotFound' if resource_id.startswith('ami-')
+                                      else 'InvalidInstanceID.NotFound')
+            for resource_id in resource_ids:
+                record = self._instances.get(resource_id) or self._images.get(resource_id)
+                record['tags'].update(tags)
+        return True
+
+    # -- security groups
+
+    def get_all_security_groups(self, groupnames=None, filters=None):
+        self._call('describe_security_groups')
+        with self._lock:
+            if groupnames:
+                missing = [n for n in groupnames if n not in self._groups]
+                if missing:
+                    raise _not_found('InvalidGroup.NotFound', missing[0])
+                names = groupnames
+            else:
+                wanted = (filters or {}).get('group-name')
+                names = [n for n in sorted(self._groups) if wanted is None or n in wanted]
+            return [copy.deepcopy(self._groups[n]) for n in names]
+
+    def create_security_group(self, name, description):
+        self._call('create_security_group')
+        with self._lock:
+            group = FakeSecurityGroup(self._new_id('sg'), name, description, self.owner_id)
+            self._groups[name] = group
+            return copy.deepcopy(group)
+
+    def _find_rule(self, group, ip_protocol, from_port, to_port, create=False):
+        from_port = str(from_port) if from_port is not None else None
+        to_port = str(to_port) if to_port is not None else None
+        for rule in group.rules:
+            if (rule.ip_protocol, rule.from_port, rule.to_port) == (ip_protocol, from_port, to_port):
+                return rule
+        if create:
+            rule = _IPPermissions(ip_protocol, from_port, to_port)
+            group.rules.append(rule)
+            return rule
+        return None
+
+    def authorize_security_group(self, group_name, src_security_group_name=None,
+                                 src_security_group_owner_id=None, ip_protocol=None, from_port=None,
+                                 to_port=None, cidr_ip=None):
+        self._call('authorize_security_group')
+        with self._lock:
+            rule = self._find_rule(self._groups[group_name], ip_protocol, from_port, to_port, create=True)
+            if src_security_group_name:
+                src = self._groups[src_security_group_name]
+                rule.grants.append(_Grant(group_id=src.id, groupName=src.name,
+                                          owner_id=src_security_group_owner_id or self.owner_id))
+            else:
+                rule.grants.append(_Grant(cidr_ip=cidr_ip))
+        return True
+
+    def revoke_security_group(self, group_name, src_security_group_name=None,
+                              src_security_group_owner_id=None, ip_protocol=None, from_port=None,
+                              to_port=None, cidr_ip=None):
+        self._call('revoke_security_group')
+        with self._lock:
+            group = self._groups[group_name]
+            rule = self._find_rule(group, ip_protocol, from_port, to_port)
+            if rule is not None:
+                rule.grants = [g for g in rule.grants
+                               if not (g.cidr_ip == cidr_ip and g.groupName == src_security_group_name)]
+                if not rule.grants:
+                    group.rules.remove(rule)
+        return True
+
+
+class _Result(str):
+    """Like Fabric's _AttributeString"""
+    def __new__(cls, output, return_code=0, command=None):
+        result = str.__new__(cls, output)
+        result.return_code = return_code
+        result.failed = return_code != 0
+        result.succeeded = not result.failed
+        result.command = command
+        return result
+
+
+class _Env(object):
+    def __init__(self):
+        self.host_string = None
+        self.key_filename = None
+        self.warn_only = False
+
+
+class FakeFabApi(object):
+    """
+    A simulated fabric.api (see the module docstring).  responses is a list of (regex,
+    output) pairs; a command gets the output of the first regex that it matches, or ''.
+    """
+    DEFAULT_RESPONSES = [(r'^echo "Hello world"', 'Hello world')]
+
+    def __init__(self, rtt=0.02, bandwidth=10 * 1024 * 1024, responses=None):
+        super(FakeFabApi, self).__init__()
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.responses = [(re.compile(regex), output) for regex, output in (responses or self.DEFAULT_RESPONSES)]
+        self.env = _Env()
+        # In shared memory, so that the worker processes' work counts too
+        self._round_trips = multiprocessing.Value('l', 0)
+        self._bytes_sent = multiprocessing.Value('l', 0)
+        self._local_commands = multiprocessing.Value('l', 0)
+
+    @staticmethod
+    def _add(counter, n):
+        with counter.get_lock():
+            counter.value += n
+
+    def counts(self):
+        return {'round_trips': self._round_trips.value,
+                'bytes_sent': self._bytes_sent.value,
+                'local_commands': self._local_commands.value}
+
+    def reset_counts(self):
+        for counter in (self._round_trips, self._bytes_sent, self._local_commands):
+            with counter.get_lock():
+                counter.value = 0
+
+    @contextmanager
+    def settings(self, **kwargs):
+        previous = dict((k, getattr(self.env, k, None)) for k in kwargs)
+        for k, v in kwargs.items():
+            setattr(self.env, k, v)
+        try:
+            yield
+        finally:
+            for k, v in previous.items():
+                setattr(self.env, k, v)
+
+    def _respond(self, command):
+        for regex, output in self.responses:
+            if regex.search(command):
+                return output
+        return ''
+
+    def run(self, command, stdout=None, **kwargs):
+        self._add(self._round_trips, 1)
+        time.sleep(self.rtt)
+        output = self._respond(command)
+        if stdout is not None:
+            stdout.write(output)
+        return _Result(output, command=command)
+
+    sudo = run
+
+    def put(self, local_path, remote_path, **kwargs):
+        size = os.path.getsize(local_path)
+        self._add(self._round_trips, 1)
+        self._add(self._bytes_sent, size)
+        time.sleep(self.rtt + float(size) / self.bandwidth)
+        return _Result('', command='put %s' % remote_path)
+
+    def local(self, command, capture=False, **kwargs):
+        self._add(self._local_commands, 1)
+        return _Result('', command=command)
+
+
+class _FakeTransport(object):
+    def is_active(self):
+        return True
+
+    def send_ignore(self):
+        pass
+
+
+class _FakeSSHClient(object):
+    def get_transport(self):
+        return _FakeTransport()
+
+    def close(self):
+        pass
+
+
+class FakeConnectionCache(dict):
+    """Stands in for fabric.state.connections: a miss "connects", costing handshake_time."""
+    def __init__(self, handshake_time=0.1):
+        super(FakeConnectionCache, self).__init__()
+        self.handshake_time = handshake_time
+        self._connects = multiprocessing.Value('l', 0)
+
+    def __missing__(self, key):
+        with self._connects.get_lock():
+            self._connects.value += 1
+        time.sleep(self.handshake_time)
+        client = self[key] = _FakeSSHClient()
+        return client
+
+    @property
+    def connects(self):
+        return self._connects.value
+
+
+def install(ec2_conn, connection_cache):
+    """
+    Plugs the fakes into the devops modules that reach EC2 or SSH other than through the
+    settings module's ec2_conn and fab_api (which the settings module must set to the fakes).
+    """
+    from devops import connections
+    from devops import readiness
+    connections.fab_connections = connection_cache
+    readiness.ssh_port_is_open = ec2_conn.ssh_port_is_open
@@ -0,0 +1,45 @@
+"""
+Import-time benchmark: times "import locately.locately_configs" and verifies that importing
+it does no network I/O (no DNS lookups, no socket connects).
+
+Run from the repository root, e.g.:
+    DEVOPS_SETTINGS_MODULE=locately.settings python benchmarks/import_bench.py
+"""
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DEVOPS_SETTINGS_MODULE', 'locately.settings')
+
+network_calls = []
+
+
+def _recording(name, fn):
+    def wrapper(*args, **kwargs):
+        network_calls.append((name, args[1:] if name == 'connect' else args))
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+socket.getaddrinfo = _recording('getaddrinfo', socket.getaddrinfo)
+socket.socket.connect = _recording('connect', socket.socket.connect)
+socket.socket.connect_ex = _recording('connect', socket.socket.connect_ex)
+
+
+def main():
+    start = time.time()
+    import locately.locately_configs  # NOQA
+    elapsed = time.time() - start
+    print 'import locately.locately_configs: %.1f ms' % (elapsed * 1000)
+    if network_calls:
+        print 'FAILED: %d network calls during import:' % len(network_calls)
+        for name, args in network_calls:
+            print '  %s%r' % (name, args)
+        sys.exit(1)
+    print 'OK: no network I/O during import'
+
+
+if __name__ == '__main__':
+    main()
@@ -22,5 +22,22 @@ except ImportError:
     traceback.print_exc()
     raise Exception("Couldn't import module %s\n%s" % (settings_module_name, traceback.format_exc()))
 
-from devops.boto_adapt import OpsRegistry
-settings.ops_registry = OpsRegistry(settings.ec2_conn, settings.DEVOPS_ENV)
+from devops.lazy import LazyObject
+
+
+def _build_ops_registry():
+    from devops.boto_adapt import OpsRegistry
+    return OpsRegistry(settings.ec2_conn, settings.DEVOPS_ENV)
+
+
+def _build_ec2_conn(ec2_conn):
+    from devops.gateway import ec2_gateway
+    return ec2_gateway.install(ec2_conn)
+
+
+# Every EC2 call goes through the gateway (see devops.gateway), unless EC2_GATEWAY is False
+if getattr(settings, 'EC2_GATEWAY', True) and hasattr(settings, 'ec2_conn'):
+    settings.ec2_conn = LazyObject(lambda ec2_conn=settings.ec2_conn: _build_ec2_conn(ec2_conn))
+
+# Built on first use, so that importing devops (or a configs module) does no I/O
+settings.ops_registry = LazyObject(_build_ops_registry)
@@ -0,0 +1,233 @@
+"""
+Build-once, fan-out distribution of code.  Rather than every host exporting from the svn
+server itself (so that a fleet deploy hits the one server N times at once), the export is
+done once, locally, and packed into a compressed tarball named by a hash of its content.
+The tarball is then pushed to the hosts -- or pulled by them over HTTP, e.g., from an
+ArtifactServer -- in parallel, and each host verifies its checksum before unpacking it.  A
+host that already has the tarball isn't sent it again; each host keeps the
+REMOTE_ARTIFACT_KEEP it most recently installed.
+
+See CodeDeployment.use_artifact, and deploy() for the whole pipeline.
+"""
+import BaseHTTPServer
+import copy
+import gzip
+import hashlib
+import os
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import tarfile
+import tempfile
+import threading
+import urllib
+
+from devops import fleet
+from devops import output
+from devops import settings
+from devops.connections import connection_pool
+from devops.instance_config import file_digest
+fab_api = settings.fab_api
+
+# Where built artifacts are kept locally, and on each host
+ARTIFACT_DIR = getattr(settings, 'ARTIFACT_DIR', os.path.expanduser('~/.devops/artifacts'))
+REMOTE_ARTIFACT_DIR = getattr(settings, 'REMOTE_ARTIFACT_DIR', '/var/tmp/devops-artifacts')
+# How many artifacts each host keeps in REMOTE_ARTIFACT_DIR (the most recently installed)
+REMOTE_ARTIFACT_KEEP = getattr(settings, 'REMOTE_ARTIFACT_KEEP', 3)
+
+
+def tree_hash(root):
+    """
+    Returns a sha256 over the relative path, executable bit and content of everything under
+    root (in sorted order), so that the same code always hashes the same -- unlike a
+    tarball of it, whose bytes depend on timestamps.
+    """
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(dirnames + filenames):
+            path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(path, root)
+            if os.path.islink(path):
+                h.update('L %s %s\0' % (rel_path, os.readlink(path)))
+            elif os.path.isdir(path):
+                h.update('D %s\0' % rel_path)
+            else:
+                executable = os.stat(path).st_mode & 0111 != 0
+                h.update('F %s %d %s\0' % (rel_path, executable, file_digest(path)))
+    return h.hexdigest()
+
+
+class Artifact(object):
+    """A built tarball of code, named by the hash of its content"""
+    def __init__(self, name, local_path, sha256, size):
+        super(Artifact, self).__init__()
+        self.name = name
+        self.local_path = local_path
+        # Of the tarball itself, for verifying transfers
+        self.sha256 = sha256
+        self.size = size
+
+    @property
+    def filename(self):
+        return os.path.basename(self.local_path)
+
+    @property
+    def remote_path(self):
+        return os.path.join(REMOTE_ARTIFACT_DIR, self.filename)
+
+    def __str__(self):
+        return '%s (%d bytes)' % (self.filename, self.size)
+
+
+def build_artifact(repo, source_folder, revision=None, artifact_dir=ARTIFACT_DIR):
+    """
+    Exports source_folder from the repository, locally, and packs it into a tarball in
+    artifact_dir.  If an identical export was packed before, its tarball is reused.
+    """
+    work_dir = tempfile.mkdtemp(prefix='devops-artifact-')
+    try:
+        export_dir = os.path.join(work_dir, 'export')
+        cmd = repo.export_cmd(source_folder, export_dir, revision, local=True)
+        with fab_api.settings(warn_only=True):
+            ret = fab_api.local(cmd, capture=True)
+        if ret.failed:
+            raise Exception('Fabric local failed: %s' % cmd)
+
+        name = '%s-%s' % (os.path.basename(source_folder.rstrip('/')), tree_hash(export_dir)[:16])
+        local_path = os.path.join(artifact_dir, name + '.tar.gz')
+        if os.path.exists(local_path):
+            print 'Reusing artifact %s' % local_path
+        else:
+            if not os.path.isdir(artifact_dir):
+                os.makedirs(artifact_dir)
+            # Written alongside and renamed into place, so a partial tarball is never reused
+            tmp_path = os.path.join(work_dir, name + '.tar.gz')
+            with open(tmp_path, 'wb') as f:
+                # mtime=0 keeps the gzip header the same from build to build
+                gz = gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0)
+                with tarfile.open(fileobj=gz, mode='w') as tar:
+                    for entry in sorted(os.listdir(export_dir)):
+                        tar.add(os.path.join(export_dir, entry), arcname=entry)
+                gz.close()
+            shutil.move(tmp_path, local_path)
+            print 'Built artifact %s' % local_path
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return Artifact(name, local_path, file_digest(local_path), os.path.getsize(local_path))
+
+
+def _verify_cmd(sha256, path):
+    return 'echo "%s  %s" | sha256sum -c --quiet -' % (sha256, path)
+
+
+def prune_cmd(keep=REMOTE_ARTIFACT_KEEP):
+    """Returns a command that deletes all but the keep most recently installed artifacts on a host."""
+    if keep < 1:
+        raise ValueError('Must keep at least one artifact: %s' % keep)
+    # Not the .tmp files of transfers in progress
+    return 'cd %s && ls -1t -- *.tar.gz | tail -n +%d | xargs -r rm -f --' % (REMOTE_ARTIFACT_DIR, keep + 1)
+
+
+def install(host_string, artifact, dest_path, base_url=None):
+    """
+    Gets the artifact onto the host (unless it's already there) and unpacks it into
+    dest_path.  The artifact is pushed over SSH, or, if base_url is given, pulled by the
+    host from base_url/<artifact filename>.  Either way it's checksummed before use.  Once
+    it's unpacked, older artifacts are deleted (see prune_cmd).
+    """
+    with connection_pool.session(host_string, warn_only=True):
+        present = fab_api.run(_verify_cmd(artifact.sha256, artifact.remote_path) + ' 2>/dev/null').succeeded
+
+    with connection_pool.session(host_string):
+        if present:
+            output.echo(host_string, 'Artifact already present: %s' % artifact)
+        else:
+            tmp_path = '%s.%s.tmp' % (artifact.remote_path, host_string.replace('@', '_').replace(':', '_'))
+            cmd = 'mkdir -p %s' % REMOTE_ARTIFACT_DIR
+            if base_url:
+                url = '%s/%s' % (base_url.rstrip('/'), urllib.quote(artifact.filename))
+                cmd += ' && curl -fsS -o %s %s' % (tmp_path, url)
+            ret = fab_api.run(cmd)
+            if ret.failed:
+                raise Exception('Fabric run failed: %s' % cmd)
+            if not base_url:
+                ret = fab_api.put(artifact.local_path, tmp_path)
+                if ret.failed:
+                    raise Exception('Fabric put failed')
+            cmd = '%s && mv %s %s' % (_verify_cmd(artifact.sha256, tmp_path), tmp_path, artifact.remote_path)
+            ret = fab_api.run(cmd)
+            if ret.failed:
+                fab_api.run('rm -f %s' % tmp_path)
+                raise Exception('Checksum verification of %s failed on %s' % (artifact, host_string))
+
+        # Touched, so that it counts as the most recently installed
+        cmd = 'mkdir -p %s && tar -xzf %s -C %s && touch %s && %s' % (
+            dest_path, artifact.remote_path, dest_path, artifact.remote_path, prune_cmd())
+        ret = fab_api.run(cmd)
+        if ret.failed:
+            raise Exception('Fabric run failed: %s' % cmd)
+        return ret
+
+
+class _ArtifactRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        # Serve only the (flat) artifact directory, not the current directory
+        filename = os.path.basename(urllib.unquote(path.split('?', 1)[0]))
+        return os.path.join(self.server.artifact_dir, filename)
+
+    def list_directory(self, path):
+        self.send_error(404, 'File not found')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class ArtifactServer(object):
+    """
+    Serves the local artifact directory over HTTP (in a background thread), so that hosts
+    can pull artifacts rather than having them pushed.  advertised_host is the address by
+    which the hosts can reach this machine.
+    """
+    def __init__(self, advertised_host, port=0, artifact_dir=ARTIFACT_DIR):
+        super(ArtifactServer, self).__init__()
+        self.server = _ThreadingHTTPServer(('', port), _ArtifactRequestHandler)
+        self.server.artifact_dir = artifact_dir
+        self.base_url = 'http://%s:%d' % (advertised_host, self.server.server_address[1])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def deploy(code_deployment, host_strings, base_url=None, pool_size=fleet.DEFAULT_POOL_SIZE, **kwargs):
+    """
+    Builds the code deployment's artifact once and deploys it to all of the hosts, in
+    parallel (with a FleetExecutor, to which kwargs are passed).  code_deployment itself is
+    left as it is.  Returns the FleetResult.
+    """
+    source_path = os.path.join(code_deployment.repo_containing_folder, code_deployment.dirname)
+    artifact = build_artifact(code_deployment.repo, source_path, code_deployment.revision)
+    deployment = copy.copy(code_deployment)
+    deployment.use_artifact(artifact, base_url)
+    print 'Deploying %s to %d hosts' % (artifact, len(host_strings))
+    return fleet.FleetExecutor([deployment], pool_size=pool_size, **kwargs).run(host_strings)
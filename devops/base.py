@@ -1,11 +1,17 @@
+from collections import OrderedDict
 from datetime import datetime
 import json
-import time
 
 import boto
 
 from devops import settings
 from devops import boto_adapt
+from devops import instance_config
+from devops import layers
+from devops import readiness
+from devops import scheduling
+from devops import tracing
+from devops.control_plane import control_plane
 
 
 # TODO
@@ -14,6 +20,9 @@ from devops import boto_adapt
 
 SSH_PORT = 22
 
+# How long a just-launched instance may take to become visible to the tagging API
+TAG_VISIBILITY_DEADLINE = 60
+
 
 class SecurityGroupRule(object):
     """See the docs for the Boto API"""
@@ -32,18 +41,155 @@ class SecurityGroupRule(object):
         else:
             return '%s - %s-%s - %s' % (self.ip_protocol, self.from_port, self.to_port, self.cidr_ip)
 
+    @property
+    def key(self):
+        """A normalized, hashable form of the rule, comparable with ec2_rule_keys()"""
+        return (self.ip_protocol, _port(self.from_port), _port(self.to_port), self.cidr_ip, self.src_group_name)
+
+    @classmethod
+    def from_key(cls, key):
+        ip_protocol, from_port, to_port, cidr_ip, src_group_name = key
+        return cls(ip_protocol, from_port, to_port, cidr_ip, src_group_name)
+
     @classmethod
     def rules_from_ec2_rule(cls, ec2_rule):
         return [cls(ec2_rule.ip_protocol, ec2_rule.from_port, ec2_rule.to_port,
                 grant.cidr_ip, grant.groupName) for grant in ec2_rule.grants]
 
 
+def _port(port):
+    # Boto hands back ports as strings
+    return int(port) if port is not None else None
+
+
+def ec2_rule_keys(ec2_group):
+    """
+    Returns a dict of SecurityGroupRule keys -> owner ID of the source group (None for a
+    CIDR grant), one for each grant on each rule of the EC2 security group.  (In EC2's data
+    model a rule can have many grants; each of our SecurityGroupRules is one grant.)
+    """
+    keys = {}
+    for r in ec2_group.rules:
+        for g in r.grants:
+            if g.cidr_ip is not None:
+                keys[(r.ip_protocol, _port(r.from_port), _port(r.to_port), g.cidr_ip, None)] = None
+            elif g.group_id is not None:
+                # The groupName attribute exists if the group_id is not None
+                keys[(r.ip_protocol, _port(r.from_port), _port(r.to_port), None, g.groupName)] = g.owner_id
+    return keys
+
+
 def fetch_ec2_security_group(ec2_conn, group_name):
     security_groups = ec2_conn.get_all_security_groups(groupnames=[group_name])
     assert len(security_groups) == 1
     return security_groups[0]
 
 
+def fetch_ec2_security_groups(ec2_conn, group_names):
+    """
+    Returns a dict of name -> EC2 security group for those of the named groups that exist,
+    with a single API call.  (Unlike groupnames=, a filter doesn't fail on a missing group.)
+    """
+    ec2_groups = ec2_conn.get_all_security_groups(filters={'group-name': sorted(set(group_names))})
+    return dict((g.name, g) for g in ec2_groups)
+
+
+class SecurityGroupPlan(object):
+    """
+    The changes needed to bring an EC2 security group in line with a SecurityGroup
+    definition: whether the group must be created, and the sets of rule keys to authorize
+    and to revoke.  Computing a plan touches nothing in EC2.
+    """
+    def __init__(self, security_group, create, to_authorize, to_revoke, description_mismatch=None):
+        super(SecurityGroupPlan, self).__init__()
+        self.security_group = security_group
+        self.create = create
+        self.to_authorize = to_authorize
+        # Rule key -> owner ID of the source group (None for CIDR grants)
+        self.to_revoke = to_revoke
+        # The EC2 group's description, if it doesn't match the definition's
+        self.description_mismatch = description_mismatch
+
+    @property
+    def has_changes(self):
+        return bool(self.create or self.to_authorize or self.to_revoke)
+
+    @property
+    def referenced_group_names(self):
+        """The source groups that applying the plan needs to resolve"""
+        return set(key[4] for key in self.to_authorize if key[4] is not None)
+
+    def __str__(self):
+        lines = ['Security group "%s"%s' % (self.security_group.name, ' (create)' if self.create else '')]
+        lines.extend('  + %s' % SecurityGroupRule.from_key(k) for k in sorted(self.to_authorize))
+        lines.extend('  - %s' % SecurityGroupRule.from_key(k) for k in sorted(self.to_revoke))
+        return '\n'.join(lines)
+
+    def apply(self, ec2_conn, ec2_groups_by_name):
+        """
+        Makes the planned changes.  ec2_groups_by_name must contain every group in
+        referenced_group_names (other than this one, if it's being created); a group that
+        this creates is added to it.
+        """
+        self.apply_create(ec2_conn, ec2_groups_by_name)
+        self.apply_rules(ec2_conn, ec2_groups_by_name)
+
+    def apply_create(self, ec2_conn, ec2_groups_by_name):
+        """Creates the group, if the plan calls for that, adding it to ec2_groups_by_name."""
+        if self.create:
+            print 'Creating security group "%s"' % self.security_group.name
+            ec2_groups_by_name[self.security_group.name] = ec2_conn.create_security_group(
+                name=self.security_group.name, description=self.security_group.description)
+
+    def report_description_mismatch(self):
+        if self.description_mismatch is not None:
+            print 'Description on the EC2 group ("%s") doesn\'t match desired description ("%s")' % (self.description_mismatch, self.security_group.description)
+            print "We're not able to change the description via Boto -- maybe someday?"
+
+    def rule_changes(self, ec2_conn, ec2_groups_by_name):
+        """
+        Returns the planned rule changes as functions of no arguments, each making one API
+        call.  They're independent of each other, so they may be called concurrently; the
+        group (and its source groups) must already exist.
+        """
+        name = self.security_group.name
+        changes = []
+
+        def authorize(key):
+            ip_protocol, from_port, to_port, cidr_ip, src_group_name = key
+            print 'Adding into the EC2 security group "%s": "%s"' % (name, SecurityGroupRule.from_key(key))
+            src_group = ec2_groups_by_name[src_group_name] if src_group_name else None
+            ret = ec2_conn.authorize_security_group(
+                group_name=name,
+                src_security_group_name=src_group.name if src_group else None,
+                src_security_group_owner_id=src_group.owner_id if src_group else None,
+                ip_protocol=ip_protocol, from_port=from_port, to_port=to_port, cidr_ip=cidr_ip)
+            assert ret == True
+
+        def revoke(key, src_owner_id):
+            ip_protocol, from_port, to_port, cidr_ip, src_group_name = key
+            print 'Revoking from the EC2 security group "%s": "%s"' % (name, SecurityGroupRule.from_key(key))
+            ec2_conn.revoke_security_group(
+                group_name=name,
+                src_security_group_name=src_group_name,
+                src_security_group_owner_id=src_owner_id,
+                ip_protocol=ip_protocol, from_port=from_port, to_port=to_port, cidr_ip=cidr_ip)
+
+        for key in sorted(self.to_authorize):
+            changes.append(lambda key=key: authorize(key))
+        for key, src_owner_id in sorted(self.to_revoke.items()):
+            changes.append(lambda key=key, src_owner_id=src_owner_id: revoke(key, src_owner_id))
+        return changes
+
+    def apply_rules(self, ec2_conn, ec2_groups_by_name):
+        """Makes the planned rule changes; the group (and its source groups) must already exist."""
+        self.report_description_mismatch()
+        for change in self.rule_changes(ec2_conn, ec2_groups_by_name):
+            change()
+        if not self.has_changes:
+            print 'Made no changes for security group "%s"' % self.security_group.name
+
+
 class SecurityGroup(object):
     def __init__(self, name, description, rules):
         self.name = name
@@ -53,100 +199,32 @@ class SecurityGroup(object):
     def __str__(self):
         return self.name
 
-    def create_or_update(self, ec2_conn):
+    def plan(self, ec2_group):
+        """
+        Returns the SecurityGroupPlan that would bring ec2_group (the existing EC2 security
+        group, or None if there isn't one) in line with this definition.  Pure: it makes no
+        EC2 calls.
+        """
+        desired = set(rule.key for rule in self.rules)
+        if ec2_group is None:
+            return SecurityGroupPlan(self, True, desired, {})
+        actual = ec2_rule_keys(ec2_group)
+        to_revoke = dict((k, v) for k, v in actual.items() if k not in desired)
+        description_mismatch = ec2_group.description if ec2_group.description != self.description else None
+        return SecurityGroupPlan(self, False, desired.difference(actual), to_revoke, description_mismatch)
 
+    def create_or_update(self, ec2_conn):
         print 'Creating or updating security group "%s"' % self.name
-        some_changes_made = False
-
-        try:
-            ec2_groups = ec2_conn.get_all_security_groups(groupnames=[self.name])
-        except boto.exception.EC2ResponseError:
-            print 'Creating security group "%s"' % self.name
-            ec2_group = ec2_conn.create_security_group(name=self.name, description=self.description)
-            some_changes_made = True
-        else:
-            assert len(ec2_groups) == 1
-            ec2_group = ec2_groups[0]
-
-        if ec2_group.description != self.description:
-            print 'Description on the EC2 group ("%s") doesn\'t match desired description ("%s")' % (ec2_group.description, self.description)
-            print "We're not able to change the description via Boto -- maybe someday?"
-
-        # Are any of the rules in this definition not present in the ec2_group?
-
-        for rule in self.rules:
-            is_present = False
-            for r in ec2_group.rules:
-                if rule.ip_protocol == r.ip_protocol \
-                and int(rule.from_port) == int(r.from_port) \
-                and int(rule.to_port) == int(r.to_port):
-                    for g in r.grants:
-                        if rule.cidr_ip is not None \
-                        and g.cidr_ip == rule.cidr_ip:
-                            is_present = True
-                            break
-                        elif rule.src_group_name is not None \
-                        and g.group_id is not None \
-                        and g.groupName == rule.src_group_name:
-                            # The groupName attribute exists if the group_id is not None
-                            is_present = True
-                            break
-
-            if not is_present:
-                print 'Adding into the EC2 security group: "%s"' % rule
-                if rule.src_group_name:
-                    src_group = fetch_ec2_security_group(ec2_conn, rule.src_group_name)
-                else:
-                    src_group = None
-                ret = ec2_group.authorize(ip_protocol=rule.ip_protocol,
-                                          from_port=rule.from_port,
-                                          to_port=rule.to_port,
-                                          cidr_ip=rule.cidr_ip,
-                                          src_group=src_group)
-                assert ret == True
-                some_changes_made = True
-
-        # Refresh the EC2 security group (seems necessary)
-        ec2_group = fetch_ec2_security_group(ec2_conn, self.name)
-
-        # Are any of the rules in the EC2 security group not present in this definition?
-
-        # In the EC2 security group, the data model is that we can have many grants under a rule
-        # So this is actually checking whether any of the EC2 "rule grants" are not present in this definition
-        for rule in ec2_group.rules:
-            for g in rule.grants:
-                is_present = False
-                for r in self.rules:
-                    if rule.ip_protocol == r.ip_protocol \
-                    and int(rule.from_port) == int(r.from_port) \
-                    and int(rule.to_port) == int(r.to_port):
-                        if g.cidr_ip is not None \
-                        and g.cidr_ip == r.cidr_ip:
-                            is_present = True
-                            break
-                        elif g.group_id is not None \
-                        and g.groupName == r.src_group_name:
-                            # The groupName attribute exists if the group_id is not None
-                            is_present = True
-                            break
-
-                if not is_present:
-                    # The rule in the EC2 security group is NOT present in self.rules -- so
-                    # delete the EC2 rule
-                    print 'Revoking from the EC2 security group: "%s"' % rule
-                    if g.group_id:
-                        src_group = fetch_ec2_security_group(ec2_conn, g.groupName)
-                    else:
-                        src_group = None
-                    ec2_group.revoke(ip_protocol=rule.ip_protocol,
-                                     from_port=rule.from_port,
-                                     to_port=rule.to_port,
-                                     cidr_ip=g.cidr_ip,
-                                     src_group=src_group)
-                    some_changes_made = True
-
-        if not some_changes_made:
-            print 'Made no changes for security group "%s"' % self.name
+        # This group and every group its rules name as a source, in one call
+        src_group_names = set(rule.src_group_name for rule in self.rules if rule.src_group_name)
+        ec2_groups_by_name = fetch_ec2_security_groups(ec2_conn, src_group_names | set([self.name]))
+        plan = self.plan(ec2_groups_by_name.get(self.name))
+        missing = plan.referenced_group_names - set(ec2_groups_by_name) - set([self.name])
+        if missing:
+            raise Exception('Security group "%s" refers to nonexistent groups: %s' %
+                            (self.name, ', '.join(sorted(missing))))
+        plan.apply(ec2_conn, ec2_groups_by_name)
+        return plan
 
     @property
     def allows_ssh(self):
@@ -172,6 +250,63 @@ class SecurityGroup(object):
         return security_group
 
 
+def security_groups_in_module(module):
+    """Returns every SecurityGroup defined at the top level of a configs module, ordered by name."""
+    groups = [v for v in vars(module).values() if isinstance(v, SecurityGroup)]
+    return sorted(groups, key=lambda g: g.name)
+
+
+def plan_security_groups(security_groups, ec2_groups_by_name):
+    """
+    Returns the SecurityGroupPlans for all of the groups, in the order given (a group that's
+    given more than once is planned once).  Pure: it makes no EC2 calls.
+    """
+    plans = []
+    planned = set()
+    for g in security_groups:
+        if g.name not in planned:
+            planned.add(g.name)
+            plans.append(g.plan(ec2_groups_by_name.get(g.name)))
+    return plans
+
+
+@tracing.traced('reconcile_security_groups')
+def reconcile_security_groups(ec2_conn, security_groups):
+    """
+    Creates or updates every one of the security groups in one pass: a single
+    get_all_security_groups call for all of them (and every group they name as a source),
+    then the creations, concurrently, then -- once every creation has finished, so that any
+    group a rule names as a source exists -- every rule change of every group, concurrently
+    (see devops.control_plane).  Returns the plans.
+    """
+    names = set(g.name for g in security_groups)
+    for g in security_groups:
+        names.update(rule.src_group_name for rule in g.rules if rule.src_group_name)
+    ec2_groups_by_name = fetch_ec2_security_groups(ec2_conn, names)
+
+    plans = plan_security_groups(security_groups, ec2_groups_by_name)
+    missing = set()
+    for plan in plans:
+        missing.update(plan.referenced_group_names - set(ec2_groups_by_name) - set(g.name for g in security_groups))
+    if missing:
+        raise Exception('Security groups refer to nonexistent groups: %s' % ', '.join(sorted(missing)))
+
+    # Creating a group doesn't involve its rules, so creations don't depend on each other.  map
+    # returns only once all of them have finished: that's the barrier the rule changes rely on.
+    control_plane.map(lambda p: p.apply_create(ec2_conn, ec2_groups_by_name), [p for p in plans if p.create])
+
+    changes = []
+    for plan in plans:
+        plan.report_description_mismatch()
+        changes.extend(plan.rule_changes(ec2_conn, ec2_groups_by_name))
+    control_plane.map(lambda change: change(), changes)
+
+    for plan in plans:
+        if not plan.has_changes:
+            print 'Made no changes for security group "%s"' % plan.security_group.name
+    return plans
+
+
 class ExternalAMI(object):
     """
     An ExternalAMI is an AMI that we DON'T define, and that
@@ -181,6 +316,28 @@ class ExternalAMI(object):
         self.ami_id = ami_id
 
 
+class RegisteredAMI(object):
+    """
+    A RegisteredAMI is one of our AMIs, looked up by name (and version) in the ops registry --
+    but not until its ami_id is needed, so that it can be used as, e.g., a parent_ami in a
+    configs module without importing that module costing an EC2 listing.
+    """
+    def __init__(self, name, version='latest'):
+        self.name = name
+        self.version = version
+
+    @property
+    def aws_ami(self):
+        return settings.ops_registry.get_ami(self.name, self.version)
+
+    @property
+    def ami_id(self):
+        aws_ami = self.aws_ami
+        if aws_ami is None:
+            raise Exception('No registered AMI named "%s" (version: %s)' % (self.name, self.version))
+        return aws_ami.id
+
+
 class AMI(object):
     def __init__(self, name, vers, env, parent_ami, config_units):
         super(AMI, self).__init__()
@@ -199,9 +356,20 @@ class AMI(object):
     def ami_id(self):
         return self.aws_ami.id if self.aws_ami else None
 
+    @tracing.traced('AMI.create')
     def create(self, ec2_conn, security_group,
                zone=settings.ALL_AVAILABILITY_ZONES[0],  # Any zone is fine
-               instance_type=settings.INSTANCE_TYPE_FOR_AMI_CREATION):
+               instance_type=settings.INSTANCE_TYPE_FOR_AMI_CREATION,
+               use_layer_cache=layers.USE_LAYER_CACHE, keep_layers=layers.DEFAULT_KEEP_LAYERS, max_parallel=1):
+        """
+        Bakes the AMI.  With use_layer_cache, the instance is snapshotted into a layer AMI
+        after each config unit, and the bake starts from the layer for the longest unchanged
+        prefix of config_units (see devops.layers), rather than from parent_ami.
+
+        With max_parallel > 1, the config units are run as a dependency graph, up to
+        max_parallel at once (see devops.scheduling).  Units then don't finish in list order,
+        so no intermediate layers are snapshotted (though a cached prefix is still used).
+        """
 
         # TODO should verify that the version is greater than the version on
         # any existing AMI for this AMI name
@@ -211,36 +379,71 @@ class AMI(object):
         assert security_group.allows_ssh, 'The security group used for AMI creation ' + \
                                           '("%s") must allow SSH access' % security_group
 
+        base_ami_id = self.parent_ami.ami_id
+        hashes = layers.layer_hashes(base_ami_id, self.config_units)
+        depth = 0
+        if use_layer_cache:
+            depth, layer_ami = layers.find_longest_cached_prefix(ec2_conn, hashes)
+            if layer_ami is not None:
+                print 'Resuming from cached layer %s (%d of %d config units already applied)' % \
+                    (layer_ami.id, depth, len(self.config_units))
+                base_ami_id = layer_ami.id
+
         print 'Creating new instance -- parent AMI ID: %s, zone: %s, instance type: %s' % \
-            (self.parent_ami.ami_id, zone, instance_type)
+            (base_ami_id, zone, instance_type)
 
-        instance = boto_adapt.new_instance(ec2_conn, self.parent_ami.ami_id, instance_type,
+        instance = boto_adapt.new_instance(ec2_conn, base_ami_id, instance_type,
             zone, user_data='', security_groups=(), ebs_optimized=False)
 
         tag_name = '%s-ami-template' % self.name
         print 'Adding tag "Name": %s' % tag_name
-        instance.add_tag('Name', tag_name)
-
-        for cu in self.config_units:
-            print 'Running config unit: %s' % cu
-            cu.run('%s@%s' % (settings.USERNAME, instance.public_dns_name))
+        # Not needed until the image is made, so the config units needn't wait for it
+        naming = control_plane.submit(instance.add_tag, 'Name', tag_name)
 
+        host_string = '%s@%s' % (settings.USERNAME, instance.public_dns_name)
+        if max_parallel > 1:
+            result = scheduling.DependencyScheduler(self.config_units[depth:], max_parallel).run(host_string)
+            result.raise_for_failures()
+        else:
+            transfers = instance_config.HostFileTransfers(host_string, self.config_units[depth:])
+            try:
+                for i, cu in enumerate(self.config_units[depth:], depth + 1):
+                    print 'Running config unit: %s' % cu
+                    with tracing.unit_span(cu, host_string, ami=self.name):
+                        if isinstance(cu, instance_config.FileTransferUnit):
+                            transfers.run(cu)
+                        else:
+                            cu.run(host_string)
+                    # The final state is captured by the AMI itself, below
+                    if use_layer_cache and hashes[i - 1] and i < len(self.config_units):
+                        layers.snapshot_layer(ec2_conn, instance, host_string, self.name, hashes[i - 1], i)
+            finally:
+                transfers.close()
+
+        naming.get()
         desc = '%s_%s' % (self.name, datetime.now().strftime('%Y%m%d'))
         print 'Creating new AMI from instance %s' % instance.id
         new_ami_id = ec2_conn.create_image(instance.id, name=desc, description=desc)
 
-        time.sleep(30)
-        print 'Terminating instance %s' % instance.id
-        instance.terminate()
+        self.aws_ami = readiness.wait_for_image_state(ec2_conn, new_ami_id, 'available')
+        terminating = control_plane.submit(boto_adapt.terminate_instances, ec2_conn, [instance.id])
 
-        self.aws_ami = ec2_conn.get_image(new_ami_id)
         tags_dict = {'Name': self.name,
                      'devops_name': self.name,
                      'devops_vers': self.vers,
                      'devops_env': self.env}
-        for k, v in tags_dict.items():
-            print 'Adding tag "%s": %s' % (k, v)
-            self.aws_ami.add_tag(k, v)
+        if hashes and hashes[-1]:
+            # So that an unchanged rebake can start from this AMI
+            tags_dict[layers.LAYER_HASH_TAG] = hashes[-1]
+        # The tagging, the termination and the layer eviction don't depend on each other
+        tagging = control_plane.submit(boto_adapt.add_tags_in_bulk, ec2_conn, {new_ami_id: tags_dict})
+        evicting = None
+        if use_layer_cache:
+            evicting = control_plane.submit(layers.evict_layers, ec2_conn, self.name, keep_layers,
+                                            protected_hashes=[h for h in hashes if h])
+        control_plane.gather([r for r in (tagging, terminating, evicting) if r])
+        self.aws_ami.tags.update(tags_dict)  # create_tags doesn't update the local object
+        settings.ops_registry.register_ami(self.aws_ami)
 
         return new_ami_id
 
@@ -280,20 +483,136 @@ class Instance(object):
         # The wrapped AWS instance
         self.aws_instance = None
 
+    @property
+    def tags_dict(self):
+        return {'Name': self.instance_name,
+                'devops_type': self.instance_type,
+                'devops_vers': self.config_vers,
+                'devops_release': self.release,
+                'devops_applic': self.application,
+                'devops_env': self.env}
+
+    @property
+    def launch_group_key(self):
+        """Instances with the same launch_group_key can be launched by one run_instances call"""
+        return (self.ami_id, self.ec2_instance_type, self.zone, tuple(self.security_groups),
+                self.ebs_optimized)
+
+    @tracing.traced('Instance.create')
     def create(self, ec2_conn, zone):
-        tags_dict = {'Name': self.instance_name,
-                     'devops_type': self.instance_type,
-                     'devops_vers': self.config_vers,
-                     'devops_release': self.release,
-                     'devops_applic': self.application,
-                     'devops_env': self.env}
-        user_data = json.dumps(tags_dict)
+        tags_dict = self.tags_dict
+        user_data = launch_user_data([self])
         print 'Creating new instance -- instance type: %s, instance name: %s, ' % (self.instance_type, self.instance_name) + \
               'ec2 instance type: %s, AMI ID: %s, zone: %s' % (self.ec2_instance_type, self.ami_id, self.zone)
-        instance = boto_adapt.new_instance(ec2_conn, self.ami_id, self.ec2_instance_type, self.zone,
-                                           user_data, self.security_groups, ebs_optimized=self.ebs_optimized)
-        for k, v in tags_dict.items():
-            print 'Adding tag "%s": %s' % (k, v)
-            instance.add_tag(k, v)
+        instance = boto_adapt.start_instances(ec2_conn, self.ami_id, self.ec2_instance_type, self.zone, user_data,
+                                              1, self.security_groups, self.ebs_optimized)[0]
+        # Tag while the instance boots, rather than after
+        tagging = control_plane.submit(boto_adapt.add_tags_in_bulk, ec2_conn, {instance.id: tags_dict},
+                                       visibility_deadline=TAG_VISIBILITY_DEADLINE)
+        usable, failures = boto_adapt.wait_for_instances(ec2_conn, [instance])
+        # A launch failure says more than the tagging error it may well have caused
+        if not usable:
+            raise Exception('Instance %s (%s) is not usable: %s' %
+                            (instance.id, self.instance_name, failures.get(instance.id, 'unknown')))
+        tagging.get()
+        instance = usable[0]
+        instance.tags.update(tags_dict)  # create_tags doesn't update the local object
+        self.aws_instance = instance
+        settings.ops_registry.register_instance(instance)
 
         # TODO take things up here -- need to emulate the current system's do_setup_instance
+
+    def terminate(self, ec2_conn):
+        boto_adapt.terminate_instances(ec2_conn, [self.aws_instance.id])
+        self.aws_instance = None
+
+
+def launch_user_data(instances):
+    """
+    The user_data for launching the Instances with one run_instances call.  For a single
+    instance, it's its tag dict, in JSON (as it's always been).  For several, the instances
+    share the one user_data, so it's a JSON list of their tag dicts, in launch order: each
+    instance finds its own entry at its ami-launch-index.
+    """
+    if len(instances) == 1:
+        return json.dumps(instances[0].tags_dict)
+    return json.dumps([inst.tags_dict for inst in instances])
+
+
+class LaunchResult(object):
+    """The outcome of launching one Instance via launch_instances()"""
+    def __init__(self, instance, aws_instance=None, error=None):
+        super(LaunchResult, self).__init__()
+        self.instance = instance
+        self.aws_instance = aws_instance
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.succeeded:
+            return '%s: %s' % (self.instance.instance_name, self.aws_instance.id)
+        return '%s: FAILED (%s)' % (self.instance.instance_name, self.error)
+
+
+@tracing.traced('launch_instances')
+def launch_instances(ec2_conn, instances):
+    """
+    Launches many Instances at once: one run_instances call per distinct (AMI, EC2 instance
+    type, zone, security groups, EBS optimized) group, all made concurrently, then a single
+    wait covering every launched instance, then tagging in bulk.  Returns a list of
+    LaunchResults, in the same order as instances.
+
+    Since the instances in a group share one user_data, for a group of several it's a JSON
+    list of the instances' tag dicts, in launch order (see launch_user_data).  If a group's
+    run_instances call fails, its instances' LaunchResults say so, and the other groups
+    carry on.
+    """
+    groups = OrderedDict()
+    for inst in instances:
+        groups.setdefault(inst.launch_group_key, []).append(inst)
+
+    results = dict((id(inst), LaunchResult(inst)) for inst in instances)
+
+    def start((key, group)):
+        ami_id, ec2_instance_type, zone, security_groups, ebs_optimized = key
+        print 'Launching %d instances -- ec2 instance type: %s, AMI ID: %s, zone: %s' % \
+            (len(group), ec2_instance_type, ami_id, zone)
+        user_data = launch_user_data(group)
+        try:
+            return boto_adapt.start_instances(ec2_conn, ami_id, ec2_instance_type, zone, user_data,
+                                              len(group), list(security_groups), ebs_optimized)
+        # Not just EC2ResponseErrors: whatever the error, the other groups have been launched
+        # concurrently, and must still be waited for, tagged and returned
+        except Exception, e:
+            for inst in group:
+                results[id(inst)].error = 'run_instances failed: %s' % e
+            return []
+
+    launched = []  # (Instance, aws instance) pairs
+    for group, aws_instances in zip(groups.values(), control_plane.map(start, groups.items())):
+        launched.extend(zip(group, aws_instances))
+
+    usable, failures = boto_adapt.wait_for_instances(ec2_conn, [aws for _, aws in launched])
+    usable_by_id = dict((i.id, i) for i in usable)
+    for inst, aws in launched:
+        if aws.id in usable_by_id:
+            results[id(inst)].aws_instance = inst.aws_instance = usable_by_id[aws.id]
+        else:
+            results[id(inst)].error = failures.get(aws.id, 'not usable')
+
+    # Tag everything that launched (even if it didn't become usable), so it can be found
+    boto_adapt.add_tags_in_bulk(ec2_conn, dict((aws.id, inst.tags_dict) for inst, aws in launched))
+    for inst, aws in launched:
+        if aws.id in usable_by_id:
+            instance = usable_by_id[aws.id]
+            instance.tags.update(inst.tags_dict)  # create_tags doesn't update the local object
+            settings.ops_registry.register_instance(instance)
+    # What we have of the rest is as of run_instances; get their actual state
+    unusable_ids = [aws.id for _, aws in launched if aws.id not in usable_by_id]
+    if unusable_ids:
+        settings.ops_registry.refresh_instances(unusable_ids)
+
+    return [results[id(inst)] for inst in instances]
@@ -1,10 +1,31 @@
 from collections import defaultdict
-import time
+import os
+import threading
 
+import boto.exception
+
+from devops import readiness
 from devops import settings
+from devops import snapshot
+from devops import tracing
+from devops.cache import CachedValue
+from devops.control_plane import control_plane
+from devops.index import InstanceIndex
 fab_api = settings.fab_api
 
+# How long (in seconds) the OpsRegistry's cached listings are used as-is, and for how much
+# longer a stale listing is still used while it's refreshed in the background
+AMI_CACHE_TTL = getattr(settings, 'OPS_REGISTRY_AMI_TTL', 600)
+INSTANCE_CACHE_TTL = getattr(settings, 'OPS_REGISTRY_INSTANCE_TTL', 60)
+CACHE_STALE_TTL = getattr(settings, 'OPS_REGISTRY_STALE_TTL', 300)
+# Where the OpsRegistry persists its snapshot ("%s" is replaced by the env); None to disable
+SNAPSHOT_PATH = getattr(settings, 'OPS_REGISTRY_SNAPSHOT_PATH', os.path.expanduser('~/.devops/registry-%s.json'))
+# A snapshot older than this (in seconds) is ignored, so that lookups (e.g., of a parent AMI)
+# aren't answered from arbitrarily old data; the first lookup then waits for EC2
+SNAPSHOT_MAX_AGE = getattr(settings, 'OPS_REGISTRY_SNAPSHOT_MAX_AGE', 3600)
+
 
+@tracing.traced('new_instance')
 def new_instance(ec2_conn, ami_id, instance_type, zone, user_data, security_groups=[], ebs_optimized=False):
     reservation = ec2_conn.run_instances(image_id=ami_id,
                                          instance_type=instance_type,
@@ -13,42 +34,13 @@ def new_instance(ec2_conn, ami_id, instance_type, zone, user_data, security_grou
                                          key_name=settings.KEYPAIR_NAME,
                                          user_data=user_data,
                                          ebs_optimized=ebs_optimized)
-    time.sleep(5)
     instance = reservation.instances[0]
-    for i in range(1, 21):
-        status = instance.update()
-        if status == 'pending':
-            print 'Instance is pending (attempt %d)...' % i
-            time.sleep(5)
-            continue
-        else:
-            break
-
-    if status != 'running':
-        raise Exception("Couldn't start instance (status: %s)" % status)
-
+    readiness.wait_for_instance_state(instance, 'running')
     print 'Instance is running'
 
-    success = False
-    for i in range(1, 21):
-        with fab_api.settings(host_string='%s@%s' % (settings.USERNAME, instance.public_dns_name)):
-            try:
-                res = fab_api.run('echo "Hello world"')
-                if res.failed:
-                    raise Exception()
-                success = True
-            except:
-                print "Couldn't run command on instance (attempt %d)..." % i
-                time.sleep(5)
-                continue
-            else:
-                break
-
-    if not success:
-        raise Exception("Couldn't run command on instance")
-
+    readiness.wait_for_ssh('%s@%s' % (settings.USERNAME, instance.public_dns_name),
+                           instance.public_dns_name)
     print 'Able to run command on instance.  Moving on...'
-    time.sleep(5)
 
     print 'Removing existing known_hosts entry for %s and %s' % \
         (instance.public_dns_name, instance.ip_address)
@@ -57,51 +49,335 @@ def new_instance(ec2_conn, ami_id, instance_type, zone, user_data, security_grou
     return instance
 
 
+def start_instances(ec2_conn, ami_id, instance_type, zone, user_data, count, security_groups=[],
+                    ebs_optimized=False):
+    """
+    Launches count identical instances with a single run_instances call, without waiting
+    for them (see wait_for_instances).  Returns the instances, ordered by launch index.
+    """
+    reservation = ec2_conn.run_instances(image_id=ami_id,
+                                         min_count=count,
+                                         max_count=count,
+                                         instance_type=instance_type,
+                                         security_groups=security_groups,
+                                         placement=zone,
+                                         key_name=settings.KEYPAIR_NAME,
+                                         user_data=user_data,
+                                         ebs_optimized=ebs_optimized)
+    return sorted(reservation.instances, key=lambda i: int(i.ami_launch_index))
+
+
+def wait_for_instances(ec2_conn, instances):
+    """
+    Waits for all of the instances together until they're running and reachable over SSH.
+    Returns (usable, failures): usable is the list of (refreshed) usable instances, in the
+    order given; failures maps instance ID -> reason for the rest.
+    """
+    ready, failures = readiness.wait_for_instances_state(ec2_conn, instances, 'running')
+    print '%d of %d instances are running' % (len(ready), len(instances))
+
+    host_strings = dict((i.id, '%s@%s' % (settings.USERNAME, i.public_dns_name)) for i in ready)
+    ssh_errors = readiness.wait_for_ssh_many([(host_strings[i.id], i.public_dns_name) for i in ready])
+    usable = []
+    for i in ready:
+        if host_strings[i.id] in ssh_errors:
+            failures[i.id] = ssh_errors[host_strings[i.id]]
+            continue
+        print 'Removing existing known_hosts entry for %s and %s' % (i.public_dns_name, i.ip_address)
+        fab_api.local('ssh-keygen -R %s -R %s' % (i.public_dns_name, i.ip_address))
+        usable.append(i)
+    return usable, failures
+
+
+def terminate_instances(ec2_conn, instance_ids):
+    """Terminates the instances, and drops them from the ops registry (without another API call)."""
+    instance_ids = list(instance_ids)
+    print 'Terminating %s' % ', '.join(instance_ids)
+    ec2_conn.terminate_instances(instance_ids)
+    for instance_id in instance_ids:
+        settings.ops_registry.unregister_instance(instance_id)
+
+
+def add_tags_in_bulk(ec2_conn, tags_by_resource_id, visibility_deadline=None):
+    """
+    Applies tags to many resources with as few create_tags calls as possible: tags that are
+    identical across a set of resources are applied to that whole set in one call, and the
+    calls are made concurrently.  tags_by_resource_id is a dict of resource ID -> dict of tags.
+
+    With visibility_deadline, resources that EC2 doesn't know about yet (e.g., instances
+    launched a moment ago) are retried for up to that many seconds.
+    """
+    ids_by_tag = defaultdict(set)
+    for resource_id, tags in tags_by_resource_id.items():
+        for k, v in tags.items():
+            ids_by_tag[(k, v)].add(resource_id)
+    tags_by_ids = defaultdict(dict)
+    for (k, v), ids in ids_by_tag.items():
+        tags_by_ids[frozenset(ids)][k] = v
+
+    def create_tags((ids, tags)):
+        print 'Adding tags %s to %s' % (tags, ', '.join(sorted(ids)))
+        if visibility_deadline is None:
+            return ec2_conn.create_tags(sorted(ids), tags)
+
+        def tagged():
+            try:
+                return ec2_conn.create_tags(sorted(ids), tags)
+            except boto.exception.EC2ResponseError, e:
+                if not readiness.is_not_found_error(e):
+                    raise
+                return False
+        return readiness.wait_until(tagged, visibility_deadline, 'tagging of %s' % ', '.join(sorted(ids)))
+    control_plane.map(create_tags, tags_by_ids.items())
+
+
 class OpsRegistry(object):
-    def __init__(self, ec2_conn, env):
+    """
+    The registry of what we've got in EC2 (AMIs and instances), for our env.  Both collections
+    are cached: within their TTL lookups are answered from memory, and for a while after that
+    the stale data is still used while it's refreshed in the background (see CachedValue).
+
+    Whenever the registry fetches from EC2 it saves a snapshot to snapshot_path, and at startup
+    it loads that snapshot (as stale data), so the first lookups are answered from disk while
+    the registry reconciles with EC2 in the background -- unless the snapshot is older than
+    snapshot_max_age.
+    """
+    def __init__(self, ec2_conn, env, ami_ttl=AMI_CACHE_TTL, instance_ttl=INSTANCE_CACHE_TTL,
+                 stale_ttl=CACHE_STALE_TTL, snapshot_path=SNAPSHOT_PATH, snapshot_max_age=SNAPSHOT_MAX_AGE):
         self.ec2_conn = ec2_conn
         self.env = env
-        self._ami_dict = None  # Lazily loaded and cached
-        self._instances = None  # Lazily loaded and cached
+        self._amis = CachedValue(self._load_amis, ami_ttl, stale_ttl, name='AMIs')
+        self._instances = CachedValue(self._load_instances, instance_ttl, stale_ttl, name='instances')
+        self.targeted_refreshes = 0
+        # Secondary indexes, rebuilt whenever the cached collection is replaced wholesale and
+        # maintained incrementally otherwise
+        self._index_lock = threading.RLock()
+        self._index = InstanceIndex()
+        self._indexed_instances = None  # The instance list that _index reflects
+        self._ami_versions = {}  # (name, devops_vers) -> AMI
+        self._indexed_ami_dict = None  # The AMI dict that _ami_versions reflects
+        self.snapshot_path = snapshot_path % env if snapshot_path and '%s' in snapshot_path else snapshot_path
+        self.snapshot_etag = None
+        # The AMIs and the instances may be loaded concurrently (see prefetch); whichever
+        # saves last must see both
+        self._snapshot_lock = threading.Lock()
+        if self.snapshot_path:
+            snap = snapshot.load_snapshot(self.snapshot_path, self.env, settings.AWS_OWNER_ID)
+            if snap and snapshot_max_age is not None and snap.age > snapshot_max_age:
+                print 'Ignoring registry snapshot %s (%ds old)' % (self.snapshot_path, snap.age)
+                snap = None
+            if snap:
+                print 'Loaded registry snapshot %s (%ds old)' % (self.snapshot_path, snap.age)
+                self.snapshot_etag = snap.etag
+                if snap.ami_dict is not None:
+                    self._amis.set_stale(snap.ami_dict)
+                if snap.instances is not None:
+                    self._instances.set_stale(snap.instances)
+
+    def save_snapshot(self):
+        if not self.snapshot_path:
+            return
+        with self._snapshot_lock:
+            try:
+                self.snapshot_etag = snapshot.save_snapshot(self.snapshot_path, self.env, settings.AWS_OWNER_ID,
+                                                            self._amis.peek(), self._instances.peek())
+            except (IOError, OSError), e:
+                # The snapshot is only an optimization
+                print 'Unable to save registry snapshot %s: %s' % (self.snapshot_path, e)
+
+    def _load_amis(self):
+        ami_dict = self._get_amis()
+        self._amis.set(ami_dict)
+        self.save_snapshot()
+        return ami_dict
+
+    def _load_instances(self):
+        instances = self._get_instances()
+        self._instances.set(instances)
+        self.save_snapshot()
+        return instances
+
+    def prefetch(self, force_refresh=False):
+        """
+        Makes sure that both the AMIs and the instances are cached, fetching whichever need it
+        concurrently -- e.g., at the start of a script that will look up both.
+        """
+        control_plane.gather([control_plane.submit(self._amis.get, force_refresh),
+                              control_plane.submit(self._instances.get, force_refresh)])
+
+    def refresh_amis(self, names):
+        """Refetches the AMIs with each of the given names, concurrently.  Returns name -> AMIs."""
+        names = list(names)
+        return dict(zip(names, control_plane.map(self.refresh_ami, names)))
+
+    def _filters(self, **extra):
+        filters = {'tag:devops_env': self.env} if self.env else {}
+        filters.update(extra)
+        return filters or None
+
+    @staticmethod
+    def _sorted_amis(amis):
+        """Sorted by (devops_vers, name) descending -- the intent being that the most current AMI is first"""
+        return sorted(amis, key=lambda x: (x.tags['devops_vers'], x.name), reverse=True)
 
     def _get_amis(self):
         """
-        Sets _ami_dict to a dict of AMIs, keyed by AMI name.  The result of each dict
+        Returns a dict of AMIs, keyed by AMI name.  The result of each dict
         entry is a LIST of AMIs that have that name (because we don't know that there's
         one and only one AMI with that name).  The list is sorted by (devops_vers, name)
         descending -- the intent being that the most current AMI is first in the list.
         """
-        if self.env:
-            filters = {'tag:devops_env': self.env}
-        else:
-            filters = None
-        amis = self.ec2_conn.get_all_images(owners=[settings.AWS_OWNER_ID], filters=filters)
+        amis = self.ec2_conn.get_all_images(owners=[settings.AWS_OWNER_ID], filters=self._filters())
         d = defaultdict(list)
         for ami in amis:
-            d[ami.tags['Name']].append(ami)
+            # Skip AMIs that aren't ours to look up by name (e.g., layer AMIs; see devops.layers)
+            if 'Name' in ami.tags and 'devops_vers' in ami.tags:
+                d[ami.tags['Name']].append(ami)
         sorted_d = {}
         for k, v in d.items():
-            sorted_d[k] = sorted(d[k], key=lambda x: (x.tags['devops_vers'], x.name),
-                                 reverse=True)
+            sorted_d[k] = self._sorted_amis(v)
         return sorted_d
 
     def _get_instances(self):
-        if self.env:
-            filters = {'tag:devops_env': self.env}
-        else:
-            filters = None
-        reservs = self.ec2_conn.get_all_instances(filters=filters)
+        reservs = self.ec2_conn.get_all_instances(filters=self._filters())
         instances = []
         for r in reservs:
             instances.extend(r.instances)
         return instances
 
+    def refresh_ami(self, name):
+        """Refetches just the AMIs with the given name, and returns them."""
+        self.targeted_refreshes += 1
+        amis = self._sorted_amis(self.ec2_conn.get_all_images(owners=[settings.AWS_OWNER_ID],
+                                                              filters=self._filters(**{'tag:Name': name})))
+
+        def patch(ami_dict):
+            d = dict(ami_dict)
+            if amis:
+                d[name] = amis
+            else:
+                d.pop(name, None)
+            self._reindex_ami_name(ami_dict, d, name)
+            return d
+        self._amis.update(patch)
+        self.save_snapshot()
+        return amis
+
+    def refresh_instances(self, instance_ids):
+        """
+        Refetches just the given instances (e.g., ones we've just created or terminated).  IDs
+        that EC2 no longer returns are dropped from the cache.  Returns the refetched instances.
+        """
+        self.targeted_refreshes += 1
+        instance_ids = list(instance_ids)
+        # A filter, since instance_ids= fails outright if any of the IDs is gone
+        reservs = self.ec2_conn.get_all_instances(filters=self._filters(**{'instance-id': instance_ids}))
+        fetched = []
+        for r in reservs:
+            fetched.extend(r.instances)
+
+        def patch(instances):
+            ids = set(instance_ids)
+            new_instances = [i for i in instances if i.id not in ids] + fetched
+            self._reindex_instances(instances, new_instances, removed_ids=ids, added=fetched)
+            return new_instances
+        self._instances.update(patch)
+        self.save_snapshot()
+        return fetched
+
+    def _reindex_instances(self, old_instances, new_instances, removed_ids=(), added=()):
+        """
+        Applies an incremental change to the instance index, if the index reflects
+        old_instances; otherwise the index is left to be rebuilt on next use.
+        """
+        with self._index_lock:
+            if self._indexed_instances is not None and self._indexed_instances is old_instances:
+                for instance_id in removed_ids:
+                    self._index.remove(instance_id)
+                for instance in added:
+                    self._index.add(instance)
+                self._indexed_instances = new_instances
+
+    def _reindex_ami_name(self, old_ami_dict, new_ami_dict, name):
+        with self._index_lock:
+            if self._indexed_ami_dict is not None and self._indexed_ami_dict is old_ami_dict:
+                for ami in old_ami_dict.get(name, []):
+                    self._ami_versions.pop((name, ami.tags['devops_vers']), None)
+                self._add_ami_versions(name, new_ami_dict.get(name, []))
+                self._indexed_ami_dict = new_ami_dict
+
+    def _add_ami_versions(self, name, amis):
+        # amis is sorted most-current first; for a duplicated version, the first one wins (as with a scan)
+        for ami in reversed(amis):
+            self._ami_versions[(name, ami.tags['devops_vers'])] = ami
+
+    def _instance_index(self, force_refresh=False):
+        instances = self._instances.get(force_refresh)
+        with self._index_lock:
+            if instances is not self._indexed_instances:
+                self._index.rebuild(instances)
+                self._indexed_instances = instances
+            return self._index
+
+    def _ami_dict(self, force_refresh=False):
+        ami_dict = self._amis.get(force_refresh)
+        with self._index_lock:
+            if ami_dict is not self._indexed_ami_dict:
+                self._ami_versions = {}
+                for name, amis in ami_dict.items():
+                    self._add_ami_versions(name, amis)
+                self._indexed_ami_dict = ami_dict
+        return ami_dict
+
+    def register_instance(self, instance):
+        """
+        Records an instance that we've just created (or re-tagged) through devops, without
+        any API call.  Its tags must already be set on the object.
+        """
+        def patch(instances):
+            new_instances = [i for i in instances if i.id != instance.id] + [instance]
+            self._reindex_instances(instances, new_instances, removed_ids=[instance.id], added=[instance])
+            return new_instances
+        self._instances.update(patch)
+
+    def unregister_instance(self, instance_id):
+        """Forgets an instance that we've just terminated through devops, without any API call."""
+        def patch(instances):
+            new_instances = [i for i in instances if i.id != instance_id]
+            self._reindex_instances(instances, new_instances, removed_ids=[instance_id])
+            return new_instances
+        self._instances.update(patch)
+
+    def register_ami(self, ami):
+        """Records an AMI that we've just created and tagged through devops, without any API call."""
+        name = ami.tags['Name']
+
+        def patch(ami_dict):
+            d = dict(ami_dict)
+            d[name] = self._sorted_amis([a for a in d.get(name, []) if a.id != ami.id] + [ami])
+            self._reindex_ami_name(ami_dict, d, name)
+            return d
+        self._amis.update(patch)
+
+    def find(self, force_refresh=False, **criteria):
+        """
+        Returns the instances matching all of the criteria, which may be any of the fields in
+        devops.index.INSTANCE_FIELDS -- e.g., find(type='caliper', release='2012-12-10-a',
+        zone='us-east-1a').
+        """
+        index = self._instance_index(force_refresh)
+        with self._index_lock:
+            return index.find(**criteria)
+
     def get_ami(self, name, version='latest', force_refresh=False):
         """version could be: 'latest', or a string that's interpreted as the version number, or a
         NEGATIVE integer that's interpreted as the number of versions BEFORE the latest version"""
-        if not self._ami_dict or force_refresh:
-            self._ami_dict = self._get_amis()
-        amis = self._ami_dict.get(name)
+        amis = self._ami_dict(force_refresh).get(name)
+        if not amis and not force_refresh:
+            # Possibly an AMI created since we last listed everything
+            amis = self.refresh_ami(name)
+        if not amis:
+            return None
         if version == 'latest':
             return amis[0]
         else:
@@ -115,18 +391,31 @@ class OpsRegistry(object):
                 return amis[min(offset, len(amis) - 1)]
             except ValueError:
                 # version isn't a negative integer, so interpret it as an actual devops_vers
-                for ami in amis:
-                    if ami.tags['devops_vers'] == version:
-                        return ami
-                return None
+                with self._index_lock:
+                    return self._ami_versions.get((name, version))
 
     def get_registered_hosts(self, force_refresh=False):
         """Returns a dict of <registered_host_alias>: <instance_id>"""
-        if not self._instances or force_refresh:
-            self._instances = self._get_instances()
-        d = {}
-        for i in self._instances:
-            host_alias = i.tags.get('registered_host_alias')
-            if host_alias:
-                d[host_alias] = i.id
-        return d
+        index = self._instance_index(force_refresh)
+        with self._index_lock:
+            # If an alias is (wrongly) on more than one instance, which one wins is arbitrary
+            return dict((alias, sorted(ids)[-1]) for alias, ids in index.values('alias').items())
+
+    def get_registered_host_addresses(self, force_refresh=False):
+        """
+        Returns a dict of <registered_host_alias>: (<private IP>, <private DNS name>), for
+        the registered hosts that have an address -- e.g., for EtcHostsConfigurer.sync
+        """
+        index = self._instance_index(force_refresh)
+        addresses = {}
+        with self._index_lock:
+            for alias, ids in index.values('alias').items():
+                instance = index.get(sorted(ids)[-1])
+                if instance.private_ip_address:
+                    addresses[alias] = (instance.private_ip_address, instance.private_dns_name)
+        return addresses
+
+    def cache_stats(self):
+        return {'amis': self._amis.stats(),
+                'instances': self._instances.stats(),
+                'targeted_refreshes': self.targeted_refreshes}
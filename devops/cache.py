@@ -0,0 +1,143 @@
+import threading
+import time
+
+
+class CachedValue(object):
+    """
+    A CachedValue holds the result of calling loader() for ttl seconds.  After that, for a
+    further stale_ttl seconds, the stale value is still handed out immediately while a
+    background thread reloads it (stale-while-revalidate); after that, get() reloads in the
+    foreground.  The value can also be patched in place with update(), for targeted refreshes
+    that don't warrant a full reload.  Patches made while a load is in flight are applied to
+    its result too, so that the load doesn't undo them.
+    """
+    def __init__(self, loader, ttl, stale_ttl=0, name=None):
+        super(CachedValue, self).__init__()
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.name = name or getattr(loader, '__name__', 'value')
+        self._value = None
+        self._loaded_at = None
+        self._refreshing = False
+        self._lock = threading.RLock()
+        # Bumped by update(); the patches made while loads are in flight, with their generations
+        self._generation = 0
+        self._loads_in_flight = 0
+        self._patches = []
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.background_refreshes = 0
+
+    @property
+    def is_loaded(self):
+        return self._loaded_at is not None
+
+    @property
+    def age(self):
+        return time.time() - self._loaded_at if self.is_loaded else None
+
+    def get(self, force_refresh=False):
+        with self._lock:
+            age = self.age
+            if force_refresh or age is None or age >= self.ttl + self.stale_ttl:
+                self.misses += 1
+                return self.refresh()
+            if age < self.ttl:
+                self.hits += 1
+                return self._value
+            self.stale_hits += 1
+            if not self._refreshing:
+                self._refreshing = True
+                t = threading.Thread(target=self._background_refresh, args=(self._start_load(),),
+                                     name='refresh-%s' % self.name)
+                t.daemon = True
+                t.start()
+            return self._value
+
+    def refresh(self):
+        """Reloads the value in the foreground and returns it."""
+        value = self._load(self._start_load())
+        with self._lock:
+            self.refreshes += 1
+        return value
+
+    def _background_refresh(self, generation):
+        try:
+            self._load(generation)
+        except Exception, e:
+            # Keep serving the stale value; the next get() past the stale window retries
+            print 'Background refresh of %s failed: %s' % (self.name, e)
+        else:
+            with self._lock:
+                self.background_refreshes += 1
+        finally:
+            self._refreshing = False
+
+    def _start_load(self):
+        """Notes that a load is starting; returns the generation to pass to _load()."""
+        with self._lock:
+            self._loads_in_flight += 1
+            return self._generation
+
+    def _load(self, generation):
+        """Calls loader() (outside the lock) and sets its result, with the patches made since generation."""
+        try:
+            value = self.loader()
+            with self._lock:
+                for patch_generation, fn in self._patches:
+                    if patch_generation > generation:
+                        value = fn(value)
+                self.set(value)
+            return value
+        finally:
+            with self._lock:
+                self._loads_in_flight -= 1
+                if not self._loads_in_flight:
+                    del self._patches[:]
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+            self._loaded_at = time.time()
+
+    def set_stale(self, value):
+        """
+        Sets a value that's already due for revalidation (e.g., one loaded from disk): the
+        next get() returns it and starts a background refresh.  (With no stale_ttl, the next
+        get() reloads in the foreground instead.)
+        """
+        with self._lock:
+            self._value = value
+            self._loaded_at = time.time() - self.ttl
+
+    def peek(self):
+        """Returns the cached value (None if nothing's loaded), without loading or counting."""
+        return self._value
+
+    def update(self, fn):
+        """
+        Replaces the cached value with fn(value), without resetting its age.  Does nothing if
+        nothing has been loaded yet (the first get() will load everything anyway).  fn is also
+        applied to the result of any load in flight, so it should be idempotent.
+        """
+        with self._lock:
+            self._generation += 1
+            if self._loads_in_flight:
+                self._patches.append((self._generation, fn))
+            if self.is_loaded:
+                self._value = fn(self._value)
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._loaded_at = None
+
+    def stats(self):
+        return {'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'background_refreshes': self.background_refreshes}
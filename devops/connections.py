@@ -0,0 +1,158 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import time
+
+from fabric.network import join_host_strings, normalize
+from fabric.state import connections as fab_connections
+
+from devops import settings
+fab_api = settings.fab_api
+
+# The most SSH connections we keep open at once; the least recently used is closed beyond this
+DEFAULT_MAX_CONNECTIONS = getattr(settings, 'SSH_POOL_MAX_CONNECTIONS', 20)
+# Connections that haven't been used for this many seconds are closed
+DEFAULT_IDLE_TIMEOUT = getattr(settings, 'SSH_POOL_IDLE_TIMEOUT', 300)
+
+
+class _PooledConnection(object):
+    def __init__(self, key_filename):
+        super(_PooledConnection, self).__init__()
+        self.key_filename = key_filename
+        self.last_used = time.time()
+
+
+class ConnectionPool(object):
+    """
+    A ConnectionPool keeps one SSH connection open per host (per user@host:port and key file)
+    so that the handshake is paid once per host per run, rather than whenever a config unit
+    happens to need the host.
+
+    Fabric already caches connections (in fabric.state.connections, keyed by user@host:port),
+    and fab_api.run/put/sudo use whatever's in that cache; the pool decides what's in it.
+    Every time a connection is handed out it's health-checked, connections that have been idle
+    longer than idle_timeout are closed, and at most max_connections are kept open (least
+    recently used is closed first).  A connection made with a different key file than the
+    current one is treated as a different connection.
+    """
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        super(ConnectionPool, self).__init__()
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        # Fabric connection key -> _PooledConnection, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.connects = 0
+        self.reuses = 0
+        self.evictions = 0
+        self.health_check_failures = 0
+
+    @staticmethod
+    def _key(host_string):
+        return join_host_strings(*normalize(host_string))
+
+    @staticmethod
+    def _key_filename():
+        key_filename = fab_api.env.key_filename
+        if isinstance(key_filename, list):
+            key_filename = tuple(key_filename)
+        return key_filename
+
+    @contextmanager
+    def session(self, host_string, **kwargs):
+        """
+        Use in place of fab_api.settings(host_string=host_string, ...): Fabric operations
+        inside the block run over the pooled connection to host_string.
+        """
+        with fab_api.settings(host_string=host_string, **kwargs):
+            self.acquire(host_string)
+            yield
+
+    def acquire(self, host_string):
+        """Ensures that Fabric's connection to host_string is open and healthy."""
+        key = self._key(host_string)
+        key_filename = self._key_filename()
+        with self._lock:
+            self._evict_idle()
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry.key_filename != key_filename:
+                self._close(key)
+                entry = None
+            if entry is not None and not self._is_healthy(key):
+                self.health_check_failures += 1
+                self._close(key)
+                entry = None
+            if entry is None and key in fab_connections:
+                if self._is_healthy(key):
+                    # Opened by Fabric outside of the pool; adopt it
+                    entry = _PooledConnection(key_filename)
+                else:
+                    # Otherwise fab_connections[key] would hand the dead client back
+                    self.health_check_failures += 1
+                    self._close(key)
+
+            if entry is None:
+                fab_connections[key]  # Fabric connects on a cache miss
+                entry = _PooledConnection(key_filename)
+                self.connects += 1
+            else:
+                self.reuses += 1
+            entry.last_used = time.time()
+            self._entries[key] = entry
+
+            while len(self._entries) > self.max_connections:
+                oldest_key = next(iter(self._entries))
+                self._close(oldest_key)
+                self.evictions += 1
+
+    def _is_healthy(self, key):
+        try:
+            transport = fab_connections[key].get_transport() if key in fab_connections else None
+            if transport is None or not transport.is_active():
+                return False
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def _evict_idle(self):
+        cutoff = time.time() - self.idle_timeout
+        for key, entry in self._entries.items():
+            if entry.last_used < cutoff:
+                self._close(key)
+                self.evictions += 1
+
+    def _close(self, key):
+        self._entries.pop(key, None)
+        client = fab_connections.pop(key, None)
+        if client is not None:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        with self._lock:
+            for key in self._entries.keys():
+                self._close(key)
+
+    def reset_after_fork(self):
+        """
+        For use in a forked child: forgets every connection inherited from the parent WITHOUT
+        closing it (the sockets still belong to the parent).
+        """
+        self._lock = threading.RLock()
+        for key in self._entries.keys():
+            fab_connections.pop(key, None)
+        self._entries.clear()
+
+    def stats(self):
+        return {'open': len(self._entries),
+                'connects': self.connects,
+                'reuses': self.reuses,
+                'evictions': self.evictions,
+                'health_check_failures': self.health_check_failures}
+
+
+# The pool shared by all of the config units
+connection_pool = ConnectionPool()
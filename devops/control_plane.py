@@ -0,0 +1,116 @@
+"""
+Concurrent EC2 API requests.  boto's calls block, so independent requests -- creating
+several security groups, the run_instances calls for several launch groups, tagging an AMI
+while its template instance terminates -- used to be made one after another.  The
+ControlPlane issues them from a pool of threads instead, at most concurrency at once, and
+hands back multiprocessing AsyncResults (get() waits for, and returns or raises, the result).
+
+The public functions that use it (reconcile_security_groups, launch_instances, AMI.create,
+Instance.create, OpsRegistry.prefetch, ...) still block until everything they started has
+finished, so callers such as scripts don't change.
+
+Requests submitted from one of the control plane's own threads are run right away, in that
+thread, so that nested use can't deadlock the pool.
+"""
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+
+from devops import settings
+
+# The most EC2 API requests we have in flight at once
+DEFAULT_CONCURRENCY = getattr(settings, 'EC2_CONCURRENCY', 8)
+
+
+class _DoneResult(object):
+    """An AsyncResult-alike for a call that has already been made"""
+    def __init__(self, value=None, exc_info=None):
+        super(_DoneResult, self).__init__()
+        self._value = value
+        self._exc_info = exc_info
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self._exc_info is None
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+class ControlPlane(object):
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        super(ControlPlane, self).__init__()
+        self.concurrency = concurrency
+        self._pool = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.calls = 0
+
+    def _thread_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Made on first use, so that importing devops starts no threads
+                self._pool = ThreadPool(self.concurrency)
+            return self._pool
+
+    def _call(self, fn, args, kwargs):
+        self._local.in_pool = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._local.in_pool = False
+
+    def submit(self, fn, *args, **kwargs):
+        """Starts fn(*args, **kwargs) and returns its AsyncResult."""
+        self.calls += 1
+        if getattr(self._local, 'in_pool', False):
+            try:
+                return _DoneResult(fn(*args, **kwargs))
+            except Exception:
+                return _DoneResult(exc_info=sys.exc_info())
+        return self._thread_pool().apply_async(self._call, (fn, args, kwargs))
+
+    def gather(self, results):
+        """
+        Waits for all of the AsyncResults and returns their values, in order.  If any call
+        raised, raises the first such exception -- but only once every call has finished.
+        """
+        for r in results:
+            # In slices, since an untimed wait can't be interrupted (by Ctrl-C, say)
+            while not r.ready():
+                r.wait(1)
+        return [r.get() for r in results]
+
+    def map(self, fn, items):
+        """Calls fn on each of the items, concurrently; returns the results, in order (see gather)."""
+        return self.gather([self.submit(fn, item) for item in items])
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+    def reset_after_fork(self):
+        """For use in a forked child: the parent's pool threads don't exist there."""
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# The process's control plane
+control_plane = ControlPlane()
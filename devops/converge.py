@@ -0,0 +1,66 @@
+"""
+Skip-if-unchanged execution of config units.  When a config unit has been applied to a host,
+a marker named by its fingerprint (see ConfigUnit.fingerprint) is left on the host; a later run
+checks for all of the markers in one command and runs only the config units that are new or
+have changed.  Converging an already-configured host then costs a single round-trip.
+
+Only deterministic config units (see ConfigUnit.deterministic) are ever skipped.
+"""
+import os
+import pipes
+
+from devops import settings
+from devops.connections import connection_pool
+fab_api = settings.fab_api
+
+# Where the markers are kept on each host
+MARKER_DIR = getattr(settings, 'CONFIG_UNIT_MARKER_DIR', '/var/lib/devops/units')
+
+
+def skippable(config_unit):
+    return config_unit.deterministic
+
+
+def applied_cmd(fingerprints):
+    """Returns a command that lists those of the fingerprints whose markers exist, one per line."""
+    # ls lists the markers that exist (complaining on stderr about the rest)
+    return 'cd %s 2>/dev/null && ls -1 -- %s 2>/dev/null; true' % (MARKER_DIR, ' '.join(sorted(fingerprints)))
+
+
+def record_cmd(fingerprints):
+    """Returns a command that leaves markers for the fingerprints."""
+    return 'sudo mkdir -p %s && sudo touch %s' % (
+        MARKER_DIR, ' '.join(pipes.quote(os.path.join(MARKER_DIR, f)) for f in fingerprints))
+
+
+def applied_fingerprints(host_string, config_units):
+    """Returns the fingerprints of those of the config units already applied to the host, in one command."""
+    fingerprints = set(cu.fingerprint() for cu in config_units if skippable(cu))
+    if not fingerprints:
+        return set()
+    cmd = applied_cmd(fingerprints)
+    with connection_pool.session(host_string, warn_only=True):
+        ret = fab_api.run(cmd)
+    return set(line.strip() for line in ret.splitlines()) & fingerprints
+
+
+def record_applied(host_string, config_units):
+    """Leaves markers on the host for the config units, in one command."""
+    fingerprints = [cu.fingerprint() for cu in config_units if skippable(cu)]
+    if not fingerprints:
+        return
+    cmd = record_cmd(fingerprints)
+    with connection_pool.session(host_string):
+        ret = fab_api.run(cmd)
+        if ret.failed:
+            raise Exception('Fabric run failed: %s' % cmd)
+
+
+def forget_applied(host_string, config_units=None):
+    """Removes the markers for the config units (all markers, if None), so they'll run again."""
+    if config_units is None:
+        cmd = 'sudo rm -rf %s' % MARKER_DIR
+    else:
+        cmd = 'sudo rm -f %s' % ' '.join(os.path.join(MARKER_DIR, cu.fingerprint()) for cu in config_units)
+    with connection_pool.session(host_string):
+        fab_api.run(cmd)
@@ -1,12 +1,19 @@
 from datetime import datetime
 import os
-import StringIO
+import re
 
+from devops import artifacts
+from devops import output
+from devops import releases
 from devops import settings
+from devops.connections import connection_pool
 from devops.instance_config import ConfigUnit
 
 fab_api = settings.fab_api
 
+# Incremental deployments keep their working copies in this directory of the target_containing_folder
+CACHE_DIRNAME = '.devops-cache'
+
 
 class CodeDeployment(ConfigUnit):
     """
@@ -21,39 +28,99 @@ class CodeDeployment(ConfigUnit):
     # TODO may want to store an attribute that represents the "release" of this code deployment --
     # e.g., 2012-12-08, or 1.0.124b, etc.
     def __init__(self, desc, repo, dirname, repo_containing_folder, target_containing_folder,
-                 activate_immediately=False):
+                 activate_immediately=False, revision=None, incremental=False,
+                 keep_releases=releases.DEFAULT_KEEP_RELEASES):
+        """
+        If incremental, rather than a full export for every release, a working copy is kept on
+        the host (under CACHE_DIRNAME in the target_containing_folder) and updated to the
+        revision being deployed, and the new release directory is made from it with rsync,
+        hardlinking every file that's unchanged from the active release.  So only what's
+        changed costs any transfer, I/O or disk.
+
+        Activating a release deletes all but the keep_releases most recent ones, other than the
+        one a rollback would go back to (see devops.releases).
+        """
         super(CodeDeployment, self).__init__(desc)
         self.repo = repo
         self.dirname = dirname
         self.repo_containing_folder = repo_containing_folder
         self.target_containing_folder = target_containing_folder
         self.activate_immediately = activate_immediately
+        # The repository revision to deploy; None for the head
+        self.revision = revision
+        self.incremental = incremental
+        self.keep_releases = keep_releases
+        # Set by use_artifact
+        self.artifact = None
+        self.artifact_base_url = None
         self.timestamp_suffix = None  # Set when we "run" (create the code directory)
+        # If set, used as the timestamp_suffix instead of the time of the run (see releases.staged_deploy)
+        self.fixed_timestamp_suffix = None
+        self.last_deploy_stats = None  # Set when we "run" incrementally
+
+    @property
+    def deterministic(self):
+        # Deploying the head gives different results as the repository changes
+        return self.revision is not None or self.artifact is not None
 
-    def activate(self, host_string):
+    def fingerprint_parts(self):
+        parts = super(CodeDeployment, self).fingerprint_parts() + \
+            [self.repo.root_url, self.repo_containing_folder, self.dirname,
+             self.target_containing_folder, str(self.activate_immediately), str(self.revision)]
+        if self.artifact:
+            parts.append(self.artifact.sha256)
+        return parts
+
+    def use_artifact(self, artifact, base_url=None):
+        """
+        Deploys the (already built) artifact rather than having each host export from the
+        repository: it's pushed to each host, or pulled by each host from base_url if given.
+        See devops.artifacts.
+        """
+        self.artifact = artifact
+        self.artifact_base_url = base_url
+
+    def activate(self, host_string, gc=True):
+        """Activates the release; with gc, old releases are then garbage-collected (see devops.releases)."""
         if not self.timestamp_suffix:
             raise Exception("Can't activate since there's no timestamp_suffix (run() hasn't been run?)")
-        out = StringIO.StringIO()
-        with fab_api.settings(host_string=host_string):
-            cmd = 'cd {} && '.format(self.target_containing_folder) + \
-                  'rm -f {} && '.format(self.dirname) + \
-                  'ln -s {dirname}_{timestamp} {dirname}'.format(dirname=self.dirname,
-                                                                 timestamp=self.timestamp_suffix)
-            ret = fab_api.run(cmd, stdout=out)
-            if ret.failed:
-                raise Exception('Fabric run failed: %s' % cmd)
+        with output.HostOutput(host_string, 'Activate %s' % self.desc) as out:
+            with connection_pool.session(host_string):
+                cmd = releases.activate_cmd(self.target_containing_folder, self.dirname, self.release_name,
+                                            self.keep_releases, gc)
+                ret = fab_api.run(cmd, stdout=out)
+                if ret.failed:
+                    raise Exception('Fabric run failed: %s%s' % (cmd, out.error_context()))
 
         return out
 
+    @property
+    def release_name(self):
+        return '%s_%s' % (self.dirname, self.timestamp_suffix)
+
     def run(self, host_string):
-        self.timestamp_suffix = datetime.now().strftime('%Y%m%d_%H%M%S%f')
+        self.timestamp_suffix = self.fixed_timestamp_suffix or datetime.now().strftime('%Y%m%d_%H%M%S%f')
         source_path = os.path.join(self.repo_containing_folder, self.dirname)
-        dest_path = os.path.join(self.target_containing_folder,
-                                 '%s_%s' % (self.dirname, self.timestamp_suffix))
-        out1 = StringIO.StringIO()
-        with fab_api.settings(host_string=host_string):
-            cmd = self.repo.export_cmd(source_path, dest_path)
-            ret = fab_api.run(cmd, stdout=out1)
+        dest_path = os.path.join(self.target_containing_folder, self.release_name)
+        # Only the last lines of the (possibly huge) export output are kept; see devops.output
+        out1 = output.HostOutput(host_string, self.desc)
+        with out1, connection_pool.session(host_string):
+            if self.artifact:
+                out1.write(artifacts.install(host_string, self.artifact, dest_path, self.artifact_base_url))
+            else:
+                if self.incremental:
+                    cmd = self.incremental_cmd(source_path, dest_path)
+                else:
+                    cmd = self.repo.export_cmd(source_path, dest_path, self.revision)
+                ret = fab_api.run(cmd, stdout=out1)
+                if ret.failed:
+                    raise Exception('Fabric run failed: %s%s' % (cmd, out1.error_context()))
+                if self.incremental:
+                    self.last_deploy_stats = DeployStats.parse(ret)
+                    output.echo(host_string, '%s: %s' % (self.desc, self.last_deploy_stats))
+
+            cmd = releases.record_cmd(self.target_containing_folder, self.dirname, self.release_name)
+            ret = fab_api.run(cmd)
             if ret.failed:
                 raise Exception('Fabric run failed: %s' % cmd)
 
@@ -64,6 +131,54 @@ class CodeDeployment(ConfigUnit):
 
         return out1.getvalue() + (('\n' + out2.getvalue()) if out2 and out2.getvalue() else '')
 
+    @property
+    def cache_path(self):
+        return os.path.join(self.target_containing_folder, CACHE_DIRNAME, self.dirname)
+
+    def incremental_cmd(self, source_path, dest_path):
+        """
+        Returns the command that brings the cached working copy to self.revision and
+        materializes it as dest_path, hardlinking the files unchanged from the active release.
+        """
+        active_path = os.path.join(self.target_containing_folder, self.dirname)
+        return ' && '.join([
+            'mkdir -p %s' % os.path.dirname(self.cache_path),
+            'if [ -d %s/.svn ]; then %s; else %s; fi' % (
+                self.cache_path,
+                self.repo.update_cmd(self.cache_path, self.revision),
+                self.repo.checkout_cmd(source_path, self.cache_path, self.revision)),
+            'LINK_DEST=""',
+            'if [ -d %s ]; then LINK_DEST="--link-dest=$(readlink -f %s)"; fi' % (active_path, active_path),
+            'rsync -a --delete --exclude=.svn --stats $LINK_DEST %s/ %s/' % (self.cache_path, dest_path)])
+
+
+class DeployStats(object):
+    """What an incremental deployment changed, parsed from the svn and rsync output"""
+    # Lines that svn checkout/update print for a changed path (e.g., "U    foo/bar.py")
+    SVN_CHANGE_RE = re.compile(r'^\s*[AUDGCER][ ADUCGER]?\s+\S')
+    RSYNC_FILES_RE = re.compile(r'Number of (?:regular )?files transferred: ([\d,]+)')
+    RSYNC_BYTES_RE = re.compile(r'Total transferred file size: ([\d,]+) bytes')
+
+    def __init__(self, files_changed, files_transferred, bytes_transferred):
+        super(DeployStats, self).__init__()
+        # Paths changed in the working copy
+        self.files_changed = files_changed
+        # Files written into the new release directory (the rest are hardlinks)
+        self.files_transferred = files_transferred
+        self.bytes_transferred = bytes_transferred
+
+    def __str__(self):
+        return '%d files changed in the repository, %d files (%d bytes) written to the release' % \
+            (self.files_changed, self.files_transferred, self.bytes_transferred)
+
+    @classmethod
+    def parse(cls, output):
+        def number(regex):
+            m = regex.search(output)
+            return int(m.group(1).replace(',', '')) if m else 0
+        files_changed = len([line for line in output.splitlines() if cls.SVN_CHANGE_RE.match(line)])
+        return cls(files_changed, number(cls.RSYNC_FILES_RE), number(cls.RSYNC_BYTES_RE))
+
 
 class SvnCodeRepository(object):
     def __init__(self, root_url, ssh_key_placement):
@@ -71,9 +186,29 @@ class SvnCodeRepository(object):
         self.root_url = root_url
         self.ssh_key_placement = ssh_key_placement
 
-    def export_cmd(self, source_folder, dest_folder):
-        """Returns a command (typically to be run on a remote instance) to export from
-        the repository."""
-        return 'LC_ALL=C SVN_SSH="ssh -i %s/%s -o StrictHostKeyChecking=no" ' % \
-                    (self.ssh_key_placement.remote_dirname, self.ssh_key_placement.ssh_key.filename) + \
-               'svn export %s/%s %s' % (self.root_url, source_folder, dest_folder)
+    def _svn(self, args, local=False):
+        # Run locally, svn uses the local copy of the key rather than the placed one
+        if local:
+            key_path = self.ssh_key_placement.ssh_key.local_path
+        else:
+            key_path = os.path.join(self.ssh_key_placement.remote_dir, self.ssh_key_placement.ssh_key.filename)
+        return 'LC_ALL=C SVN_SSH="ssh -i %s -o StrictHostKeyChecking=no" svn %s' % (key_path, args)
+
+    @staticmethod
+    def _revision_arg(revision):
+        return '-r %s ' % revision if revision else ''
+
+    def export_cmd(self, source_folder, dest_folder, revision=None, local=False):
+        """Returns a command (typically to be run on a remote instance, unless local) to export
+        from the repository."""
+        return self._svn('export %s%s/%s %s' % (self._revision_arg(revision),
+                                                self.root_url, source_folder, dest_folder), local=local)
+
+    def checkout_cmd(self, source_folder, dest_folder, revision=None):
+        """Returns a command to check out a working copy from the repository."""
+        return self._svn('checkout -q %s%s/%s %s' % (self._revision_arg(revision),
+                                                     self.root_url, source_folder, dest_folder))
+
+    def update_cmd(self, working_copy, revision=None):
+        """Returns a command to bring a working copy to the revision (the head, if None)."""
+        return self._svn('update --non-interactive %s%s' % (self._revision_arg(revision), working_copy))
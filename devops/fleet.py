@@ -0,0 +1,237 @@
+from collections import OrderedDict
+import multiprocessing
+import time
+import traceback
+
+from devops import converge
+from devops import output
+from devops import settings
+from devops import tracing
+from devops.connections import connection_pool
+from devops.control_plane import control_plane
+from devops.gateway import ec2_gateway
+from devops.instance_config import FileTransferUnit, HostFileTransfers
+fab_api = settings.fab_api
+
+# Default upper bound on the number of hosts we work on at the same time
+DEFAULT_POOL_SIZE = 10
+
+
+class HostResult(object):
+    """
+    The outcome of running a sequence of config units on one host.  outputs is a list
+    of (config unit description, output) pairs, one for each config unit that ran
+    successfully, in the order in which they ran.
+    """
+    def __init__(self, host_string, outputs, failed_unit=None, error=None, elapsed=None):
+        super(HostResult, self).__init__()
+        self.host_string = host_string
+        self.outputs = outputs
+        self.failed_unit = failed_unit
+        self.error = error
+        self.elapsed = elapsed
+        # Tracing spans recorded in a worker process, on their way back to the parent
+        self.spans = []
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.succeeded:
+            return '%s: OK (%d config units, %.1fs)' % (self.host_string, len(self.outputs), self.elapsed)
+        return '%s: FAILED on "%s"' % (self.host_string, self.failed_unit)
+
+
+class FleetResult(object):
+    """The HostResults of a fleet run, keyed by host string (in the order the hosts were given)."""
+    def __init__(self, host_strings):
+        super(FleetResult, self).__init__()
+        self.host_results = OrderedDict((h, None) for h in host_strings)
+
+    @property
+    def succeeded_hosts(self):
+        return [h for h, r in self.host_results.items() if r is not None and r.succeeded]
+
+    @property
+    def failed_hosts(self):
+        return [h for h, r in self.host_results.items() if r is not None and not r.succeeded]
+
+    @property
+    def skipped_hosts(self):
+        """Hosts that were never run (or whose run was cut short) because of fail-fast"""
+        return [h for h, r in self.host_results.items() if r is None]
+
+    @property
+    def succeeded(self):
+        return not self.failed_hosts and not self.skipped_hosts
+
+    def raise_for_failures(self):
+        if not self.succeeded:
+            raise Exception('Fleet run failed -- failed hosts: %s, skipped hosts: %s' %
+                            (self.failed_hosts, self.skipped_hosts))
+
+
+def run_config_units(config_units, host_string, skip_applied=False):
+    """
+    Runs the config units, in order, on a single host.  Never raises; failures are
+    reported in the returned HostResult.  With skip_applied, config units that have
+    already been applied to the host are skipped (see devops.converge).  The
+    FileTransferUnits' files are checked and sent in one go (see HostFileTransfers).
+    """
+    start = time.time()
+    outputs = []
+    applied = set()
+    newly_applied = []
+    failed_unit = error = None
+    step = 'checking applied config units'
+    try:
+        if skip_applied:
+            applied = converge.applied_fingerprints(host_string, config_units)
+        to_run = []
+        for cu in config_units:
+            if skip_applied and converge.skippable(cu) and cu.fingerprint() in applied:
+                output.echo(host_string, 'Already applied; skipping config unit: %s' % cu)
+            else:
+                to_run.append(cu)
+        transfers = HostFileTransfers(host_string, to_run)
+        try:
+            for cu in to_run:
+                step = str(cu)
+                output.echo(host_string, 'Running config unit: %s' % cu)
+                with tracing.unit_span(cu, host_string):
+                    if isinstance(cu, FileTransferUnit):
+                        unit_output = transfers.run(cu)
+                    else:
+                        unit_output = cu.run(host_string)
+                outputs.append((str(cu), unit_output))
+                newly_applied.append(cu)
+        finally:
+            transfers.close()
+    # Fabric aborts (e.g., on a failed command) by raising SystemExit
+    except (Exception, SystemExit):
+        failed_unit, error = step, traceback.format_exc()
+
+    if skip_applied and newly_applied:
+        try:
+            converge.record_applied(host_string, newly_applied)
+        except (Exception, SystemExit):
+            if error is None:
+                failed_unit, error = 'recording applied config units', traceback.format_exc()
+    return HostResult(host_string, outputs, failed_unit=failed_unit, error=error,
+                      elapsed=time.time() - start)
+
+
+def init_worker_process(processes=1):
+    """
+    Initializer for multiprocessing pools that run Fabric operations.  Fabric's env and
+    connection cache are process-global, and a forked worker inherits the parent's open
+    connections; drop them (without closing the parent's sockets), as Fabric's own
+    parallel mode does.  processes is the pool's size: each worker gets that share of the
+    EC2 rate limit, so that the pool as a whole keeps to it (see ApiGateway.reset_after_fork).
+    """
+    from fabric.state import connections
+    connection_pool.reset_after_fork()
+    connections.clear()
+    tracing.tracer.reset_after_fork()
+    control_plane.reset_after_fork()
+    ec2_gateway.reset_after_fork(1.0 / processes)
+
+
+def _run_host_task(args):
+    # Module-level (and taking a single argument) so that multiprocessing can pickle it
+    config_units, host_string, skip_applied = args
+    result = run_config_units(config_units, host_string, skip_applied)
+    result.spans = tracing.tracer.drain()
+    return result
+
+
+def _batches(host_strings, batch_size):
+    """
+    Splits host_strings into rolling batches.  batch_size may be None (everything in one
+    batch), a number of hosts, or a percentage string such as '25%'.
+    """
+    if not batch_size:
+        return [host_strings] if host_strings else []
+    if isinstance(batch_size, basestring) and batch_size.endswith('%'):
+        pct = float(batch_size[:-1])
+        if not 0 < pct <= 100:
+            raise ValueError('Invalid batch size: %s' % batch_size)
+        size = max(1, int(round(len(host_strings) * pct / 100.0)))
+    else:
+        size = int(batch_size)
+        if size < 1:
+            raise ValueError('Invalid batch size: %s' % batch_size)
+    return [host_strings[i:i + size] for i in range(0, len(host_strings), size)]
+
+
+class FleetExecutor(object):
+    """
+    A FleetExecutor runs a list of config units across many hosts.  On each host the config
+    units run in order; different hosts are worked on concurrently, at most pool_size at a
+    time.  Because Fabric's env is process-global, each host is worked on in its own process
+    (as with Fabric's @parallel) rather than in a thread.
+
+    If batch_size is given (a number of hosts, or a percentage like '25%'), the fleet is
+    rolled in batches: a batch must finish before the next one starts.  With fail_fast, the
+    first failure stops the run -- in-flight hosts are aborted and later batches are never
+    started; otherwise every host is run and the failures are reported in the FleetResult.
+
+    With skip_applied, each host only runs the config units it hasn't already had applied
+    (see devops.converge).
+    """
+    def __init__(self, config_units, pool_size=DEFAULT_POOL_SIZE, batch_size=None, fail_fast=True,
+                 skip_applied=False):
+        super(FleetExecutor, self).__init__()
+        self.config_units = config_units
+        self.skip_applied = skip_applied
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.fail_fast = fail_fast
+
+    def run(self, host_strings):
+        result = FleetResult(host_strings)
+        for i, batch in enumerate(_batches(list(host_strings), self.batch_size)):
+            print 'Running %d config units on batch %d (%d hosts)' % (len(self.config_units), i + 1, len(batch))
+            failed = self._run_batch(batch, result)
+            if failed and self.fail_fast:
+                print 'Stopping fleet run after failure (fail-fast)'
+                break
+        for host_string in result.failed_hosts:
+            print str(result.host_results[host_string])
+        return result
+
+    def _run_batch(self, batch, result):
+        """Runs one batch, recording into result.  Returns True if any host failed."""
+        any_failed = False
+        if self.pool_size == 1 or len(batch) == 1:
+            for host_string in batch:
+                host_result = run_config_units(self.config_units, host_string, self.skip_applied)
+                result.host_results[host_string] = host_result
+                if not host_result.succeeded:
+                    any_failed = True
+                    if self.fail_fast:
+                        break
+            return any_failed
+
+        processes = min(self.pool_size, len(batch))
+        pool = multiprocessing.Pool(processes, initializer=init_worker_process, initargs=(processes,))
+        try:
+            tasks = [(self.config_units, h, self.skip_applied) for h in batch]
+            for host_result in pool.imap_unordered(_run_host_task, tasks):
+                tracing.tracer.merge(host_result.spans)
+                host_result.spans = []
+                result.host_results[host_result.host_string] = host_result
+                if not host_result.succeeded:
+                    any_failed = True
+                    if self.fail_fast:
+                        pool.terminate()
+                        break
+            else:
+                pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return any_failed
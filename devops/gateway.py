@@ -0,0 +1,271 @@
+"""
+A gateway in front of ec2_conn that every EC2 API call in the process goes through (devops
+installs it on settings.ec2_conn; see devops/__init__.py).  It:
+
+* coalesces identical read-only calls that are in flight at the same time (single-flight):
+  the first caller makes the request, and the others wait for -- and get -- its result
+  (the same objects), rather than each making its own full listing;
+* rate-limits requests with a token bucket (rate requests per second, bursts of up to burst);
+* when EC2 answers with a throttling error, retries the call with exponential backoff and
+  jitter, halves the bucket's rate (at most once a second, and not below min_rate) and
+  empties it; each successful request then raises the rate by RATE_RECOVERY_STEP, back up
+  to the configured rate.
+
+stats() has its counters: calls, requests actually made, coalesced calls, throttled
+requests, retries, and calls that had to wait for a token.
+
+Throttled requests aren't carried out by EC2, so retrying mutating calls is safe.
+
+The gateway is per process.  The worker processes of devops' own pools (FleetExecutor,
+DependencyScheduler, staged activation) each get an equal share of the rate limit when they
+start (see fleet.init_worker_process), so together they stay within it.
+"""
+import functools
+import random
+import sys
+import threading
+import time
+
+from devops import settings
+
+# Requests per second (sustained), and how many may be made in a burst.  EC2 throttles per
+# account, so these are best set below what the account is allowed.
+DEFAULT_RATE = getattr(settings, 'EC2_RATE_LIMIT', 20.0)
+DEFAULT_BURST = getattr(settings, 'EC2_RATE_BURST', 50)
+# The rate is never cut below this
+DEFAULT_MIN_RATE = getattr(settings, 'EC2_MIN_RATE_LIMIT', 1.0)
+# How many times a throttled call is retried before the error is raised
+DEFAULT_MAX_RETRIES = getattr(settings, 'EC2_THROTTLE_RETRIES', 6)
+# How much (in requests per second) each successful request raises a cut rate
+RATE_RECOVERY_STEP = 0.1
+
+# The error codes with which EC2 (and other AWS APIs) signal throttling
+THROTTLING_ERROR_CODES = frozenset(['RequestLimitExceeded', 'Throttling', 'ThrottlingException'])
+
+# boto EC2Connection methods whose identical concurrent calls are coalesced
+READ_METHODS = ['get_all_images', 'get_image', 'get_all_instances', 'get_only_instances',
+                'get_all_reservations', 'get_all_instance_status', 'get_all_security_groups',
+                'get_all_tags', 'get_all_snapshots', 'get_all_volumes', 'get_all_zones']
+# ... and those that are only rate-limited and retried
+WRITE_METHODS = ['run_instances', 'terminate_instances', 'stop_instances', 'start_instances',
+                 'create_image', 'deregister_image', 'create_tags', 'delete_tags',
+                 'create_security_group', 'delete_security_group', 'authorize_security_group',
+                 'revoke_security_group', 'modify_instance_attribute', 'create_snapshot', 'delete_snapshot']
+
+
+def is_throttling_error(e):
+    return getattr(e, 'error_code', None) in THROTTLING_ERROR_CODES
+
+
+def _freeze(value):
+    """A hashable equivalent of value (dicts and sequences made into tuples); TypeError if there isn't one"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(v) for v in value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    hash(value)
+    return value
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, first waiting for one if need be.  Returns how long it waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def drain(self):
+        """Throws away the saved-up tokens, so that the next requests go at the (current) rate."""
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = time.time()
+
+
+class _Flight(object):
+    """A call in progress, which identical calls wait for"""
+    def __init__(self):
+        super(_Flight, self).__init__()
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class ApiGateway(object):
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, min_rate=DEFAULT_MIN_RATE,
+                 max_retries=DEFAULT_MAX_RETRIES, initial_backoff=0.5, max_backoff=20.0):
+        super(ApiGateway, self).__init__()
+        self.max_rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.bucket = TokenBucket(rate, burst)
+        self._last_rate_cut = 0
+        self._flights = {}  # Call key -> _Flight
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset_counts()
+
+    def reset_counts(self):
+        with self._lock:
+            self.calls = 0
+            self.requests = 0
+            self.coalesced = 0
+            self.throttled = 0
+            self.retried = 0
+            self.rate_limited = 0
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls,
+                    'requests': self.requests,
+                    'coalesced': self.coalesced,
+                    'throttled': self.throttled,
+                    'retried': self.retried,
+                    'rate_limited': self.rate_limited,
+                    'rate': round(self.bucket.rate, 2)}
+
+    def _request(self, fn, args, kwargs):
+        """Makes the call: a token per attempt, retrying (and slowing down) while it's throttled."""
+        backoff = self.initial_backoff
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            with self._lock:
+                self.requests += 1
+                if waited:
+                    self.rate_limited += 1
+            self._local.in_request = True
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, e:
+                if not is_throttling_error(e):
+                    raise
+                with self._lock:
+                    self.throttled += 1
+                    # Concurrent requests tend to be throttled together; that's one signal
+                    if time.time() - self._last_rate_cut >= 1:
+                        self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+                        self.bucket.drain()
+                        self._last_rate_cut = time.time()
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+                delay = min(backoff, self.max_backoff) * random.uniform(0.5, 1.5)
+                print 'EC2 throttled %s; retrying in %.1fs (attempt %d)' % (
+                    getattr(fn, '__name__', 'call'), delay, attempt)
+                time.sleep(delay)
+                backoff *= 2
+                continue
+            finally:
+                self._local.in_request = False
+            with self._lock:
+                # Additive increase, back towards the configured rate
+                self.bucket.rate = min(self.max_rate, self.bucket.rate + RATE_RECOVERY_STEP)
+            return result
+
+    def call(self, fn, args=(), kwargs=None, key=None):
+        """
+        Calls fn(*args, **kwargs) through the gateway.  Calls with the same key (other than
+        None) that overlap in time are coalesced into one.
+        """
+        kwargs = kwargs or {}
+        if getattr(self._local, 'in_request', False):
+            # A method calling another (e.g., boto's get_all_instances calls get_all_reservations):
+            # that's still the one request
+            return fn(*args, **kwargs)
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key) if key is not None else None
+            if flight is not None:
+                self.coalesced += 1
+            elif key is not None:
+                self._flights[key] = leader = _Flight()
+        if flight is not None:
+            # In slices, since an untimed wait can't be interrupted (by Ctrl-C, say)
+            while not flight.done.wait(1.0):
+                pass
+            if flight.exc_info:
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+            return flight.result
+        if key is None:
+            return self._request(fn, args, kwargs)
+
+        try:
+            leader.result = self._request(fn, args, kwargs)
+            return leader.result
+        except Exception:
+            leader.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            leader.done.set()
+
+    def _wrap(self, ec2_conn, name, coalesce):
+        fn = getattr(ec2_conn, name)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            key = None
+            if coalesce:
+                try:
+                    key = (id(ec2_conn), name, _freeze(args), _freeze(kwargs))
+                except TypeError:
+                    # Arguments we can't compare; just don't coalesce
+                    pass
+            return self.call(fn, args, kwargs, key)
+        wrapper.devops_gateway = self
+        return wrapper
+
+    def install(self, ec2_conn):
+        """
+        Puts the gateway in front of ec2_conn's API methods (those of them it has), including
+        for the instance and image objects it hands out.  Returns ec2_conn.
+        """
+        for names, coalesce in ((READ_METHODS, True), (WRITE_METHODS, False)):
+            for name in names:
+                fn = getattr(ec2_conn, name, None)
+                if callable(fn) and not getattr(fn, 'devops_gateway', None):
+                    setattr(ec2_conn, name, self._wrap(ec2_conn, name, coalesce))
+        return ec2_conn
+
+    def reset_after_fork(self, share=1.0):
+        """
+        For use in a forked child: the parent's in-flight calls (and locks) aren't ours.
+        The child's gateway keeps share of the parent's rates and burst, since the processes
+        of a pool each have their own bucket: with N workers that each take 1/N, the pool as a
+        whole stays within the limit.  (A throttle seen by one of them still slows only that
+        one down, though.)
+        """
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._flights = {}
+        self.max_rate *= share
+        self.min_rate *= share
+        self.bucket = TokenBucket(self.bucket.rate * share, max(1, int(self.bucket.burst * share)))
+
+
+# The process's gateway
+ec2_gateway = ApiGateway()
@@ -0,0 +1,88 @@
+from collections import defaultdict
+
+
+def _tag(name):
+    return lambda instance: (instance.tags or {}).get(name)
+
+
+# The fields that an InstanceIndex can be queried on, and how to get each from an instance
+INSTANCE_FIELDS = {
+    'name': _tag('Name'),
+    'type': _tag('devops_type'),
+    'vers': _tag('devops_vers'),
+    'release': _tag('devops_release'),
+    'applic': _tag('devops_applic'),
+    'env': _tag('devops_env'),
+    'alias': _tag('registered_host_alias'),
+    'zone': lambda instance: instance.placement,
+    'state': lambda instance: instance.state,
+}
+
+
+class InstanceIndex(object):
+    """
+    Hash indexes over a collection of instances, one per field in INSTANCE_FIELDS, so that
+    find() costs O(k) in the size of the smallest matching set rather than a scan of every
+    instance.  Maintained incrementally with add() and remove().
+    """
+    def __init__(self, instances=()):
+        super(InstanceIndex, self).__init__()
+        self.rebuild(instances)
+
+    def rebuild(self, instances):
+        self._instances = {}
+        # Field -> value -> set of instance IDs
+        self._ids = dict((field, defaultdict(set)) for field in INSTANCE_FIELDS)
+        # Instance ID -> field -> value (what the instance is currently indexed under)
+        self._values = {}
+        for instance in instances:
+            self.add(instance)
+
+    def add(self, instance):
+        """Adds the instance, or re-indexes it if it's already present."""
+        self.remove(instance.id)
+        self._instances[instance.id] = instance
+        values = dict((field, get(instance)) for field, get in INSTANCE_FIELDS.items())
+        self._values[instance.id] = values
+        for field, value in values.items():
+            if value is not None:
+                self._ids[field][value].add(instance.id)
+
+    def remove(self, instance_id):
+        values = self._values.pop(instance_id, None)
+        if values is None:
+            return
+        del self._instances[instance_id]
+        for field, value in values.items():
+            if value is not None:
+                ids = self._ids[field][value]
+                ids.discard(instance_id)
+                if not ids:
+                    del self._ids[field][value]
+
+    def __len__(self):
+        return len(self._instances)
+
+    def get(self, instance_id):
+        return self._instances.get(instance_id)
+
+    def values(self, field):
+        """Returns a dict of value -> set of instance IDs, for one field"""
+        return self._ids[field]
+
+    def find(self, **criteria):
+        """
+        Returns the instances matching every criterion (e.g., type='caliper', zone='us-east-1a'),
+        ordered by instance ID.  With no criteria, returns every instance.
+        """
+        unknown = set(criteria) - set(INSTANCE_FIELDS)
+        if unknown:
+            raise ValueError('Unknown instance fields: %s' % ', '.join(sorted(unknown)))
+        if not criteria:
+            ids = set(self._instances)
+        else:
+            id_sets = sorted((self._ids[field].get(value, set()) for field, value in criteria.items()), key=len)
+            ids = set(id_sets[0])
+            for s in id_sets[1:]:
+                ids &= s
+        return [self._instances[i] for i in sorted(ids)]
@@ -1,10 +1,22 @@
 import abc
+import hashlib
 import os
-import StringIO
+import re
+import tarfile
+import tempfile
+import uuid
 
+from devops import output
 from devops import settings
+from devops.connections import connection_pool
 fab_api = settings.fab_api
 
+# Printed by a batched CommandStrs script to identify the command that failed
+BATCH_FAILURE_MARKER = '__devops_command_failed__'
+
+# Commands that take the apt/dpkg lock
+APT_COMMAND_RE = re.compile(r'\b(apt-get|apt-key|aptitude|dpkg)\b')
+
 
 class ConfigUnit(object):
     """
@@ -27,30 +39,111 @@ class ConfigUnit(object):
     def run(self, host_string):
         pass
 
+    # The config units that must have been applied before this one; None (the default) means
+    # "whatever precedes it in the list of config units it's run from" (see devops.scheduling)
+    depends_on = None
+    # Names of things on the host (e.g., 'apt', for the dpkg lock) that this config unit can't
+    # share with a config unit that's running at the same time
+    resources = frozenset()
+
+    def declare(self, depends_on=None, resources=None):
+        """Declares this config unit's dependencies and/or resources; returns self, for chaining."""
+        if depends_on is not None:
+            self.depends_on = list(depends_on)
+        if resources is not None:
+            self.resources = frozenset(resources)
+        return self
+
+    # False for a config unit whose effect can change even though its definition hasn't
+    # (e.g., a deployment of whatever's at the head of a repository)
+    deterministic = True
+
+    def fingerprint_parts(self):
+        """
+        The things that determine what this config unit does to an instance, as strings.
+        Subclasses extend this with their inputs (commands, file contents, etc.).  The
+        description is deliberately not included: rewording it doesn't change anything.
+        """
+        return [type(self).__name__]
+
+    def fingerprint(self):
+        """A deterministic content hash of the config unit (see fingerprint_parts)"""
+        return hashlib.sha1('\0'.join(self.fingerprint_parts())).hexdigest()
+
+
+def file_digest(path):
+    """The SHA-256 hex digest of a local file's contents"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
 
 class CommandStrs(ConfigUnit):
     """
     A CommandStrs is a ConfigUnit that's comprised of some sequence
     of strings that are to be executed on the instance.
+
+    If batched is True, the whole sequence is shipped to the instance as a single script
+    and run in one remote shell session, rather than one session per command.  Each command
+    still runs in its own subshell (so, e.g., a "cd" doesn't leak into the next command,
+    just as when the commands are run one at a time), and the script stops at the first
+    command that fails (set -e semantics) and reports which command that was.
     """
-    def __init__(self, desc, commands):
+    def __init__(self, desc, commands, batched=False):
         """Commands is a list of commands (strings) that are executed on an instance."""
         super(CommandStrs, self).__init__(desc)
         self.commands = commands
+        self.batched = batched
+        if any(APT_COMMAND_RE.search(s) for s in commands):
+            # Only one apt/dpkg process can run at a time
+            self.resources = frozenset(['apt'])
 
     def __add__(self, other):
         if not isinstance(other, CommandStrs):
             raise Exception('Invalid to add a %s object to a CommandStrs' % type(other))
+        # If either side is batched, the combination runs as one session
         return CommandStrs(desc=self.desc + ' -> ' + other.desc,
-                           commands=self.commands + other.commands)
+                           commands=self.commands + other.commands,
+                           batched=self.batched or other.batched)
+
+    def fingerprint_parts(self):
+        return super(CommandStrs, self).fingerprint_parts() + list(self.commands)
 
     def run(self, host_string):
-        out = StringIO.StringIO()
-        with fab_api.settings(host_string=host_string):
-            for s in self.commands:
-                ret = fab_api.run(s, stdout=out)
-                if ret.failed:
-                    raise Exception('Fabric run failed: %s' % s)
+        if self.batched:
+            return self._run_batched(host_string)
+        with output.HostOutput(host_string, self.desc) as out:
+            with connection_pool.session(host_string):
+                for s in self.commands:
+                    ret = fab_api.run(s, stdout=out)
+                    if ret.failed:
+                        raise Exception('Fabric run failed: %s%s' % (s, out.error_context()))
+        return out.getvalue()
+
+    def batch_script(self):
+        """Returns the script that runs all of the commands in one shell session."""
+        lines = []
+        for i, s in enumerate(self.commands):
+            lines.append('( %s\n) || { rc=$?; echo "%s %d $rc"; exit $rc; }' % (s, BATCH_FAILURE_MARKER, i))
+        return '\n'.join(lines)
+
+    def _run_batched(self, host_string):
+        with output.HostOutput(host_string, self.desc) as out:
+            with connection_pool.session(host_string, warn_only=True):
+                ret = fab_api.run(self.batch_script(), stdout=out)
+        if ret.failed:
+            # The marker is the script's last output, so it's in the tail
+            failed_cmd = None
+            for line in reversed(out.tail):
+                if line.startswith(BATCH_FAILURE_MARKER + ' '):
+                    index, rc = line.split()[1:3]
+                    failed_cmd = self.commands[int(index)]
+                    break
+            if failed_cmd is None:
+                raise Exception('Fabric run failed (batched): %s%s' % (self.desc, out.error_context()))
+            raise Exception('Fabric run failed (exit status %s): %s%s' % (rc, failed_cmd, out.error_context()))
         return out.getvalue()
 
 
@@ -64,8 +157,164 @@ class SshKey(object):
     def local_path(self):
         return os.path.join(self.local_dir, self.filename)
 
+    def digest(self):
+        return file_digest(self.local_path)
+
+
+class FileTransfer(object):
+    """A local file to be put on a host at remote_path (with mode, if given)"""
+    def __init__(self, local_path, remote_path, mode=None):
+        super(FileTransfer, self).__init__()
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.mode = mode
+
+    def digest(self):
+        return file_digest(self.local_path)
+
+
+def _expand_home(remote_path, home):
+    """remote_path with a leading ~ replaced by home (the remote user's home directory)"""
+    if home and (remote_path == '~' or remote_path.startswith('~/')):
+        return home + remote_path[1:]
+    return remote_path
+
+
+def remote_digests(host_string, remote_paths):
+    """
+    Returns a dict of remote path: sha256, for those of the remote files that exist, and the
+    remote user's home directory, in one command.  The dict's paths have ~ expanded (see
+    _expand_home).
+    """
+    cmd = 'echo "$HOME"; sha256sum -- %s 2>/dev/null; true' % ' '.join(sorted(set(remote_paths)))
+    with connection_pool.session(host_string, warn_only=True):
+        ret = fab_api.run(cmd)
+    lines = ret.splitlines()
+    home = lines[0].strip() if lines else ''
+    digests = {}
+    for line in lines[1:]:
+        parts = line.strip().split(None, 1)
+        if len(parts) == 2:
+            digests[parts[1].lstrip('*')] = parts[0]
+    return digests, home
+
+
+class HostFileTransfers(object):
+    """
+    Runs the FileTransferUnits among a host's config units as one batch, wherever they are in
+    the list.  At the first unit's turn, the remote copies of all of their files are checksummed
+    in one command, and the files whose checksum differs from the local file's are sent -- all
+    of them in one tarball -- to a staging directory on the host.  Then, at each unit's turn,
+    run(unit) just moves that unit's changed files into place, so the units still take effect in
+    list order.  Re-running on a host that's up to date sends nothing.
+
+    The checksums are taken once, so the other config units are expected not to change the
+    files that the FileTransferUnits put.  Call close() when done (it removes what's left of the
+    staging directory if a unit failed).
+    """
+    def __init__(self, host_string, config_units):
+        super(HostFileTransfers, self).__init__()
+        self.host_string = host_string
+        self.units = [cu for cu in config_units if isinstance(cu, FileTransferUnit)]
+        self._checked = False
+        self._pending = {}  # id(unit) -> [(staged name, remote path)], for the units with changed files
+        self._staging_dir = None
+        self._remote_tarball = None
+
+    def _check(self):
+        transfers = [(unit, t) for unit in self.units for t in unit.file_transfers()]
+        digests, home = remote_digests(self.host_string, [t.remote_path for unit, t in transfers])
+        pending = [(unit, t, _expand_home(t.remote_path, home)) for unit, t in transfers]
+        pending = [(unit, t, path) for unit, t, path in pending if digests.get(path) != t.digest()]
+        self._checked = True
+        if not pending:
+            output.echo(self.host_string, '%d files up to date; nothing sent' % len(transfers))
+            return
+
+        # Staged as 0, 1, ... and moved to their (~-expanded) remote paths by run()
+        with tempfile.NamedTemporaryFile(suffix='.tar.gz') as f:
+            with tarfile.open(fileobj=f, mode='w:gz') as tar:
+                for i, (unit, t, path) in enumerate(pending):
+                    tarinfo = tar.gettarinfo(t.local_path)
+                    tarinfo.name = str(i)
+                    tarinfo.uid = tarinfo.gid = 0
+                    tarinfo.uname = tarinfo.gname = ''
+                    if t.mode is not None:
+                        tarinfo.mode = t.mode
+                    with open(t.local_path, 'rb') as local_file:
+                        tar.addfile(tarinfo, local_file)
+                    self._pending.setdefault(id(unit), []).append((str(i), path))
+            f.flush()
+            size = os.path.getsize(f.name)
+            name = '/tmp/.devops-files-%s' % uuid.uuid4().hex
+            self._staging_dir, self._remote_tarball = name, name + '.tar.gz'
+            with connection_pool.session(self.host_string):
+                ret = fab_api.put(f.name, self._remote_tarball)
+                if ret.failed:
+                    raise Exception('Fabric put failed')
+        output.echo(self.host_string, '%d files up to date; sent %d files (%d bytes)' % (
+            len(transfers) - len(pending), len(pending), size))
+
+    def run(self, unit):
+        """Puts unit's files in place (those that have changed).  Returns a summary of what was done."""
+        if not self._checked:
+            self._check()
+        staged = self._pending.pop(id(unit), [])
+        if not staged:
+            return 'files up to date; nothing put'
+        unit.before_transfer(self.host_string)
+
+        cmds = []
+        if self._remote_tarball:
+            # The first unit with changed files unpacks the tarball
+            cmds.append('mkdir -p %s && tar -xzf %s -C %s --no-same-owner && rm -f %s' % (
+                self._staging_dir, self._remote_tarball, self._staging_dir, self._remote_tarball))
+        for name, path in staged:
+            cmds.append('mkdir -p %s && mv -f %s/%s %s' % (
+                os.path.dirname(path) or '.', self._staging_dir, name, path))
+        if not self._pending:
+            cmds.append('rmdir %s' % self._staging_dir)
+        cmd = ' && '.join(cmds)
+        with connection_pool.session(self.host_string):
+            ret = fab_api.run(cmd)
+            if ret.failed:
+                raise Exception('Fabric run failed: %s' % cmd)
+        self._remote_tarball = None
+        if not self._pending:
+            self._staging_dir = None
+        return 'put %d files' % len(staged)
+
+    def close(self):
+        if self._staging_dir:
+            with connection_pool.session(self.host_string, warn_only=True):
+                fab_api.run('rm -rf %s %s.tar.gz' % (self._staging_dir, self._staging_dir))
+            self._staging_dir = self._remote_tarball = None
+
 
-class SshKeyPlacement(ConfigUnit):
+class FileTransferUnit(ConfigUnit):
+    """
+    A config unit that puts local files on a host (see file_transfers).  The FileTransferUnits
+    that devops.fleet.run_config_units and AMI.create run on a host are run as one batch, and
+    only changed files are ever sent (see HostFileTransfers).
+    """
+    @abc.abstractmethod
+    def file_transfers(self):
+        """Returns a list of FileTransfers"""
+        pass
+
+    def before_transfer(self, host_string):
+        """Called before any of the unit's files are put in place; may raise to prevent it."""
+        pass
+
+    def run(self, host_string):
+        transfers = HostFileTransfers(host_string, [self])
+        try:
+            return transfers.run(self)
+        finally:
+            transfers.close()
+
+
+class SshKeyPlacement(FileTransferUnit):
     """
     A SshKeyPlacement represents the placement of an SSH key.
     """
@@ -74,20 +323,17 @@ class SshKeyPlacement(ConfigUnit):
         self.ssh_key = ssh_key
         self.remote_dir = remote_dir
 
-    def run(self, host_string):
-        with fab_api.settings(host_string=host_string):
-            cmd = 'mkdir -p %s' % self.remote_dir
-            ret = fab_api.run(cmd)
-            if ret.failed:
-                raise Exception('Fabric run failed: %s' % cmd)
-            ret = fab_api.put(self.ssh_key.local_path,
-                              os.path.join(self.remote_dir, self.ssh_key.filename),
-                              mode=0600)
-            if ret.failed:
-                raise Exception('Fabric put failed')
+    def fingerprint_parts(self):
+        return super(SshKeyPlacement, self).fingerprint_parts() + \
+            [self.ssh_key.filename, self.ssh_key.digest(), self.remote_dir]
 
+    def file_transfers(self):
+        # Extracting the tarball creates remote_dir if need be
+        return [FileTransfer(self.ssh_key.local_path, os.path.join(self.remote_dir, self.ssh_key.filename),
+                             mode=0600)]
 
-class PutFile(ConfigUnit):
+
+class PutFile(FileTransferUnit):
     """
     A PutFile represents the "put" of a local file onto a remote instance.  If
     only_if_existing_file_identical_to is passed, the file will only be "put"
@@ -103,19 +349,25 @@ class PutFile(ConfigUnit):
         self.remote_filename = remote_filename
         self.only_if_existing_file_identical_to = only_if_existing_file_identical_to
 
-    def run(self, host_string):
+    def fingerprint_parts(self):
+        return super(PutFile, self).fingerprint_parts() + \
+            [file_digest(os.path.join(self.local_dir, self.local_filename)),
+             os.path.join(self.remote_dir, self.remote_filename),
+             str(self.only_if_existing_file_identical_to)]
+
+    def file_transfers(self):
+        return [FileTransfer(os.path.join(self.local_dir, self.local_filename),
+                             os.path.join(self.remote_dir, self.remote_filename))]
+
+    def before_transfer(self, host_string):
         remote_filepath = os.path.join(self.remote_dir, self.remote_filename)
         if self.only_if_existing_file_identical_to:
-            with fab_api.settings(host_string=host_string, warn_only=True):
+            with connection_pool.session(host_string, warn_only=True):
                 cmd = 'diff %s %s' % (remote_filepath, self.only_if_existing_file_identical_to)
                 ret = fab_api.run(cmd)
                 if ret.return_code != 0:
                     raise Exception("Existing file (%s) doesn't match expected file (%s)" % \
                         (remote_filepath, self.only_if_existing_file_identical_to))
-        with fab_api.settings(host_string=host_string):
-            ret = fab_api.put(os.path.join(self.local_dir, self.local_filename), remote_filepath)
-            if ret.failed:
-                raise Exception('Fabric put failed')
 
 
 class RemoteCopyFile(ConfigUnit):
@@ -128,16 +380,21 @@ class RemoteCopyFile(ConfigUnit):
         self.use_sudo = use_sudo
         self.only_if_existing_file_identical_to = only_if_existing_file_identical_to
 
+    def fingerprint_parts(self):
+        return super(RemoteCopyFile, self).fingerprint_parts() + \
+            [self.source_filepath, self.dest_filepath, str(self.use_sudo),
+             str(self.only_if_existing_file_identical_to)]
+
     def run(self, host_string):
         if self.only_if_existing_file_identical_to:
-            with fab_api.settings(host_string=host_string, warn_only=True):
+            with connection_pool.session(host_string, warn_only=True):
                 cmd = 'sudo ' if self.use_sudo else '' + \
                       'diff %s %s' % (self.dest_filepath, self.only_if_existing_file_identical_to)
                 ret = fab_api.run(cmd)
                 if ret.return_code != 0:
                     raise Exception("Existing file (%s) doesn't match expected file (%s)" % \
                         (self.dest_filepath, self.only_if_existing_file_identical_to))
-        with fab_api.settings(host_string=host_string):
+        with connection_pool.session(host_string):
             ret = fab_api.run('sudo ' if self.use_sudo else '' + \
                               'cp -p %s %s' % (self.source_filepath, self.dest_filepath))
             if ret.failed:
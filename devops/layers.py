@@ -0,0 +1,116 @@
+"""
+Layered AMI baking: while an AMI is being baked, the instance is snapshotted into an
+intermediate "layer" AMI after each config unit, tagged with the cumulative hash of the
+parent AMI and the config units applied so far.  A later bake of the same AMI starts from
+the layer for the longest prefix of its config units that's unchanged, rather than from
+the parent AMI -- much like Docker's layer cache.
+
+Each layer costs an AMI and an EBS snapshot per config unit (up to AMI_LAYER_CACHE_KEEP of
+them per AMI name are kept), so the cache is opt-in: AMI_LAYER_CACHE, or AMI.create's
+use_layer_cache.
+"""
+import hashlib
+
+import boto.exception
+
+from devops import readiness
+from devops import settings
+from devops import tracing
+from devops.connections import connection_pool
+from devops.control_plane import control_plane
+fab_api = settings.fab_api
+
+# Tags on layer AMIs: the cumulative hash, the name of the AMI being baked, and the number
+# of config units applied
+LAYER_HASH_TAG = 'devops_layer'
+LAYER_OF_TAG = 'devops_layer_of'
+LAYER_DEPTH_TAG = 'devops_layer_depth'
+
+# Whether AMI.create snapshots layers (and starts from cached ones) by default
+USE_LAYER_CACHE = getattr(settings, 'AMI_LAYER_CACHE', False)
+# How many layer AMIs to keep per AMI name (besides those of the most recent bake)
+DEFAULT_KEEP_LAYERS = getattr(settings, 'AMI_LAYER_CACHE_KEEP', 10)
+
+
+def layer_hashes(parent_ami_id, config_units):
+    """
+    Returns a list with the cumulative hash after each config unit.  Past a config unit that
+    isn't deterministic (see ConfigUnit.deterministic), the entries are None: nothing from
+    there on can be cached.
+    """
+    hashes = []
+    h = hashlib.sha1('parent:%s' % parent_ami_id).hexdigest()
+    for cu in config_units:
+        if h is not None and cu.deterministic:
+            h = hashlib.sha1('%s:%s' % (h, cu.fingerprint())).hexdigest()
+        else:
+            h = None
+        hashes.append(h)
+    return hashes
+
+
+def find_longest_cached_prefix(ec2_conn, hashes):
+    """
+    Looks up all of the layers with a single API call.  Returns (depth, layer AMI) for the
+    deepest available layer, or (0, None) if none of them are cached.
+    """
+    wanted = [h for h in hashes if h]
+    if not wanted:
+        return 0, None
+    images = ec2_conn.get_all_images(owners=[settings.AWS_OWNER_ID],
+                                     filters={'tag:%s' % LAYER_HASH_TAG: wanted, 'state': 'available'})
+    by_hash = dict((image.tags[LAYER_HASH_TAG], image) for image in images)
+    for depth in range(len(hashes), 0, -1):
+        image = by_hash.get(hashes[depth - 1])
+        if image is not None:
+            return depth, image
+    return 0, None
+
+
+@tracing.traced('snapshot_layer')
+def snapshot_layer(ec2_conn, instance, host_string, ami_name, layer_hash, depth):
+    """
+    Starts creating a layer AMI from the instance, without rebooting it or waiting for the
+    image, so baking carries on while EC2 snapshots.  Returns the new image's ID.
+
+    Since the instance isn't rebooted, its filesystems are synced first (over host_string);
+    otherwise writes of the config unit that just ran could be missing from the layer, and
+    every later bake with the same prefix would start from it.
+    """
+    desc = '%s-layer-%d-%s' % (ami_name, depth, layer_hash[:12])
+    print 'Snapshotting layer %d of %s (%s)' % (depth, ami_name, layer_hash[:12])
+    with connection_pool.session(host_string):
+        ret = fab_api.sudo('sync')
+        if ret.failed:
+            raise Exception('Fabric sudo failed: sync')
+    image_id = ec2_conn.create_image(instance.id, name=desc, description=desc, no_reboot=True)
+    tags = {LAYER_HASH_TAG: layer_hash, LAYER_OF_TAG: ami_name, LAYER_DEPTH_TAG: str(depth)}
+
+    def tagged():
+        try:
+            return ec2_conn.create_tags([image_id], tags)
+        except boto.exception.EC2ResponseError, e:
+            # A just-created image isn't always visible to the API right away
+            if not readiness.is_not_found_error(e):
+                raise
+            return False
+    readiness.wait_until(tagged, 60, 'tagging of layer %s' % image_id)
+    return image_id
+
+
+def evict_layers(ec2_conn, ami_name, keep=DEFAULT_KEEP_LAYERS, protected_hashes=()):
+    """
+    Deregisters all but the keep most recent layer AMIs of ami_name (along with their EBS
+    snapshots).  Layers whose hash is in protected_hashes (e.g., those of the bake that just
+    finished) are never deregistered, and don't count against keep.
+    """
+    images = ec2_conn.get_all_images(owners=[settings.AWS_OWNER_ID],
+                                     filters={'tag:%s' % LAYER_OF_TAG: ami_name})
+    protected_hashes = set(protected_hashes)
+    candidates = [i for i in images if i.tags.get(LAYER_HASH_TAG) not in protected_hashes]
+    candidates.sort(key=lambda i: i.creationDate, reverse=True)
+
+    def deregister(image):
+        print 'Deregistering layer %s of %s (and its snapshot)' % (image.id, ami_name)
+        return ec2_conn.deregister_image(image.id, delete_snapshot=True)
+    control_plane.map(deregister, candidates[keep:])
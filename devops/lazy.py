@@ -0,0 +1,36 @@
+import threading
+
+
+class LazyObject(object):
+    """
+    A stand-in for an object that's expensive (or has side effects, like network I/O) to build:
+    factory is called to build it the first time any of its attributes is used, and from then
+    on attribute access goes to the built object.  Lets a settings module define, e.g., its EC2
+    connection without importing the module costing anything.
+    """
+    def __init__(self, factory):
+        # Set via __dict__ since __setattr__ is forwarded to the wrapped object
+        self.__dict__['_factory'] = factory
+        self.__dict__['_wrapped'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _setup(self):
+        if self.__dict__['_wrapped'] is None:
+            with self.__dict__['_lock']:
+                if self.__dict__['_wrapped'] is None:
+                    self.__dict__['_wrapped'] = self.__dict__['_factory']()
+        return self.__dict__['_wrapped']
+
+    def is_built(self):
+        return self.__dict__['_wrapped'] is not None
+
+    def __getattr__(self, name):
+        return getattr(self._setup(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._setup(), name, value)
+
+    def __repr__(self):
+        if not self.is_built():
+            return '<LazyObject (not yet built)>'
+        return repr(self.__dict__['_wrapped'])
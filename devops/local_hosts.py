@@ -1,11 +1,77 @@
+import hashlib
+import pipes
+
 from fabric.contrib.files import contains, sed
 
+from devops import fleet
 from devops import settings
+from devops.connections import connection_pool
+from devops.instance_config import ConfigUnit
 fab_api = settings.fab_api
 
 # The name of the /etc/hosts file on the instance
 HOSTS_FILENAME = '/etc/hosts'
 
+# The lines around the block of /etc/hosts that EtcHostsConfigurer.sync manages; the BEGIN
+# line ends with a hash of the block's entries
+BLOCK_BEGIN = '# BEGIN devops managed hosts'
+BLOCK_END = '# END devops managed hosts'
+
+# The comment EtcHostsConfigurer.update writes above each line it adds; sync_cmd strips it
+# along with those lines
+UPDATE_MARKER = '# Will be auto-edited'
+
+
+def render_block(hosts):
+    """
+    Returns (the managed block, its hash) for a dict of alias: (ip, hostname) -- e.g., from
+    OpsRegistry.get_registered_host_addresses.
+    """
+    entries = ['%s %s %s' % (ip, hostname, alias) for alias, (ip, hostname) in sorted(hosts.items())]
+    block_hash = hashlib.sha1('\n'.join(entries)).hexdigest()
+    return '\n'.join(['%s %s' % (BLOCK_BEGIN, block_hash)] + entries + [BLOCK_END]), block_hash
+
+
+def _sed_escape(s):
+    return s.replace('\\', '\\\\').replace('.', '\\.').replace('/', '\\/')
+
+
+def sync_cmd(hosts):
+    """
+    Returns a command (to be run with sudo) that replaces the managed block of /etc/hosts
+    -- and any other lines for the same aliases, such as those added by
+    EtcHostsConfigurer.update, along with update's marker comments -- unless the block already has the same hash.  The new file
+    is written alongside and renamed into place.  Echoes "unchanged" or "updated".
+    """
+    block, block_hash = render_block(hosts)
+    new_filename = HOSTS_FILENAME + '.devops-new'
+    deletes = ["-e '/^%s/,/^%s/d'" % (_sed_escape(BLOCK_BEGIN), _sed_escape(BLOCK_END))]
+    deletes += ["-e '/^%s$/d'" % _sed_escape(UPDATE_MARKER)]
+    deletes += ["-e '/[[:space:]]%s$/d'" % _sed_escape(alias) for alias in sorted(hosts)]
+    return ('if grep -qxF %(begin)s %(f)s; then echo unchanged; else '
+            'sed %(deletes)s %(f)s > %(new)s && printf "%%s\\n" %(block)s >> %(new)s && '
+            'chmod 644 %(new)s && mv %(new)s %(f)s && echo updated; fi') % {
+                'begin': pipes.quote('%s %s' % (BLOCK_BEGIN, block_hash)), 'f': HOSTS_FILENAME,
+                'new': new_filename, 'deletes': ' '.join(deletes), 'block': pipes.quote(block)}
+
+
+class EtcHostsSync(ConfigUnit):
+    """Brings a host's managed /etc/hosts block up to date, in one command (see sync_cmd)."""
+    def __init__(self, hosts, desc='Sync managed /etc/hosts entries'):
+        super(EtcHostsSync, self).__init__(desc)
+        self.hosts = dict(hosts)
+
+    def fingerprint_parts(self):
+        return super(EtcHostsSync, self).fingerprint_parts() + [render_block(self.hosts)[1]]
+
+    def run(self, host_string):
+        with connection_pool.session(host_string):
+            cmd = sync_cmd(self.hosts)
+            ret = fab_api.sudo(cmd)
+            if ret.failed:
+                raise Exception('Fabric sudo failed: %s' % cmd)
+        return ret.strip()
+
 
 class EtcHostsConfigurer(object):
     def __init__(self):
@@ -13,13 +79,27 @@ class EtcHostsConfigurer(object):
         pass
 
     def update(self, ssh_host_string, alias, ip, hostname):
-        with fab_api.settings(host_string=ssh_host_string):
+        with connection_pool.session(ssh_host_string):
             # If the hosts file contains the given alias, EDIT the IP and hostname on that line
             if contains(HOSTS_FILENAME, r'.*\s%s$' % alias, escape=False, use_sudo=True):
                 sed(HOSTS_FILENAME, r'.*\s%s$' % alias, r'%s %s %s' % (ip, hostname, alias), use_sudo=True)
             # The hosts file does NOT contain the given alias; add a line for it
             else:
                 for line in ['',
-                    '# Will be auto-edited',
+                    UPDATE_MARKER,
                     '%s %s %s' % (ip, hostname, alias)]:
                     fab_api.sudo('echo "%s" >> %s' % (line, HOSTS_FILENAME))
+
+    def sync(self, host_strings, hosts, pool_size=fleet.DEFAULT_POOL_SIZE):
+        """
+        Makes the managed block of /etc/hosts on every host list exactly the aliases in hosts
+        (a dict of alias: (ip, hostname)), with one command per host and the hosts worked on
+        in parallel.  Hosts whose block is already up to date are left alone.  Returns the
+        FleetResult.
+        """
+        sync_unit = EtcHostsSync(hosts)
+        result = fleet.FleetExecutor([sync_unit], pool_size=pool_size, fail_fast=False).run(host_strings)
+        updated = [h for h in result.succeeded_hosts if result.host_results[h].outputs[0][1] == 'updated']
+        print 'Synced %d /etc/hosts entries: %d hosts updated, %d unchanged, %d failed' % (
+            len(hosts), len(updated), len(result.succeeded_hosts) - len(updated), len(result.failed_hosts))
+        return result
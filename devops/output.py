@@ -0,0 +1,198 @@
+"""
+Streaming of remote command output.  A HostOutput is the file-like object that Fabric writes
+a command's output to (its stdout= argument), as the output arrives.  Each complete line is:
+
+* echoed with a "[host]" prefix (see echo), so that the output of many hosts can be
+  followed live;
+* appended to the host's log file (see host_log_path), which is rotated when it gets large.
+  Lines are written in batches (every LOG_FLUSH_LINES lines or LOG_FLUSH_INTERVAL seconds),
+  and the processes writing to one host's log take turns by locking the file;
+* kept in a ring buffer of the last tail_lines lines, for error reports and return values.
+
+So memory use is bounded, however much a command prints, and nothing waits for the
+command to finish before being shown.  read_host_log() gives a host's logged lines back.
+"""
+from collections import deque
+import fcntl
+import os
+import re
+import sys
+import threading
+import time
+
+from devops import settings
+
+# Where the per-host log files go; None to not keep them
+LOG_DIR = getattr(settings, 'OUTPUT_LOG_DIR', os.path.expanduser('~/.devops/logs'))
+# A log file is rotated when it reaches LOG_MAX_BYTES; LOG_BACKUPS rotated files are kept
+LOG_MAX_BYTES = getattr(settings, 'OUTPUT_LOG_MAX_BYTES', 10 * 1024 * 1024)
+LOG_BACKUPS = getattr(settings, 'OUTPUT_LOG_BACKUPS', 3)
+# Log lines are written every LOG_FLUSH_LINES lines, or when LOG_FLUSH_INTERVAL seconds have passed
+LOG_FLUSH_LINES = 100
+LOG_FLUSH_INTERVAL = 1.0
+# How many of the last lines are kept in memory
+TAIL_LINES = getattr(settings, 'OUTPUT_TAIL_LINES', 200)
+# Whether output is echoed live
+LIVE = getattr(settings, 'OUTPUT_LIVE', True)
+
+# Serializes the live echo (and log writes) of the threads in a process
+_lock = threading.Lock()
+
+
+def echo(host_string, message):
+    """
+    Prints a line for the host with a "[host]" prefix, as HostOutput echoes output: whole,
+    and flushed, so that the lines of hosts worked on in other threads and processes don't
+    get mixed up.
+    """
+    with _lock:
+        sys.stdout.write('[%s] %s\n' % (host_string, message))
+        sys.stdout.flush()
+
+
+def host_log_path(host_string, log_dir=LOG_DIR):
+    return os.path.join(log_dir, '%s.log' % re.sub(r'[^\w.@-]', '_', host_string))
+
+
+def _rotate(path, backups):
+    for i in range(backups - 1, 0, -1):
+        if os.path.exists('%s.%d' % (path, i)):
+            os.rename('%s.%d' % (path, i), '%s.%d' % (path, i + 1))
+    if backups > 0:
+        os.rename(path, '%s.1' % path)
+    else:
+        os.remove(path)
+
+
+def read_host_log(host_string, log_dir=LOG_DIR, backups=LOG_BACKUPS):
+    """Yields the lines logged for the host, oldest first (including the rotated files)."""
+    path = host_log_path(host_string, log_dir)
+    for p in ['%s.%d' % (path, i) for i in range(backups, 0, -1)] + [path]:
+        if os.path.exists(p):
+            with open(p) as f:
+                for line in f:
+                    yield line.rstrip('\n')
+
+
+class HostOutput(object):
+    """
+    The output of the commands run on one host for one purpose (e.g., a config unit); see
+    the module docstring.  Use it as the stdout= of fab_api.run/sudo, and close it (or use
+    it as a context manager) when done.
+    """
+    def __init__(self, host_string, desc=None, live=LIVE, tail_lines=TAIL_LINES, log_dir=LOG_DIR,
+                 max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        super(HostOutput, self).__init__()
+        self.host_string = host_string
+        self.desc = desc
+        self.live = live
+        self.tail = deque(maxlen=tail_lines)
+        self.lines_seen = 0
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._partial = ''
+        # Fabric's own prefix on each line, which we replace with ours
+        self._fabric_prefix = '[%s] out: ' % host_string
+        self._log = None
+        self._log_pending = []
+        self._log_flushed_at = time.time()
+        self.log_path = None
+        if log_dir:
+            if not os.path.isdir(log_dir):
+                try:
+                    os.makedirs(log_dir)
+                except OSError:
+                    # Made meanwhile by another process
+                    pass
+            self.log_path = host_log_path(host_string, log_dir)
+            self._log = open(self.log_path, 'a')
+            if desc:
+                self._log_pending.append('=== %s' % desc)
+
+    def write(self, data):
+        data = self._partial + data.replace('\r\n', '\n')
+        lines = data.split('\n')
+        self._partial = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def flush(self):
+        pass
+
+    def _line(self, line):
+        if line.startswith(self._fabric_prefix):
+            line = line[len(self._fabric_prefix):]
+        self.tail.append(line)
+        self.lines_seen += 1
+        if self.live:
+            echo(self.host_string, line)
+        if self._log:
+            self._log_pending.append(line)
+            if len(self._log_pending) >= LOG_FLUSH_LINES or \
+                    time.time() - self._log_flushed_at >= LOG_FLUSH_INTERVAL:
+                self._flush_log()
+
+    def _flush_log(self):
+        """Appends the pending lines to the log file, rotating it if it's got too large."""
+        self._log_flushed_at = time.time()
+        if not self._log_pending:
+            return
+        data = ''.join(line + '\n' for line in self._log_pending)
+        del self._log_pending[:]
+        with _lock:
+            # Other processes (e.g., the DependencyScheduler's) may log for the host too.  Once
+            # we hold the lock on our file, it must still be the one at log_path: if another
+            # process has rotated it meanwhile, we reopen and lock the new one.
+            while True:
+                fcntl.flock(self._log, fcntl.LOCK_EX)
+                if self._is_current_log():
+                    break
+                self._log.close()
+                self._log = open(self.log_path, 'a')
+            rotated = False
+            try:
+                self._log.write(data)
+                self._log.flush()
+                if os.fstat(self._log.fileno()).st_size >= self.max_bytes:
+                    _rotate(self.log_path, self.backups)
+                    rotated = True
+            finally:
+                fcntl.flock(self._log, fcntl.LOCK_UN)
+            if rotated:
+                self._log.close()
+                self._log = open(self.log_path, 'a')
+
+    def _is_current_log(self):
+        try:
+            return os.path.samestat(os.fstat(self._log.fileno()), os.stat(self.log_path))
+        except OSError:
+            return False
+
+    def close(self):
+        if self._partial:
+            self._line(self._partial)
+            self._partial = ''
+        if self._log:
+            self._flush_log()
+            self._log.close()
+            self._log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def getvalue(self):
+        """The last lines of output (in place of StringIO.getvalue, which has all of them)"""
+        lines = list(self.tail) + ([self._partial] if self._partial else [])
+        return '\n'.join(lines)
+
+    def error_context(self, n=20):
+        """The last n lines of output, for adding to an error message"""
+        if not self.tail:
+            return ''
+        lines = list(self.tail)[-n:]
+        return '\nLast %d lines of output on %s%s:\n%s' % (
+            len(lines), self.host_string, ' (full log: %s)' % self.log_path if self.log_path else '',
+            '\n'.join(lines))
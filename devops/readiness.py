@@ -0,0 +1,211 @@
+from multiprocessing.pool import ThreadPool
+import random
+import socket
+import time
+
+import boto.exception
+
+from devops import settings
+from devops import tracing
+from devops.connections import connection_pool
+fab_api = settings.fab_api
+
+# Overall deadlines (in seconds); each can be overridden in the settings module
+INSTANCE_RUNNING_DEADLINE = getattr(settings, 'INSTANCE_RUNNING_DEADLINE', 300)
+SSH_READY_DEADLINE = getattr(settings, 'SSH_READY_DEADLINE', 300)
+IMAGE_AVAILABLE_DEADLINE = getattr(settings, 'IMAGE_AVAILABLE_DEADLINE', 1800)
+
+SSH_PORT = 22
+
+# The most port probes we have in flight at once when waiting on many instances
+MAX_PROBE_THREADS = 20
+
+
+class ReadinessTimeout(Exception):
+    pass
+
+
+def is_not_found_error(e):
+    """Whether e is EC2 saying that a resource doesn't exist (or isn't visible to the API yet)"""
+    return getattr(e, 'error_code', None) is not None and e.error_code.endswith('.NotFound')
+
+
+def wait_until(predicate, deadline, desc, initial_delay=0.5, max_delay=10.0, factor=2.0, jitter=0.5):
+    """
+    Calls predicate until it returns a true value, which is then returned.  Between
+    attempts we sleep with exponential backoff (starting at initial_delay, multiplied by
+    factor each time, capped at max_delay) and +/- jitter (a fraction of the delay), so
+    that many waiters don't poll in lockstep.  Raises ReadinessTimeout once deadline
+    seconds have passed.
+    """
+    give_up_at = time.time() + deadline
+    delay = initial_delay
+    attempt = 0
+    with tracing.span('wait for %s' % desc, tracing.WAIT_CATEGORY) as span:
+        while True:
+            attempt += 1
+            if span:
+                span.attrs['attempts'] = attempt
+            result = predicate()
+            if result:
+                return result
+            remaining = give_up_at - time.time()
+            if remaining <= 0:
+                raise ReadinessTimeout('Timed out after %ds (%d attempts) waiting for %s' % (deadline, attempt, desc))
+            print 'Waiting for %s (attempt %d)...' % (desc, attempt)
+            time.sleep(min(delay * random.uniform(1 - jitter, 1 + jitter), remaining))
+            delay = min(delay * factor, max_delay)
+
+
+def wait_for_instance_state(instance, state='running', deadline=INSTANCE_RUNNING_DEADLINE):
+    def reached():
+        try:
+            status = instance.update()
+        except boto.exception.EC2ResponseError, e:
+            # A just-launched instance isn't always visible to the API right away
+            if not is_not_found_error(e):
+                raise
+            return False
+        if status == state:
+            return True
+        if status != 'pending':
+            raise Exception("Couldn't start instance (status: %s)" % status)
+        return False
+    wait_until(reached, deadline, 'instance %s to be %s' % (instance.id, state))
+    return instance
+
+
+def ssh_port_is_open(host, port=SSH_PORT, timeout=3.0):
+    """
+    A cheap TCP-level check that sshd is up: connects and reads the SSH banner, without
+    attempting a login.
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+    try:
+        return sock.recv(64).startswith('SSH-')
+    except (socket.error, socket.timeout):
+        return False
+    finally:
+        sock.close()
+
+
+def ssh_login_works(host_string):
+    try:
+        # The probe's connection stays in the pool for the config units that follow
+        with connection_pool.session(host_string):
+            res = fab_api.run('echo "Hello world"')
+    # Fabric aborts by raising SystemExit
+    except (Exception, SystemExit):
+        return False
+    return not res.failed
+
+
+def wait_for_ssh(host_string, host, deadline=SSH_READY_DEADLINE):
+    """
+    Waits until sshd on host accepts TCP connections, then until we can actually log in
+    and run a command.  Both phases share the one deadline.
+    """
+    give_up_at = time.time() + deadline
+    wait_until(lambda: ssh_port_is_open(host), deadline, 'SSH port on %s' % host)
+    wait_until(lambda: ssh_login_works(host_string), max(give_up_at - time.time(), 0),
+               'SSH login to %s' % host_string, initial_delay=1.0)
+
+
+def wait_for_image_state(ec2_conn, image_id, state='available', deadline=IMAGE_AVAILABLE_DEADLINE):
+    """Waits for the AMI to reach the given state (typically pending -> available); returns the image."""
+    def reached():
+        try:
+            image = ec2_conn.get_image(image_id)
+        except boto.exception.EC2ResponseError, e:
+            # A just-created image isn't always visible to the API right away
+            if not is_not_found_error(e):
+                raise
+            return None
+        if image is None:
+            return None
+        if image.state == 'failed':
+            raise Exception('Creation of image %s failed' % image_id)
+        return image if image.state == state else None
+    return wait_until(reached, deadline, 'image %s to be %s' % (image_id, state),
+                      initial_delay=5.0, max_delay=30.0)
+
+
+def wait_for_instances_state(ec2_conn, instances, state='running', deadline=INSTANCE_RUNNING_DEADLINE):
+    """
+    Waits for many instances at once, polling them all with a single API call per attempt.
+    Returns (ready, failed): ready is the list of (refreshed) instances that reached the
+    state, in the order given; failed maps instance ID -> reason for the rest.
+    """
+    ids = [i.id for i in instances]
+    current = dict((i.id, i) for i in instances)
+    failed = {}
+
+    def all_settled():
+        pending_ids = [i for i in ids if i not in failed and current[i].state != state]
+        if not pending_ids:
+            return True
+        try:
+            reservs = ec2_conn.get_all_instances(instance_ids=pending_ids)
+        except boto.exception.EC2ResponseError, e:
+            # Just-launched instances aren't always visible to the API right away
+            if not is_not_found_error(e):
+                raise
+            return False
+        for r in reservs:
+            for i in r.instances:
+                current[i.id] = i
+                if i.state not in (state, 'pending'):
+                    failed[i.id] = 'status: %s' % i.state
+        return False
+
+    try:
+        wait_until(all_settled, deadline, '%d instances to be %s' % (len(ids), state))
+    except ReadinessTimeout:
+        for i in ids:
+            if i not in failed and current[i].state != state:
+                failed[i] = 'timed out (status: %s)' % current[i].state
+    ready = [current[i] for i in ids if i not in failed]
+    return ready, failed
+
+
+def wait_for_ssh_many(host_pairs, deadline=SSH_READY_DEADLINE):
+    """
+    Like wait_for_ssh, for many (host_string, host) pairs.  The port probes (plain sockets)
+    run concurrently in threads; the logins go through Fabric, whose env is process-global,
+    so they're done one host at a time -- by then sshd is known to be up, so each typically
+    succeeds on the first attempt.  Returns a dict of host_string -> error, for the hosts
+    that never became usable.
+    """
+    give_up_at = time.time() + deadline
+    errors = {}
+
+    def wait_for_port(pair):
+        host_string, host = pair
+        try:
+            wait_until(lambda: ssh_port_is_open(host), deadline, 'SSH port on %s' % host)
+        except ReadinessTimeout, e:
+            return host_string, str(e)
+        return host_string, None
+
+    if host_pairs:
+        thread_pool = ThreadPool(min(len(host_pairs), MAX_PROBE_THREADS))
+        try:
+            for host_string, error in thread_pool.map(wait_for_port, host_pairs):
+                if error:
+                    errors[host_string] = error
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    for host_string, host in host_pairs:
+        if host_string in errors:
+            continue
+        try:
+            wait_until(lambda: ssh_login_works(host_string), max(give_up_at - time.time(), 0),
+                       'SSH login to %s' % host_string, initial_delay=1.0)
+        except ReadinessTimeout, e:
+            errors[host_string] = str(e)
+    return errors
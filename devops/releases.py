@@ -0,0 +1,367 @@
+"""
+Bookkeeping for the timestamped release directories that CodeDeployments create.  Next to
+each deployment's symlink, a manifest (MANIFEST_FORMAT) lists its releases, oldest first, and
+a history (HISTORY_FORMAT) lists the releases that were active before the current one, most
+recent last.  Activating a release adds the outgoing one to the history and (unless it's
+deferred, as staged_deploy does) garbage-collects all but the most recent keep releases, in
+the same command; rolling back re-points the symlink to the last release in the history, and
+drops it from there.  Both cost one round-trip per host.  Garbage collection never deletes
+the active release or the one a rollback would go back to.
+
+Activation swaps the symlink atomically (see point_cmd), and staged_deploy rolls a release
+out to a fleet in two phases -- stage everywhere, then activate everywhere at once -- so
+that the window in which hosts run different versions is as short as possible.
+"At once" is a barrier (see activate_together): every host is connected to first, and
+only then are the symlinks swapped, so the SSH handshakes don't spread the swaps out.
+"""
+from datetime import datetime
+import copy
+import multiprocessing
+import time
+import traceback
+
+from devops import fleet
+from devops import output
+from devops import settings
+from devops import tracing
+from devops.connections import connection_pool
+from devops.instance_config import ConfigUnit
+fab_api = settings.fab_api
+
+# How many releases of each deployment are kept on a host (the active one always is)
+DEFAULT_KEEP_RELEASES = getattr(settings, 'DEPLOY_KEEP_RELEASES', 5)
+# The most processes hosts are activated (or rolled back) from at once; beyond that, each
+# process activates a share of the hosts
+MAX_ACTIVATION_PROCESSES = getattr(settings, 'DEPLOY_MAX_ACTIVATION_PROCESSES', 32)
+# How long (in seconds) activation waits for every host to be connected before going ahead
+# with those that are
+ACTIVATION_CONNECT_TIMEOUT = getattr(settings, 'DEPLOY_ACTIVATION_CONNECT_TIMEOUT', 120)
+
+MANIFEST_FORMAT = '.%s.releases'
+HISTORY_FORMAT = '.%s.history'
+
+
+def manifest_name(dirname):
+    return MANIFEST_FORMAT % dirname
+
+
+def history_name(dirname):
+    return HISTORY_FORMAT % dirname
+
+
+def record_cmd(target_containing_folder, dirname, release):
+    """Returns a command that adds the release (a directory name) to the manifest."""
+    manifest = manifest_name(dirname)
+    return 'cd %s && { grep -qxF -- %s %s 2>/dev/null || echo %s >> %s; }' % (
+        target_containing_folder, release, manifest, release, manifest)
+
+
+def point_cmd(dirname, release):
+    """
+    Returns a command (to run in the target folder) that points the symlink at the release.
+    The new symlink is made alongside and renamed over the old one, so the path always exists.
+    """
+    tmp = '.%s.new' % dirname
+    return 'ln -sfn %s %s && mv -T %s %s' % (release, tmp, tmp, dirname)
+
+
+def gc_cmd(dirname, keep):
+    """
+    Returns a command (to run in the target folder) that deletes all but the last keep
+    releases in the manifest -- except the active one and the last previously active one --
+    and drops them from the manifest.  The history is cut to its last keep entries.
+    """
+    if keep < 1:
+        raise ValueError('Must keep at least one release: %s' % keep)
+    return ('touch %(m)s %(h)s && CUR=$(readlink %(d)s); PREV=$(tail -n 1 %(h)s); '
+            'for R in $(head -n -%(keep)d %(m)s); do '
+            '[ "$R" = "$CUR" ] || [ "$R" = "$PREV" ] || rm -rf -- "$R"; done && '
+            '{ head -n -%(keep)d %(m)s | grep -xF -e "$CUR" -e "$PREV"; tail -n %(keep)d %(m)s; } > %(m)s.tmp && '
+            'mv %(m)s.tmp %(m)s && tail -n %(keep)d %(h)s > %(h)s.tmp && mv %(h)s.tmp %(h)s') % {
+        'd': dirname, 'm': manifest_name(dirname), 'h': history_name(dirname), 'keep': keep}
+
+
+def activate_cmd(target_containing_folder, dirname, release, keep=DEFAULT_KEEP_RELEASES, gc=True):
+    """
+    Returns a command that points the symlink at the release, adding the release that was
+    active to the history, and then (if gc) garbage-collects old releases.
+    """
+    cmd = 'cd %s && CUR=$(readlink %s); if [ -n "$CUR" ] && [ "$CUR" != %s ]; then echo "$CUR" >> %s; fi && %s' % (
+        target_containing_folder, dirname, release, history_name(dirname), point_cmd(dirname, release))
+    if gc:
+        cmd += ' && ' + gc_cmd(dirname, keep)
+    return cmd
+
+
+def rollback_cmd(target_containing_folder, dirname, from_release=None):
+    """
+    Returns a command that points the symlink at the release that was active before the
+    current one (the last in the history), drops it from the history, and echoes it.  With
+    from_release, does nothing (echoing the active release) unless from_release is the
+    active one.
+    """
+    cmd = 'cd %(t)s && CUR=$(readlink %(d)s) && '
+    if from_release:
+        cmd += 'if [ "$CUR" != %(from)s ]; then echo "$CUR"; exit 0; fi && '
+    cmd += ('PREV=$(tail -n 1 %(h)s 2>/dev/null; true) && '
+            'if [ -z "$PREV" ] || [ ! -d "$PREV" ]; then echo "No release to roll back to from $CUR" >&2; exit 1; fi && '
+            '%(point)s && head -n -1 %(h)s > %(h)s.tmp && mv %(h)s.tmp %(h)s && echo "$PREV"')
+    return cmd % {'t': target_containing_folder, 'd': dirname, 'h': history_name(dirname),
+                  'from': from_release, 'point': point_cmd(dirname, '"$PREV"')}
+
+
+def cleanup_cmd(target_containing_folder, dirname, keep=DEFAULT_KEEP_RELEASES):
+    """Returns a command that garbage-collects old releases (see gc_cmd)."""
+    return 'cd %s && %s' % (target_containing_folder, gc_cmd(dirname, keep))
+
+
+class ReleaseState(object):
+    """
+    The releases of a deployment on a host (oldest first), which is active, and which was
+    active before it (the release a rollback would activate), or None
+    """
+    def __init__(self, releases, active, previous=None):
+        super(ReleaseState, self).__init__()
+        self.releases = releases
+        self.active = active
+        self.previous = previous
+
+
+def release_state(host_string, code_deployment):
+    dirname = code_deployment.dirname
+    cmd = 'cd %s && cat %s 2>/dev/null; echo; echo "previous: $(tail -n 1 %s 2>/dev/null)"; echo "active: $(readlink %s)"' % (
+        code_deployment.target_containing_folder, manifest_name(dirname), history_name(dirname), dirname)
+    with connection_pool.session(host_string, warn_only=True):
+        ret = fab_api.run(cmd)
+    releases = []
+    labelled = {}
+    for line in ret.splitlines():
+        label, sep, value = line.partition(': ')
+        if sep and label in ('previous', 'active'):
+            labelled[label] = value.strip() or None
+        elif line.strip():
+            releases.append(line.strip())
+    return ReleaseState(releases, labelled.get('active'), labelled.get('previous'))
+
+
+class CodeRollback(ConfigUnit):
+    """Re-points a CodeDeployment's symlink to the release before the active one."""
+    deterministic = False
+
+    def __init__(self, code_deployment, desc=None, from_release=None):
+        super(CodeRollback, self).__init__(desc or 'Roll back %s' % code_deployment.desc)
+        self.code_deployment = code_deployment
+        # If given, only hosts on which this release is active are rolled back
+        self.from_release = from_release
+
+    def run(self, host_string):
+        with connection_pool.session(host_string):
+            cmd = rollback_cmd(self.code_deployment.target_containing_folder, self.code_deployment.dirname,
+                               self.from_release)
+            ret = fab_api.run(cmd)
+            if ret.failed:
+                raise Exception('Fabric run failed: %s' % cmd)
+        output.echo(host_string, 'Rolled back %s to %s' % (self.code_deployment.dirname, ret.strip()))
+        return ret
+
+
+def rollback(code_deployment, host_strings, pool_size=fleet.DEFAULT_POOL_SIZE):
+    """Rolls the deployment back on all of the hosts, in parallel.  Returns the FleetResult."""
+    return fleet.FleetExecutor([CodeRollback(code_deployment)], pool_size=pool_size,
+                               fail_fast=False).run(host_strings)
+
+
+class CodeCleanup(ConfigUnit):
+    """Garbage-collects a CodeDeployment's old releases (see gc_cmd)."""
+    deterministic = False
+
+    def __init__(self, code_deployment):
+        super(CodeCleanup, self).__init__('Clean up old releases of %s' % code_deployment.desc)
+        self.code_deployment = code_deployment
+
+    def run(self, host_string):
+        with connection_pool.session(host_string):
+            cmd = cleanup_cmd(self.code_deployment.target_containing_folder, self.code_deployment.dirname,
+                              self.code_deployment.keep_releases)
+            ret = fab_api.run(cmd)
+            if ret.failed:
+                raise Exception('Fabric run failed: %s' % cmd)
+        return ret
+
+
+class CodeActivation(ConfigUnit):
+    """
+    Activates a CodeDeployment's already-staged release (see staged_deploy), then, if
+    health_check_cmd is given, runs it on the host; the activation fails if it does.
+    Old releases aren't garbage-collected (see CodeCleanup).
+    """
+    deterministic = False
+
+    def __init__(self, code_deployment, health_check_cmd=None):
+        super(CodeActivation, self).__init__('Activate %s' % code_deployment.desc)
+        self.code_deployment = code_deployment
+        self.health_check_cmd = health_check_cmd
+
+    def run(self, host_string):
+        out = self.code_deployment.activate(host_string, gc=False).getvalue()
+        if self.health_check_cmd:
+            with connection_pool.session(host_string, warn_only=True):
+                ret = fab_api.run(self.health_check_cmd)
+            if ret.failed:
+                raise Exception('Health check failed after activating %s: %s' %
+                                (self.code_deployment.release_name, self.health_check_cmd))
+        return out
+
+
+# The activation barrier, in an activation worker process (see _init_activation_worker)
+_ready = None
+_go = None
+
+
+def _init_activation_worker(processes, ready, go):
+    global _ready, _go
+    fleet.init_worker_process(processes)
+    _ready, _go = ready, go
+
+
+def _activate_hosts_task(args):
+    # Module-level (and taking a single argument) so that multiprocessing can pickle it
+    config_unit, host_strings, go_timeout = args
+    # Every connection must stay open until the swap
+    connection_pool.max_connections = max(connection_pool.max_connections, len(host_strings))
+    unreachable = {}
+    for host_string in host_strings:
+        try:
+            with connection_pool.session(host_string):
+                pass
+        except (Exception, SystemExit):
+            unreachable[host_string] = traceback.format_exc()
+    _ready.release()
+    released = _go.wait(go_timeout)
+
+    results = []
+    for host_string in host_strings:
+        if host_string in unreachable:
+            results.append(fleet.HostResult(host_string, [], failed_unit='connecting',
+                                            error=unreachable[host_string], elapsed=0))
+        elif not released:
+            results.append(fleet.HostResult(host_string, [], failed_unit=str(config_unit),
+                                            error='Never released to activate', elapsed=0))
+        else:
+            results.append(fleet.run_config_units([config_unit], host_string))
+    results[0].spans = tracing.tracer.drain()
+    return results
+
+
+def activate_together(config_unit, host_strings, max_processes=MAX_ACTIVATION_PROCESSES,
+                      connect_timeout=ACTIVATION_CONNECT_TIMEOUT):
+    """
+    Runs config_unit (e.g., a CodeActivation) on all of the hosts as nearly at the same moment
+    as we can: up to max_processes worker processes each connect to (and health-check) their
+    share of the hosts, and wait; once all of them have -- or connect_timeout has passed --
+    they're released together, and run config_unit on each of their hosts.  Hosts that
+    couldn't be connected to fail without running it.  Returns the FleetResult.
+    """
+    host_strings = list(host_strings)
+    result = fleet.FleetResult(host_strings)
+    if not host_strings:
+        return result
+    n = min(max_processes, len(host_strings))
+    shares = [host_strings[i::n] for i in range(n)]
+    ready = multiprocessing.Semaphore(0)
+    go = multiprocessing.Event()
+    pool = multiprocessing.Pool(n, initializer=_init_activation_worker, initargs=(n, ready, go))
+    try:
+        # A worker holds on to its share until it's released, so each takes exactly one
+        async_result = pool.map_async(_activate_hosts_task,
+                                      [(config_unit, share, connect_timeout + 60) for share in shares], 1)
+        give_up_at = time.time() + connect_timeout
+        connected = 0
+        # Timeouts throughout, so that the waits can be interrupted with Ctrl-C
+        while connected < n and time.time() < give_up_at:
+            if ready.acquire(True, 1):
+                connected += 1
+        if connected < n:
+            print 'Only %d of %d activation processes connected within %ds; activating anyway' % (
+                connected, n, connect_timeout)
+        print 'Activating on %d hosts' % len(host_strings)
+        go.set()
+        while not async_result.ready():
+            async_result.wait(1)
+        for host_results in async_result.get():
+            for host_result in host_results:
+                tracing.tracer.merge(host_result.spans)
+                host_result.spans = []
+                result.host_results[host_result.host_string] = host_result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        go.set()
+        pool.join()
+    for host_string in result.failed_hosts:
+        print str(result.host_results[host_string])
+    return result
+
+
+class StagedDeployResult(object):
+    """The FleetResults of each phase of a staged_deploy (None for phases that didn't run)"""
+    def __init__(self, release, stage_result, activate_result=None, rollback_result=None, cleanup_result=None):
+        super(StagedDeployResult, self).__init__()
+        self.release = release
+        self.stage_result = stage_result
+        self.activate_result = activate_result
+        self.rollback_result = rollback_result
+        self.cleanup_result = cleanup_result
+
+    @property
+    def succeeded(self):
+        return self.activate_result is not None and self.activate_result.succeeded
+
+    def raise_for_failures(self):
+        if not self.succeeded:
+            failed = self.stage_result if self.activate_result is None else self.activate_result
+            raise Exception('Staged deploy of %s failed%s -- failed hosts: %s' % (
+                self.release, ' (rolled back)' if self.rollback_result else '', failed.failed_hosts))
+
+
+def staged_deploy(code_deployment, host_strings, pool_size=fleet.DEFAULT_POOL_SIZE, health_check_cmd=None,
+                  rollback_on_failure=True):
+    """
+    Deploys code_deployment to all of the hosts in two phases.  First the release is staged
+    (created, but not activated) on every host, in parallel; if that fails anywhere,
+    nothing is activated.  Then it's activated on every host at once (see activate_together),
+    followed by health_check_cmd if given.  If any activation fails and rollback_on_failure,
+    every host on which the release was activated is rolled back.  Old releases are only
+    garbage-collected once the release is active everywhere (a failed cleanup is reported in
+    the result's cleanup_result, but doesn't fail the deploy).
+
+    The release's timestamp is fixed here, in the parent process, so that every host gets
+    the same release name (the hosts are worked on in child processes, so anything they set
+    on the deployment is lost).  code_deployment itself is left as it is.
+    """
+    host_strings = list(host_strings)
+    deployment = copy.copy(code_deployment)
+    deployment.activate_immediately = False
+    deployment.fixed_timestamp_suffix = deployment.timestamp_suffix = \
+        datetime.now().strftime('%Y%m%d_%H%M%S%f')
+    release = deployment.release_name
+
+    print 'Staging %s on %d hosts' % (release, len(host_strings))
+    stage_result = fleet.FleetExecutor([deployment], pool_size=pool_size, fail_fast=False).run(host_strings)
+    if not stage_result.succeeded:
+        print 'Not activating %s: staging failed on %s' % (release, stage_result.failed_hosts)
+        return StagedDeployResult(release, stage_result)
+
+    print 'Connecting to %d hosts to activate %s' % (len(host_strings), release)
+    activate_result = activate_together(CodeActivation(deployment, health_check_cmd), host_strings)
+    rollback_result = None
+    if not activate_result.succeeded and rollback_on_failure:
+        print 'Activation failed on %s; rolling back %s everywhere' % (activate_result.failed_hosts, release)
+        rollback_result = activate_together(CodeRollback(deployment, from_release=release), host_strings)
+    cleanup_result = None
+    if activate_result.succeeded:
+        cleanup_result = fleet.FleetExecutor([CodeCleanup(deployment)], pool_size=pool_size,
+                                             fail_fast=False).run(host_strings)
+    return StagedDeployResult(release, stage_result, activate_result, rollback_result, cleanup_result)
@@ -0,0 +1,256 @@
+"""
+Running a host's config units as a dependency graph rather than a flat list: config units whose
+dependencies have all been applied run concurrently (at most max_parallel at once), except that
+two config units that use the same resource (see ConfigUnit.resources) never run at the same
+time.  As with FleetExecutor, concurrently running config units are in separate processes,
+since Fabric's env is process-global.
+"""
+import multiprocessing
+import time
+import traceback
+
+from devops import fleet
+from devops import output
+from devops import settings
+from devops import tracing
+
+DEFAULT_MAX_PARALLEL = 4
+# A config unit with no result after this many seconds is taken to have failed (e.g., its
+# worker process died, which multiprocessing never reports)
+UNIT_TIMEOUT = getattr(settings, 'CONFIG_UNIT_TIMEOUT', 3600)
+# How often (in seconds) we check on the running config units
+POLL_INTERVAL = 0.2
+
+
+def resolve_dependencies(config_units):
+    """
+    Returns a list with, for each config unit, the set of indexes (into config_units) of the
+    config units it depends on.  A config unit whose depends_on is None depends on the one
+    before it.  Dependencies on config units that aren't in the list are taken to have been
+    applied already.  Raises an Exception on a dependency cycle.
+    """
+    index_of = dict((id(cu), i) for i, cu in enumerate(config_units))
+    deps = []
+    for i, cu in enumerate(config_units):
+        if cu.depends_on is None:
+            deps.append(set([i - 1]) if i > 0 else set())
+        else:
+            deps.append(set(index_of[id(d)] for d in cu.depends_on if id(d) in index_of))
+
+    # Check for cycles
+    state = {}  # index -> 'visiting' / 'done'
+
+    def visit(i, path):
+        if state.get(i) == 'done':
+            return
+        if state.get(i) == 'visiting':
+            raise Exception('Dependency cycle among config units: %s' %
+                            ' -> '.join(str(config_units[j]) for j in path + [i]))
+        state[i] = 'visiting'
+        for d in deps[i]:
+            visit(d, path + [i])
+        state[i] = 'done'
+
+    for i in range(len(config_units)):
+        visit(i, [])
+    return deps
+
+
+class UnitTiming(object):
+    def __init__(self, config_unit, start, end, output=None, error=None):
+        super(UnitTiming, self).__init__()
+        self.config_unit = config_unit
+        self.start = start
+        self.end = end
+        self.output = output
+        self.error = error
+
+    @property
+    def elapsed(self):
+        return self.end - self.start
+
+
+class ScheduleResult(object):
+    """The outcome of DependencyScheduler.run on one host"""
+    def __init__(self, host_string, config_units, deps, timings, started_at, finished_at):
+        super(ScheduleResult, self).__init__()
+        self.host_string = host_string
+        self.config_units = config_units
+        self.deps = deps
+        # Index -> UnitTiming, for each config unit that ran
+        self.timings = timings
+        self.started_at = started_at
+        self.finished_at = finished_at
+
+    @property
+    def failed_units(self):
+        return [self.config_units[i] for i, t in sorted(self.timings.items()) if t.error]
+
+    @property
+    def not_run_units(self):
+        return [cu for i, cu in enumerate(self.config_units) if i not in self.timings]
+
+    @property
+    def succeeded(self):
+        return not self.failed_units and not self.not_run_units
+
+    def raise_for_failures(self):
+        if not self.succeeded:
+            messages = ['%s: %s' % (self.config_units[i], t.error)
+                        for i, t in sorted(self.timings.items()) if t.error]
+            raise Exception('Config units failed on %s:\n%s' % (self.host_string, '\n'.join(messages)))
+
+    def critical_path(self):
+        """
+        Returns (config units, seconds): the chain of dependent config units with the longest
+        total run time -- the floor on how fast this host can be configured, no matter how
+        much runs in parallel.
+        """
+        # Dependencies can point "forward" in the list, so go in dependency order
+        order = []
+        seen = set()
+
+        def visit(i):
+            if i in seen:
+                return
+            seen.add(i)
+            for d in self.deps[i]:
+                visit(d)
+            order.append(i)
+        for i in range(len(self.config_units)):
+            visit(i)
+
+        finish = {}  # Index -> total time of the longest chain ending with that config unit
+        via = {}  # Index -> the dependency on that chain
+        for i in order:
+            own = self.timings[i].elapsed if i in self.timings else 0.0
+            best = max(self.deps[i], key=lambda d: finish[d]) if self.deps[i] else None
+            finish[i] = own + (finish[best] if best is not None else 0.0)
+            via[i] = best
+        if not finish:
+            return [], 0.0
+        i = max(finish, key=lambda k: finish[k])
+        total = finish[i]
+        path = []
+        while i is not None:
+            path.append(self.config_units[i])
+            i = via[i]
+        return list(reversed(path)), total
+
+    def report(self):
+        lines = ['Config units on %s:' % self.host_string,
+                 '  %8s %8s  %s' % ('start', 'elapsed', 'config unit')]
+        for i, t in sorted(self.timings.items(), key=lambda item: item[1].start):
+            lines.append('  %7.1fs %7.1fs  %s%s' % (t.start - self.started_at, t.elapsed, t.config_unit,
+                                                  ' (FAILED)' if t.error else ''))
+        for cu in self.not_run_units:
+            lines.append('  %8s %8s  %s (not run)' % ('-', '-', cu))
+        path, total = self.critical_path()
+        serial = sum(t.elapsed for t in self.timings.values())
+        lines.append('Wall time: %.1fs (%.1fs if run serially)' % (self.finished_at - self.started_at, serial))
+        lines.append('Critical path (%.1fs): %s' % (total, ' -> '.join(str(cu) for cu in path)))
+        return '\n'.join(lines)
+
+
+def _run_unit_task(args):
+    # Module-level (and taking a single argument) so that multiprocessing can pickle it
+    # The spans recorded in the worker go back with the result
+    index, config_unit, host_string = args
+    start = time.time()
+    try:
+        with tracing.unit_span(config_unit, host_string):
+            unit_output = config_unit.run(host_string)
+    # Fabric aborts (e.g., on a failed command) by raising SystemExit
+    except (Exception, SystemExit):
+        return index, start, time.time(), None, traceback.format_exc(), tracing.tracer.drain()
+    return index, start, time.time(), unit_output, None, tracing.tracer.drain()
+
+
+class DependencyScheduler(object):
+    """
+    Runs config units on a host as a dependency graph (see the module docstring).  Stops
+    starting new config units after the first failure, but lets the running ones finish.
+    """
+    def __init__(self, config_units, max_parallel=DEFAULT_MAX_PARALLEL, unit_timeout=UNIT_TIMEOUT):
+        super(DependencyScheduler, self).__init__()
+        self.config_units = list(config_units)
+        self.max_parallel = max_parallel
+        self.unit_timeout = unit_timeout
+        self.deps = resolve_dependencies(self.config_units)
+
+    def _next_finished(self, pending):
+        """
+        Waits for one of the pending config units (index -> (AsyncResult, submitted at)) to
+        finish.  Returns (its task result, whether it was given up on).  Every outcome counts:
+        a task or result that couldn't be pickled, or no result within unit_timeout, is a
+        failure of that unit.
+        """
+        while True:
+            now = time.time()
+            for index, (async_result, submitted_at) in pending.items():
+                if async_result.ready():
+                    del pending[index]
+                    try:
+                        return async_result.get(), False
+                    except Exception:
+                        return (index, submitted_at, now, None, traceback.format_exc(), []), False
+                if now - submitted_at > self.unit_timeout:
+                    del pending[index]
+                    error = 'No result after %ds (the worker process may have died)' % self.unit_timeout
+                    return (index, submitted_at, now, None, error, []), True
+            # A timeout, so that the wait can be interrupted with Ctrl-C
+            next(pending.itervalues())[0].wait(POLL_INTERVAL)
+
+    def run(self, host_string):
+        started_at = time.time()
+        timings = {}
+        done = set()
+        running = set()
+        held_resources = set()
+        failed = False
+        pending = {}  # Index -> (AsyncResult, submitted at)
+        gave_up = False
+
+        pool = multiprocessing.Pool(self.max_parallel, initializer=fleet.init_worker_process,
+                                    initargs=(self.max_parallel,))
+        try:
+            while True:
+                if not failed:
+                    for i, cu in enumerate(self.config_units):
+                        if len(running) >= self.max_parallel:
+                            break
+                        if i in done or i in running or not self.deps[i] <= done:
+                            continue
+                        if cu.resources & held_resources:
+                            continue
+                        output.echo(host_string, 'Running config unit: %s' % cu)
+                        running.add(i)
+                        held_resources |= cu.resources
+                        pending[i] = (pool.apply_async(_run_unit_task, [(i, cu, host_string)]), time.time())
+                if not running:
+                    break
+                (index, start, end, unit_output, error, spans), lost = self._next_finished(pending)
+                gave_up = gave_up or lost
+                tracing.tracer.merge(spans)
+                running.discard(index)
+                held_resources -= self.config_units[index].resources
+                timings[index] = UnitTiming(self.config_units[index], start, end, unit_output, error)
+                if error:
+                    output.echo(host_string, 'Config unit FAILED: %s' % self.config_units[index])
+                    failed = True
+                else:
+                    done.add(index)
+            if gave_up:
+                # A worker may still be busy with (or have lost) a unit; don't wait on it
+                pool.terminate()
+            else:
+                pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        result = ScheduleResult(host_string, self.config_units, self.deps, timings, started_at, time.time())
+        print result.report()
+        return result
@@ -0,0 +1,129 @@
+"""
+A compact on-disk snapshot of the OpsRegistry (AMIs and instances, with their tags), so that a
+new process can start from it in milliseconds rather than listing the whole account first.
+
+The snapshot holds plain records rather than Boto objects; ImageRecord and InstanceRecord
+expose the attributes of Boto's Image and Instance that the registry's callers use.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+# Bump whenever the layout of the snapshot changes; snapshots with any other version are ignored
+SNAPSHOT_VERSION = 1
+
+
+class ImageRecord(object):
+    FIELDS = ('id', 'name', 'state', 'tags')
+
+    def __init__(self, id, name, state, tags):
+        super(ImageRecord, self).__init__()
+        self.id = id
+        self.name = name
+        self.state = state
+        self.tags = tags
+
+    def __repr__(self):
+        return 'ImageRecord:%s' % self.id
+
+
+class InstanceRecord(object):
+    FIELDS = ('id', 'state', 'tags', 'image_id', 'instance_type', 'placement',
+              'public_dns_name', 'private_dns_name', 'ip_address', 'private_ip_address')
+
+    def __init__(self, id, state, tags, image_id, instance_type, placement,
+                 public_dns_name, private_dns_name, ip_address, private_ip_address):
+        super(InstanceRecord, self).__init__()
+        self.id = id
+        self.state = state
+        self.tags = tags
+        self.image_id = image_id
+        self.instance_type = instance_type
+        self.placement = placement
+        self.public_dns_name = public_dns_name
+        self.private_dns_name = private_dns_name
+        self.ip_address = ip_address
+        self.private_ip_address = private_ip_address
+
+    def __repr__(self):
+        return 'InstanceRecord:%s' % self.id
+
+
+def _to_dict(obj, record_cls):
+    d = dict((f, getattr(obj, f, None)) for f in record_cls.FIELDS)
+    d['tags'] = dict(d['tags'] or {})
+    return d
+
+
+def _etag(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True)).hexdigest()
+
+
+def save_snapshot(path, env, owner_id, ami_dict, instances):
+    """
+    Writes the registry's AMI dict (name -> list of AMIs) and instance list (Boto objects or
+    records; either may be None) to path, atomically.  Returns the snapshot's etag.
+    """
+    payload = {'env': env,
+               'owner_id': owner_id,
+               'amis': None,
+               'instances': None}
+    # A collection that hasn't been loaded yet is saved as null, not as empty
+    if ami_dict is not None:
+        payload['amis'] = dict((name, [_to_dict(a, ImageRecord) for a in amis])
+                               for name, amis in ami_dict.items())
+    if instances is not None:
+        payload['instances'] = [_to_dict(i, InstanceRecord) for i in instances]
+    etag = _etag(payload)
+    snapshot = {'version': SNAPSHOT_VERSION, 'etag': etag, 'saved_at': time.time(), 'payload': payload}
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname or '.', prefix='.registry-snapshot-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.rename(tmp_path, path)
+    return etag
+
+
+class Snapshot(object):
+    def __init__(self, etag, saved_at, ami_dict, instances):
+        super(Snapshot, self).__init__()
+        self.etag = etag
+        self.saved_at = saved_at
+        # Name -> list of ImageRecords, in the order they were saved (None if not saved)
+        self.ami_dict = ami_dict
+        # List of InstanceRecords (None if not saved)
+        self.instances = instances
+
+    @property
+    def age(self):
+        return time.time() - self.saved_at
+
+
+def load_snapshot(path, env, owner_id):
+    """
+    Returns the Snapshot at path, or None if there isn't a usable one (missing, unreadable,
+    a different version, for a different env/account, or whose contents don't match its etag).
+    """
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    payload = snapshot.get('payload') or {}
+    if payload.get('env') != env or payload.get('owner_id') != owner_id:
+        return None
+    if _etag(payload) != snapshot.get('etag'):
+        return None
+    ami_dict = instances = None
+    if payload['amis'] is not None:
+        ami_dict = dict((name, [ImageRecord(**d) for d in amis]) for name, amis in payload['amis'].items())
+    if payload['instances'] is not None:
+        instances = [InstanceRecord(**d) for d in payload['instances']]
+    return Snapshot(snapshot['etag'], snapshot['saved_at'], ami_dict, instances)
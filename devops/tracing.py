@@ -0,0 +1,202 @@
+"""
+Timed spans around the hot paths -- EC2 API calls, remote commands, config units and wait
+loops -- for finding out where the time in a bake, launch or deploy actually goes.
+
+Tracing is off by default, and span() then costs next to nothing.  enable() turns it on and
+instruments the settings module's fab_api and ec2_conn, so that every remote command and
+every EC2 API request gets a span.  The spans can be exported as Chrome trace JSON (load it
+in chrome://tracing or Perfetto) with export_chrome_trace, and summarized per config unit
+(p50/p95 across hosts) with unit_latency_table.
+
+Spans recorded in FleetExecutor's (and DependencyScheduler's) worker processes are sent back
+to the parent along with each result.
+"""
+from contextlib import contextmanager
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+from devops import settings
+
+# Categories of the spans recorded by devops itself
+EC2_CATEGORY = 'ec2'
+SSH_CATEGORY = 'ssh'
+UNIT_CATEGORY = 'config_unit'
+WAIT_CATEGORY = 'wait'
+PHASE_CATEGORY = 'phase'
+
+# How much of a remote command is recorded on its span
+MAX_COMMAND_LENGTH = 200
+
+
+class Span(object):
+    def __init__(self, name, category, attrs, start, end=None, pid=None, tid=None):
+        super(Span, self).__init__()
+        self.name = name
+        self.category = category
+        self.attrs = attrs
+        self.start = start
+        self.end = end
+        self.pid = pid
+        self.tid = tid
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def to_chrome_event(self):
+        return {'name': self.name, 'cat': self.category, 'ph': 'X', 'pid': self.pid, 'tid': self.tid,
+                'ts': int(self.start * 1e6), 'dur': int(self.duration * 1e6), 'args': self.attrs}
+
+
+class Tracer(object):
+    def __init__(self):
+        super(Tracer, self).__init__()
+        self.enabled = False
+        self._spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category, **attrs):
+        """
+        Records a span around the block (if tracing is enabled).  Yields the Span (or None),
+        whose attrs the block may add to.
+        """
+        if not self.enabled:
+            yield None
+            return
+        s = Span(name, category, attrs, time.time(), pid=os.getpid(), tid=threading.current_thread().ident)
+        try:
+            yield s
+        except BaseException, e:
+            s.attrs['error'] = '%s: %s' % (type(e).__name__, e)
+            raise
+        finally:
+            s.end = time.time()
+            with self._lock:
+                self._spans.append(s)
+
+    def spans(self, category=None):
+        with self._lock:
+            return [s for s in self._spans if category is None or s.category == category]
+
+    def drain(self):
+        """Returns the spans recorded so far, and forgets them (e.g., to send them to another process)."""
+        with self._lock:
+            spans, self._spans = self._spans, []
+        return spans
+
+    def merge(self, spans):
+        with self._lock:
+            self._spans.extend(spans or [])
+
+    def reset_after_fork(self):
+        """For use in a forked child: forgets the spans inherited from the parent."""
+        self._lock = threading.Lock()
+        self._spans = []
+
+
+# The process's tracer
+tracer = Tracer()
+span = tracer.span
+
+
+def unit_span(config_unit, host_string, **attrs):
+    """A span around running a config unit on a host"""
+    return tracer.span(str(config_unit), UNIT_CATEGORY, host=host_string,
+                       unit_class=type(config_unit).__name__, **attrs)
+
+
+def traced(name, category=PHASE_CATEGORY):
+    """Decorator: a span around every call of the function"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name, category):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _traced_fab_operation(fab_api, name, fn):
+    def traced(*args, **kwargs):
+        if not tracer.enabled:
+            return fn(*args, **kwargs)
+        what = str(args[0] if args else kwargs.get('command', kwargs.get('local_path', '')))
+        with tracer.span(name, SSH_CATEGORY, host=fab_api.env.host_string,
+                         command=what[:MAX_COMMAND_LENGTH]):
+            return fn(*args, **kwargs)
+    traced.devops_traced = True
+    return traced
+
+
+def instrument_fab_api(fab_api):
+    """Wraps fab_api's run, sudo, put and local so that each gets a span."""
+    for name in ('run', 'sudo', 'put', 'local'):
+        fn = getattr(fab_api, name)
+        if not getattr(fn, 'devops_traced', False):
+            setattr(fab_api, name, _traced_fab_operation(fab_api, name, fn))
+
+
+def instrument_ec2_conn(ec2_conn):
+    """
+    Wraps ec2_conn's make_request -- which every boto EC2 call goes through, including those
+    made via instance and image objects -- so that each API request gets a span.
+    """
+    make_request = ec2_conn.make_request
+    if getattr(make_request, 'devops_traced', False):
+        return
+
+    def traced(action, *args, **kwargs):
+        if not tracer.enabled:
+            return make_request(action, *args, **kwargs)
+        with tracer.span(action, EC2_CATEGORY, action=action):
+            return make_request(action, *args, **kwargs)
+    traced.devops_traced = True
+    ec2_conn.make_request = traced
+
+
+def enable():
+    tracer.enabled = True
+    instrument_fab_api(settings.fab_api)
+    instrument_ec2_conn(settings.ec2_conn)
+
+
+def disable():
+    tracer.enabled = False
+
+
+def export_chrome_trace(path, spans=None):
+    """Writes the spans (by default, every span recorded) as Chrome trace JSON."""
+    spans = tracer.spans() if spans is None else spans
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': [s.to_chrome_event() for s in sorted(spans, key=lambda s: s.start)],
+                   'displayTimeUnit': 'ms'}, f)
+
+
+def percentile(values, pct):
+    """The pct-th percentile of values (nearest rank)"""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank - 1, 0), len(values) - 1)]
+
+
+def unit_latency_table(spans=None):
+    """
+    Returns a table of the time each config unit took (count, p50, p95, max, total), across
+    all of the hosts it ran on -- the most total time first.
+    """
+    spans = tracer.spans(UNIT_CATEGORY) if spans is None else [s for s in spans if s.category == UNIT_CATEGORY]
+    durations = {}
+    for s in spans:
+        durations.setdefault(s.name, []).append(s.duration)
+    lines = ['  %5s %8s %8s %8s %9s  %s' % ('count', 'p50', 'p95', 'max', 'total', 'config unit')]
+    for name, ds in sorted(durations.items(), key=lambda item: sum(item[1]), reverse=True):
+        lines.append('  %5d %7.1fs %7.1fs %7.1fs %8.1fs  %s' % (len(ds), percentile(ds, 50), percentile(ds, 95),
+                                                               max(ds), sum(ds), name))
+    return '\n'.join(lines)
@@ -1,7 +1,7 @@
 import os
 
 from devops import settings
-from devops.base import ExternalAMI, AMI, SecurityGroup, SecurityGroupRule
+from devops.base import ExternalAMI, AMI, RegisteredAMI, SecurityGroup, SecurityGroupRule
 from devops.deployment import CodeDeployment, SvnCodeRepository
 from devops.instance_config import CommandStrs, RemoteCopyFile, SshKey, SshKeyPlacement
 
@@ -17,19 +17,23 @@ ubuntu_inital_packages = CommandStrs(
               'sudo apt-get install gdal-bin --yes',
               'sudo apt-get install libpq-dev --yes',
               'sudo apt-get install sysstat --yes',
-              'sudo apt-get install subversion --yes'])
+              'sudo apt-get install subversion --yes'],
+    batched=True)
+ubuntu_inital_packages.declare(depends_on=[])
 
 create_deploy_dir = CommandStrs(
     desc='Create /deploy directory',
     commands=['sudo rm -rf /deploy',
               'sudo mkdir /deploy',
               'sudo chown ubuntu:ubuntu /deploy'])
+create_deploy_dir.declare(depends_on=[])
 
 python_27 = CommandStrs(
     desc='Python 2.7',
     # commands=['sudo apt-get install python 2.7 --yes',
     #           'sudo apt-get install python2.7-dev --yes'])
     commands=['sudo apt-get install python2.7-dev --yes'])
+python_27.declare(depends_on=[ubuntu_inital_packages])
 
 opsdev_ssh_key = SshKey(filename='opsdev_dsa',
     local_dir=os.path.join(settings.CONFIG_ROOT, 'ssh-keys'))
@@ -44,6 +48,7 @@ opsdev_ssh_key_placement = SshKeyPlacement(
     desc='Placement of opsdev SSH key',
     ssh_key=opsdev_ssh_key,
     remote_dir='/deploy/ssh-keys')
+opsdev_ssh_key_placement.declare(depends_on=[create_deploy_dir])
 
 restricted_ssh_key_placement = SshKeyPlacement(
     desc='Placement of restricted SSH key',
@@ -66,16 +71,19 @@ ubuntu_non_apt_packages = CodeDeployment(
     repo_containing_folder='aws',
     target_containing_folder='/home/ubuntu',
     activate_immediately=True)
+ubuntu_non_apt_packages.declare(depends_on=[ubuntu_inital_packages, opsdev_ssh_key_placement])
 
 post_deploy_non_apt_packages = CommandStrs(
     desc='Ubuntu NON-aptitude packages (installation)',
     commands=['find /home/ubuntu/ubuntu-config/packages -name \'*.tar.gz\' -execdir tar xvpf {} \';\'',
               'cd /home/ubuntu/ubuntu-config/packages/setuptools-0.6c11; sudo python ./setup.py install',
               'sudo easy_install virtualenv'])
+post_deploy_non_apt_packages.declare(depends_on=[python_27, ubuntu_non_apt_packages])
 
 scipy_dependencies = CommandStrs(
     desc='Dependencies for SciPy',
     commands=['sudo apt-get install libblas-dev libatlas-base-dev gfortran g++ --yes'])
+scipy_dependencies.declare(depends_on=[ubuntu_inital_packages])
 
 apache_wsgi_installation = \
     CommandStrs(desc='Install Apache',
@@ -86,6 +94,7 @@ apache_wsgi_installation = \
                       './configure --with-apxs=/usr/bin/apxs2 --with-python=/usr/bin/python2.7',
                   'cd /home/ubuntu/ubuntu-config/packages/mod_wsgi-3.3; ' +
                       'make; sudo make install'])
+apache_wsgi_installation.declare(depends_on=[python_27, ubuntu_non_apt_packages])
 
 add_wheezy_to_apt_sources = CommandStrs(
     desc='Add Wheezy to apt sources',
@@ -98,14 +107,16 @@ add_wheezy_to_apt_sources = CommandStrs(
               # These two get around the "GPG error NO_PUBKEY" error for the wheezy site
               'gpg --keyserver pgpkeys.mit.edu --recv-key AED4B06F473041FA',
               'gpg -a --export AED4B06F473041FA | sudo apt-key add -',
-              'sudo apt-get update'])
+              'sudo apt-get update'],
+    batched=True)
 
 remove_wheezy_from_apt_sources = CommandStrs(
     desc='Remove Wheezy from apt sources',
     # Just so that we don't unknowningly install a package from Wheezy (we only want it for PostgreSQL 9.1)
     commands=['sudo rm /etc/apt/sources.list.d/wheezy.list',
               'sudo rm /etc/apt/sources.list.d/wheezy-sec.list',
-              'sudo apt-get update'])
+              'sudo apt-get update'],
+    batched=True)
 
 # We add wheezy because we need at least 1.3.4 of pgbouncer (to work with PostgreSQL 9.1)
 # install_pgbouncer = \
@@ -117,11 +128,13 @@ remove_wheezy_from_apt_sources = CommandStrs(
 install_pgbouncer = \
     CommandStrs(desc='Install pgbouncer',
         commands=['sudo apt-get install pgbouncer --yes'])
+install_pgbouncer.declare(depends_on=[ubuntu_inital_packages])
 
 create_virtualenv = CommandStrs(
     desc='Create Python virtualenv',
     commands=['mkdir /deploy/pythonenvs; cd /home/ubuntu/ubuntu-config/pythonenvs; ' +
                   './create-virtualenv.sh /deploy/pythonenvs/siphonenv'])
+create_virtualenv.declare(depends_on=[post_deploy_non_apt_packages, scipy_dependencies])
 
 # For the time being, this has to be done WITH wheezy having been added to apt_sources
 # If we didn't need wheezy, this could have been done above with the rest of the packages
@@ -130,10 +143,12 @@ install_postgresql_client = \
     CommandStrs(desc='PostgreSQL client',
         commands=['sudo apt-get install postgresql-client-9.1 --yes']) + \
     remove_wheezy_from_apt_sources
+install_postgresql_client.declare(depends_on=[ubuntu_inital_packages])
 
 remove_ubuntu_non_apt_packages = CommandStrs(
     desc='Removing ubuntu-config directory',
     commands=['sudo rm -rf /home/ubuntu/ubuntu-config'])
+remove_ubuntu_non_apt_packages.declare(depends_on=[post_deploy_non_apt_packages, apache_wsgi_installation, create_virtualenv])
 
 create_restricted_user = CommandStrs(
     desc='Create a restricted user',
@@ -260,7 +275,7 @@ caliper_ami = AMI(
     name='caliper',
     vers='0.1',
     env=settings.DEVOPS_ENV,
-    parent_ami=settings.ops_registry.get_ami('Python'),
+    parent_ami=RegisteredAMI('Python'),
     config_units=[aws_deploy_dir,
                   aws_pysrc_dir,
                   create_restricted_user,
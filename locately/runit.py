@@ -3,10 +3,11 @@
 # export DEVOPS_SETTINGS_MODULE=locately.settings
 
 from devops import settings
+from devops.base import reconcile_security_groups, security_groups_in_module
 from locately import locately_configs
 
 # This should be done automatically, every time we start up the shell
-locately_configs.default_security_group.create_or_update(settings.ec2_conn)
+reconcile_security_groups(settings.ec2_conn, security_groups_in_module(locately_configs))
 
 ##################
 
@@ -20,7 +20,9 @@ fab_api.env.key_filename = AWS_SSH_KEY_FILENAME
 from locately.aws_creds import mpklein
 
 from boto.ec2 import EC2Connection
-# ec2_conn = EC2Connection(ec2manager.ACCESS_KEY_ID, ec2manager.SECRET_ACCESS_KEY)
-ec2_conn = EC2Connection(mpklein.ACCESS_KEY_ID, mpklein.SECRET_ACCESS_KEY)
+from devops.lazy import LazyObject
+# The connection is only made the first time it's used, so importing settings does no I/O
+# ec2_conn = LazyObject(lambda: EC2Connection(ec2manager.ACCESS_KEY_ID, ec2manager.SECRET_ACCESS_KEY))
+ec2_conn = LazyObject(lambda: EC2Connection(mpklein.ACCESS_KEY_ID, mpklein.SECRET_ACCESS_KEY))
 
 DEVOPS_ENV = 'prod'
@@ -0,0 +1,11 @@
+"""
+Unit tests for the pure parts of devops -- the shell commands it builds, its plans and its
+indexes.  Nothing here needs AWS or a live host; the shell commands are run locally, in
+temporary directories, with bash.
+
+Run from the repository root:
+    python -m unittest discover -s tests -t .
+"""
+import os
+
+os.environ.setdefault('DEVOPS_SETTINGS_MODULE', 'tests.unit_settings')
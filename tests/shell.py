@@ -0,0 +1,35 @@
+"""Runs the commands that devops builds for remote hosts locally, as Fabric would run them"""
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+def run(cmd, cwd=None):
+    """Runs cmd with bash; returns (exit status, output stripped as Fabric strips it)."""
+    p = subprocess.Popen(cmd, shell=True, cwd=cwd, executable='/bin/bash',
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = p.communicate()
+    return p.returncode, out.strip()
+
+
+class TempDir(object):
+    """A temporary directory, removed on exit"""
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix='devops-test-')
+        return self.path
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.path, True)
+
+
+def write_lines(path, lines):
+    with open(path, 'w') as f:
+        f.write(''.join('%s\n' % line for line in lines))
+
+
+def read_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return f.read().split()
@@ -0,0 +1,47 @@
+import os
+import unittest
+
+from devops import converge
+from tests.shell import TempDir, run
+
+# Stands in for sudo, which the tests needn't have
+NO_SUDO = 'sudo() { "$@"; }; '
+
+
+class MarkerCmdTest(unittest.TestCase):
+    def setUp(self):
+        self.marker_dir = converge.MARKER_DIR
+
+    def tearDown(self):
+        converge.MARKER_DIR = self.marker_dir
+
+    def test_applied_lists_existing_markers(self):
+        # (markers left, fingerprints asked about) -> listed
+        cases = [
+            ([], ['f1'], []),
+            (['f1', 'f2'], ['f2', 'f3'], ['f2']),
+            (['f1', 'f2'], ['f1', 'f2'], ['f1', 'f2']),
+        ]
+        for markers, fingerprints, expected in cases:
+            with TempDir() as tmp:
+                converge.MARKER_DIR = tmp
+                for marker in markers:
+                    open(os.path.join(tmp, marker), 'w').close()
+                status, out = run(converge.applied_cmd(fingerprints))
+                self.assertEqual(status, 0)
+                self.assertEqual(out.splitlines(), expected, (markers, fingerprints))
+
+    def test_applied_without_marker_dir(self):
+        with TempDir() as tmp:
+            converge.MARKER_DIR = os.path.join(tmp, 'missing')
+            self.assertEqual(run(converge.applied_cmd(['f1'])), (0, ''))
+
+    def test_record_then_applied(self):
+        with TempDir() as tmp:
+            converge.MARKER_DIR = os.path.join(tmp, 'units')
+            self.assertEqual(run(NO_SUDO + converge.record_cmd(['f1', 'f2']))[0], 0)
+            self.assertEqual(run(converge.applied_cmd(['f1', 'f2', 'f3'])), (0, 'f1\nf2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from devops import fleet
+
+HOSTS = ['h%d' % i for i in range(10)]
+
+
+class BatchesTest(unittest.TestCase):
+    # (hosts, batch_size) -> batch sizes
+    CASES = [
+        ((HOSTS, None), [10]),
+        ((HOSTS, 0), [10]),
+        (([], None), []),
+        (([], 3), []),
+        ((HOSTS, 1), [1] * 10),
+        ((HOSTS, 3), [3, 3, 3, 1]),
+        ((HOSTS, 10), [10]),
+        ((HOSTS, 50), [10]),
+        ((HOSTS, '3'), [3, 3, 3, 1]),
+        ((HOSTS, '25%'), [3, 3, 3, 1]),
+        ((HOSTS, '50%'), [5, 5]),
+        ((HOSTS, '100%'), [10]),
+        # Never less than one host per batch
+        ((HOSTS, '1%'), [1] * 10),
+        ((HOSTS[:1], '10%'), [1]),
+    ]
+
+    def test_cases(self):
+        for (hosts, batch_size), expected in self.CASES:
+            batches = fleet._batches(hosts, batch_size)
+            self.assertEqual([len(b) for b in batches], expected, (len(hosts), batch_size))
+            self.assertEqual(sum(batches, []), hosts)
+
+    def test_invalid(self):
+        for batch_size in [-1, '0%', '101%', '-5%']:
+            self.assertRaises(ValueError, fleet._batches, HOSTS, batch_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
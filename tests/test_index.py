@@ -0,0 +1,72 @@
+import unittest
+
+from devops.index import InstanceIndex
+
+
+class Instance(object):
+    """The attributes of a boto Instance that InstanceIndex reads"""
+    def __init__(self, id, type=None, zone='us-east-1a', state='running', **tags):
+        self.id = id
+        self.tags = dict(tags, devops_type=type) if type else tags
+        self.placement = zone
+        self.state = state
+
+
+def ids(instances):
+    return [i.id for i in instances]
+
+
+class InstanceIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = InstanceIndex([
+            Instance('i-1', 'web', 'us-east-1a'),
+            Instance('i-2', 'web', 'us-east-1b'),
+            Instance('i-3', 'db', 'us-east-1a', devops_release='r1'),
+            Instance('i-4', 'db', 'us-east-1b', state='stopped', devops_release='r1'),
+            Instance('i-5', zone='us-east-1a'),
+        ])
+
+    def test_find(self):
+        # criteria -> instance IDs
+        cases = [
+            ({}, ['i-1', 'i-2', 'i-3', 'i-4', 'i-5']),
+            ({'type': 'web'}, ['i-1', 'i-2']),
+            ({'zone': 'us-east-1a'}, ['i-1', 'i-3', 'i-5']),
+            ({'type': 'db', 'zone': 'us-east-1a'}, ['i-3']),
+            ({'type': 'db', 'state': 'running', 'release': 'r1'}, ['i-3']),
+            ({'release': 'r1', 'state': 'stopped'}, ['i-4']),
+            ({'type': 'cache'}, []),
+            ({'type': 'web', 'zone': 'us-west-2a'}, []),
+            # Untagged instances aren't indexed under None
+            ({'type': None}, []),
+        ]
+        for criteria, expected in cases:
+            self.assertEqual(ids(self.index.find(**criteria)), expected, criteria)
+
+    def test_unknown_field(self):
+        self.assertRaises(ValueError, self.index.find, colour='blue')
+
+    def test_add_reindexes(self):
+        self.index.add(Instance('i-1', 'db', 'us-east-1b'))
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(ids(self.index.find(type='web')), ['i-2'])
+        self.assertEqual(ids(self.index.find(type='db', zone='us-east-1b')), ['i-1', 'i-4'])
+
+    def test_remove(self):
+        self.index.remove('i-1')
+        self.index.remove('i-2')
+        self.index.remove('i-missing')
+        self.assertEqual(len(self.index), 3)
+        self.assertIsNone(self.index.get('i-1'))
+        self.assertEqual(ids(self.index.find(type='web')), [])
+        # Emptied values are dropped entirely
+        self.assertEqual(sorted(self.index.values('type')), ['db'])
+
+    def test_rebuild(self):
+        self.index.rebuild([Instance('i-9', 'web')])
+        self.assertEqual(ids(self.index.find()), ['i-9'])
+        self.assertEqual(dict(self.index.values('type')), {'web': set(['i-9'])})
+
+
+if __name__ == '__main__':
+    unittest.main()
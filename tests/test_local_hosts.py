@@ -0,0 +1,68 @@
+import os
+import unittest
+
+from devops import local_hosts
+from tests.shell import TempDir, run, write_lines
+
+HOSTS = {'web1': ('10.0.0.1', 'ip-10-0-0-1'), 'db': ('10.0.0.2', 'ip-10-0-0-2')}
+
+
+class RenderBlockTest(unittest.TestCase):
+    def test_block(self):
+        block, block_hash = local_hosts.render_block(HOSTS)
+        self.assertEqual(block.splitlines(), [
+            '%s %s' % (local_hosts.BLOCK_BEGIN, block_hash),
+            '10.0.0.2 ip-10-0-0-2 db',
+            '10.0.0.1 ip-10-0-0-1 web1',
+            local_hosts.BLOCK_END,
+        ])
+
+    def test_hash(self):
+        # The hash depends only on the entries, not the dict's order
+        block_hash = local_hosts.render_block(HOSTS)[1]
+        self.assertEqual(local_hosts.render_block(dict(reversed(HOSTS.items())))[1], block_hash)
+        self.assertNotEqual(local_hosts.render_block(dict(HOSTS, db=('10.0.0.3', 'ip-10-0-0-3')))[1], block_hash)
+        self.assertNotEqual(local_hosts.render_block({})[1], block_hash)
+
+
+class SyncCmdTest(unittest.TestCase):
+    def setUp(self):
+        self.hosts_filename = local_hosts.HOSTS_FILENAME
+
+    def tearDown(self):
+        local_hosts.HOSTS_FILENAME = self.hosts_filename
+
+    def sync(self, lines, hosts):
+        """Runs sync_cmd on a hosts file of the lines; returns (output, the lines afterwards)."""
+        with TempDir() as tmp:
+            local_hosts.HOSTS_FILENAME = os.path.join(tmp, 'hosts')
+            write_lines(local_hosts.HOSTS_FILENAME, lines)
+            status, out = run(local_hosts.sync_cmd(hosts))
+            self.assertEqual(status, 0)
+            with open(local_hosts.HOSTS_FILENAME) as f:
+                return out, f.read().splitlines()
+
+    def test_cases(self):
+        block = local_hosts.render_block(HOSTS)[0].splitlines()
+        stale_block = local_hosts.render_block({'web1': ('10.0.0.9', 'ip-10-0-0-9')})[0].splitlines()
+        # hosts file before -> (output, hosts file after)
+        cases = [
+            (['127.0.0.1 localhost'],
+             ('updated', ['127.0.0.1 localhost'] + block)),
+            (['127.0.0.1 localhost'] + block,
+             ('unchanged', ['127.0.0.1 localhost'] + block)),
+            (['127.0.0.1 localhost'] + stale_block + ['10.1.1.1 other'],
+             ('updated', ['127.0.0.1 localhost', '10.1.1.1 other'] + block)),
+            # Lines from EtcHostsConfigurer.update for the same aliases go, with their markers
+            (['127.0.0.1 localhost', '', local_hosts.UPDATE_MARKER, '10.0.0.9 ip-10-0-0-9 web1'],
+             ('updated', ['127.0.0.1 localhost', ''] + block)),
+            # ... but not lines for other aliases that merely end the same way
+            (['10.1.1.1 ip-10-1-1-1 oldweb1', '10.1.1.2 ip-10-1-1-2 web1.example'],
+             ('updated', ['10.1.1.1 ip-10-1-1-1 oldweb1', '10.1.1.2 ip-10-1-1-2 web1.example'] + block)),
+        ]
+        for before, expected in cases:
+            self.assertEqual(self.sync(before, HOSTS), expected, before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import unittest
+
+from devops import releases
+from tests.shell import TempDir, read_lines, run, write_lines
+
+DIRNAME = 'app'
+
+
+def make_deployment(folder, releases_=(), active=None, history=(), missing=()):
+    """Lays out a deployment: release directories (except those in missing), manifest, history, symlink"""
+    for release in releases_:
+        if release not in missing:
+            os.mkdir(os.path.join(folder, release))
+    write_lines(os.path.join(folder, releases.manifest_name(DIRNAME)), releases_)
+    if history:
+        write_lines(os.path.join(folder, releases.history_name(DIRNAME)), history)
+    if active:
+        os.symlink(active, os.path.join(folder, DIRNAME))
+
+
+def deployment_state(folder):
+    """Returns (release directories, active release, manifest, history)"""
+    dirs = sorted(d for d in os.listdir(folder) if not d.startswith('.') and d != DIRNAME)
+    link = os.path.join(folder, DIRNAME)
+    active = os.readlink(link) if os.path.islink(link) else None
+    return (dirs, active, read_lines(os.path.join(folder, releases.manifest_name(DIRNAME))),
+            read_lines(os.path.join(folder, releases.history_name(DIRNAME))))
+
+
+class RecordCmdTest(unittest.TestCase):
+    def test_records_each_release_once(self):
+        with TempDir() as folder:
+            for release in ['a', 'b', 'a', 'c', 'b']:
+                self.assertEqual(run(releases.record_cmd(folder, DIRNAME, release))[0], 0)
+            self.assertEqual(read_lines(os.path.join(folder, '.app.releases')), ['a', 'b', 'c'])
+
+
+class ActivateCmdTest(unittest.TestCase):
+    # (releases, active, history, release to activate, keep, gc) ->
+    # (release directories, active, manifest, history) afterwards
+    CASES = [
+        # First activation: nothing to add to the history
+        ((['a'], None, [], 'a', 5, True),
+         (['a'], 'a', ['a'], [])),
+        # The outgoing release goes into the history
+        ((['a', 'b'], 'a', [], 'b', 5, True),
+         (['a', 'b'], 'b', ['a', 'b'], ['a'])),
+        # Re-activating the active release doesn't add it to the history
+        ((['a', 'b'], 'b', ['a'], 'b', 5, True),
+         (['a', 'b'], 'b', ['a', 'b'], ['a'])),
+        # GC keeps the last keep releases, plus the one a rollback would go back to
+        ((['a', 'b', 'c', 'd'], 'b', ['a'], 'd', 1, True),
+         (['b', 'd'], 'd', ['b', 'd'], ['b'])),
+        # With gc=False, nothing is deleted
+        ((['a', 'b', 'c', 'd'], 'b', ['a'], 'd', 1, False),
+         (['a', 'b', 'c', 'd'], 'd', ['a', 'b', 'c', 'd'], ['a', 'b'])),
+    ]
+
+    def test_cases(self):
+        for (releases_, active, history, release, keep, gc), expected in self.CASES:
+            with TempDir() as folder:
+                make_deployment(folder, releases_, active, history)
+                status, _ = run(releases.activate_cmd(folder, DIRNAME, release, keep=keep, gc=gc))
+                self.assertEqual(status, 0)
+                self.assertEqual(deployment_state(folder), expected,
+                                 'activating %s over %s' % (release, (releases_, active, history, keep, gc)))
+
+
+class GcCmdTest(unittest.TestCase):
+    # (releases, active, history, keep) -> (release directories, manifest, history) afterwards
+    CASES = [
+        # Fewer releases than keep: nothing to do
+        ((['a', 'b'], 'b', ['a'], 5),
+         (['a', 'b'], ['a', 'b'], ['a'])),
+        # The previously active release is spared even when it's beyond keep
+        ((['a', 'b', 'c', 'd'], 'd', ['a', 'b', 'c'], 1),
+         (['c', 'd'], ['c', 'd'], ['c'])),
+        ((['a', 'b', 'c', 'd'], 'd', ['c'], 2),
+         (['c', 'd'], ['c', 'd'], ['c'])),
+        # A release staged after the active one doesn't push the active one out
+        ((['a', 'b', 'c', 'd', 'e'], 'b', ['a'], 2),
+         (['a', 'b', 'd', 'e'], ['a', 'b', 'd', 'e'], ['a'])),
+        # No history at all
+        ((['a', 'b', 'c'], 'c', [], 1),
+         (['c'], ['c'], [])),
+        # The history is cut to its last keep entries
+        ((['a', 'b', 'c', 'd'], 'd', ['a', 'b', 'c'], 2),
+         (['c', 'd'], ['c', 'd'], ['b', 'c'])),
+    ]
+
+    def test_cases(self):
+        for (releases_, active, history, keep), expected in self.CASES:
+            with TempDir() as folder:
+                make_deployment(folder, releases_, active, history)
+                status, _ = run(releases.cleanup_cmd(folder, DIRNAME, keep))
+                self.assertEqual(status, 0)
+                dirs, now_active, manifest, now_history = deployment_state(folder)
+                self.assertEqual(now_active, active)
+                self.assertEqual((dirs, manifest, now_history), expected,
+                                 'keeping %d of %s' % (keep, (releases_, active, history)))
+
+    def test_must_keep_a_release(self):
+        self.assertRaises(ValueError, releases.gc_cmd, DIRNAME, 0)
+
+
+class RollbackCmdTest(unittest.TestCase):
+    # (releases, active, history, from_release, missing directories) ->
+    # (succeeds, output, active, history) afterwards
+    CASES = [
+        ((['a', 'b', 'c'], 'c', ['a', 'b'], None, []),
+         (True, 'b', 'b', ['a'])),
+        # Rolling back twice walks back through the history
+        ((['a', 'b', 'c'], 'b', ['a'], None, []),
+         (True, 'a', 'a', [])),
+        # Nothing to roll back to
+        ((['a'], 'a', [], None, []),
+         (False, '', 'a', [])),
+        # The release to roll back to is gone
+        ((['a', 'b'], 'b', ['a'], None, ['a']),
+         (False, '', 'b', ['a'])),
+        # from_release isn't the active release: no change
+        ((['a', 'b'], 'b', ['a'], 'x', []),
+         (True, 'b', 'b', ['a'])),
+        ((['a', 'b'], 'b', ['a'], 'b', []),
+         (True, 'a', 'a', [])),
+    ]
+
+    def test_cases(self):
+        for (releases_, active, history, from_release, missing), expected in self.CASES:
+            with TempDir() as folder:
+                make_deployment(folder, releases_, active, history, missing)
+                status, out = run(releases.rollback_cmd(folder, DIRNAME, from_release))
+                _, now_active, _, now_history = deployment_state(folder)
+                self.assertEqual((status == 0, out, now_active, now_history), expected,
+                                 'rolling back %s' % ((releases_, active, history, from_release, missing),))
+
+
+if __name__ == '__main__':
+    unittest.main()
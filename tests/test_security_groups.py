@@ -0,0 +1,121 @@
+import unittest
+
+from devops.base import SecurityGroup, SecurityGroupRule, ec2_rule_keys, plan_security_groups
+
+OWNER_ID = '000000000000'
+
+
+class Grant(object):
+    def __init__(self, cidr_ip=None, group_name=None):
+        self.cidr_ip = cidr_ip
+        self.group_id = 'sg-%s' % group_name if group_name else None
+        self.groupName = group_name
+        self.owner_id = OWNER_ID if group_name else None
+
+
+class Rule(object):
+    def __init__(self, ip_protocol, from_port, to_port, grants):
+        # Boto hands back ports as strings
+        self.ip_protocol = ip_protocol
+        self.from_port = str(from_port) if from_port is not None else None
+        self.to_port = str(to_port) if to_port is not None else None
+        self.grants = grants
+
+
+class EC2Group(object):
+    """The attributes of a boto SecurityGroup that planning reads"""
+    def __init__(self, name, rules, description='desc'):
+        self.name = name
+        self.rules = rules
+        self.description = description
+
+
+SSH = SecurityGroupRule('tcp', 22, 22, cidr_ip='0.0.0.0/0')
+HTTP = SecurityGroupRule('tcp', 80, 80, cidr_ip='0.0.0.0/0')
+FROM_WEB = SecurityGroupRule('tcp', 5432, 5432, src_group_name='web')
+
+EC2_SSH = Rule('tcp', 22, 22, [Grant(cidr_ip='0.0.0.0/0')])
+EC2_HTTP = Rule('tcp', 80, 80, [Grant(cidr_ip='0.0.0.0/0')])
+EC2_FROM_WEB = Rule('tcp', 5432, 5432, [Grant(group_name='web')])
+
+
+class EC2RuleKeysTest(unittest.TestCase):
+    def test_one_key_per_grant(self):
+        group = EC2Group('g', [Rule('tcp', 0, 65535, [Grant(cidr_ip='10.0.0.0/8'), Grant(group_name='web')]),
+                               Rule('icmp', -1, -1, [Grant(cidr_ip='0.0.0.0/0')])])
+        self.assertEqual(ec2_rule_keys(group), {
+            ('tcp', 0, 65535, '10.0.0.0/8', None): None,
+            ('tcp', 0, 65535, None, 'web'): OWNER_ID,
+            ('icmp', -1, -1, '0.0.0.0/0', None): None,
+        })
+
+    def test_keys_match_rule_keys(self):
+        for rule, ec2_rule in [(SSH, EC2_SSH), (FROM_WEB, EC2_FROM_WEB)]:
+            self.assertEqual(list(ec2_rule_keys(EC2Group('g', [ec2_rule]))), [rule.key])
+
+
+class PlanTest(unittest.TestCase):
+    # (desired rules, EC2 group's rules or None if it doesn't exist) ->
+    # (create, rules to authorize, rules to revoke)
+    CASES = [
+        (([SSH, HTTP], None),
+         (True, [SSH, HTTP], [])),
+        (([], None),
+         (True, [], [])),
+        (([SSH, HTTP], [EC2_SSH, EC2_HTTP]),
+         (False, [], [])),
+        (([SSH, HTTP], [EC2_SSH]),
+         (False, [HTTP], [])),
+        (([SSH], [EC2_SSH, EC2_HTTP]),
+         (False, [], [HTTP])),
+        (([SSH, FROM_WEB], [EC2_HTTP]),
+         (False, [SSH, FROM_WEB], [HTTP])),
+        (([SSH], [EC2_FROM_WEB, EC2_SSH]),
+         (False, [], [FROM_WEB])),
+        # The same ports from a different source are a different rule
+        (([SecurityGroupRule('tcp', 22, 22, cidr_ip='10.0.0.0/8')], [EC2_SSH]),
+         (False, [SecurityGroupRule('tcp', 22, 22, cidr_ip='10.0.0.0/8')], [SSH])),
+    ]
+
+    def test_cases(self):
+        for (rules, ec2_rules), (create, to_authorize, to_revoke) in self.CASES:
+            ec2_group = EC2Group('g', ec2_rules) if ec2_rules is not None else None
+            plan = SecurityGroup('g', 'desc', rules).plan(ec2_group)
+            self.assertEqual((plan.create, plan.to_authorize, set(plan.to_revoke)),
+                             (create, set(r.key for r in to_authorize), set(r.key for r in to_revoke)),
+                             '%s vs. %s' % (map(str, rules), ec2_rules and len(ec2_rules)))
+            self.assertEqual(plan.has_changes, bool(create or to_authorize or to_revoke))
+
+    def test_revoke_keeps_source_owner(self):
+        plan = SecurityGroup('g', 'desc', []).plan(EC2Group('g', [EC2_FROM_WEB, EC2_SSH]))
+        self.assertEqual(plan.to_revoke, {FROM_WEB.key: OWNER_ID, SSH.key: None})
+
+    def test_referenced_group_names(self):
+        plan = SecurityGroup('db', 'desc', [SSH, FROM_WEB]).plan(None)
+        self.assertEqual(plan.referenced_group_names, set(['web']))
+        # A source that's already granted needn't be resolved
+        plan = SecurityGroup('db', 'desc', [SSH, FROM_WEB]).plan(EC2Group('db', [EC2_FROM_WEB]))
+        self.assertEqual(plan.referenced_group_names, set())
+
+    def test_description_mismatch(self):
+        group = SecurityGroup('g', 'desc', [SSH])
+        self.assertIsNone(group.plan(EC2Group('g', [EC2_SSH], 'desc')).description_mismatch)
+        self.assertEqual(group.plan(EC2Group('g', [EC2_SSH], 'other')).description_mismatch, 'other')
+
+    def test_str(self):
+        plan = SecurityGroup('g', 'desc', [SSH]).plan(EC2Group('g', [EC2_HTTP]))
+        self.assertEqual(str(plan).splitlines(), [
+            'Security group "g"', '  + tcp - 22-22 - 0.0.0.0/0', '  - tcp - 80-80 - 0.0.0.0/0'])
+
+
+class PlanSecurityGroupsTest(unittest.TestCase):
+    def test_order_and_duplicates(self):
+        web = SecurityGroup('web', 'desc', [HTTP])
+        db = SecurityGroup('db', 'desc', [FROM_WEB])
+        plans = plan_security_groups([db, web, db], {'web': EC2Group('web', [EC2_HTTP])})
+        self.assertEqual([(p.security_group.name, p.create, p.has_changes) for p in plans],
+                         [('db', True, True), ('web', False, False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
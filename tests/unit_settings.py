@@ -0,0 +1,12 @@
+"""Settings for the unit tests (see tests/__init__.py), which never reach EC2 or SSH"""
+from fabric import api as fab_api
+
+DEVOPS_ENV = 'test'
+KEYPAIR_NAME = 'test'
+ALL_AVAILABILITY_ZONES = ['us-east-1a', 'us-east-1b']
+USERNAME = 'ubuntu'
+INSTANCE_TYPE_FOR_AMI_CREATION = 't1.micro'
+AWS_OWNER_ID = '000000000000'
+
+# Nothing should outlive a test run
+OPS_REGISTRY_SNAPSHOT_PATH = None